@@ -158,18 +158,302 @@ Pool (пул) прокси:
 
 Тогда по истечении этого времени будет брошено исключение `NoFreeProxies` (см. proxy_switcher.errors)
 
+Одновременная выдача одного прокси нескольким потокам (по умолчанию прокси выдается только одному):
+
+    proxies = proxy_switcher.chain.Proxies.from_cfg_string('''{
+        "list": ["proxy-server.com:8080", "proxy-server.com:8081"],
+        "max_leases": 8,
+        "max_leases_per_proxy": {"proxy-server.com:8081": 16}
+    }''')
+
+Выдается наименее загруженный прокси, охлаждение и черный список действуют сразу на все его выдачи.
+
+Ограничение частоты использования прокси (альтернатива охлаждению после каждого запроса):
+
+    proxies = proxy_switcher.chain.Proxies.from_cfg_string('''{
+        "file": "./proxy_list.txt",
+        "rate_limit": 2,
+        "rate_burst": 5
+    }''')
+
+Каждый прокси выдается не чаще 2 раз в секунду (допускается до 5 выдач подряд),
+если все прокси исчерпали лимит - ожидание длится ровно до появления ближайшего свободного.
+Опция 'rate_limit_per_target' - считать лимит отдельно для каждого ресурса (см. ниже).
+
+Классы приоритета и ограничение очереди ожидающих:
+
+    proxies = proxy_switcher.chain.Proxies.from_cfg_string('''{
+        "file": "./proxy_list.txt",
+        "priorities": {"interactive": 10, "batch": 1},
+        "priority_mode": "weighted",
+        "max_waiters": 1000
+    }''')
+    proxy_chain = proxy_switcher.chain.Chain(proxies, use_pool=True, pool_priority='interactive')
+    proxies.get_pool().get_wait_stats()
+
+'strict' - "batch" ждет, пока есть ожидающие "interactive", 'weighted' - прокси делятся между классами
+пропорционально весам. Если ожидающих больше 'max_waiters' - сразу бросается `NoFreeProxies`.
+
+Список с атрибутами прокси (страна, провайдер, стоимость и т.п.) и выбор прокси по ним:
+
+    proxies = proxy_switcher.chain.Proxies.from_cfg_string('''{
+        "file": "./proxy_list.jsonl",
+        "format": "jsonl"
+    }''')
+    # proxy_list.jsonl: {"address": "1.2.3.4:1080", "type": "socks5", "country": "de", "provider": "acme"}
+    # proxy_list.csv ("format": "csv"): address,type,country,provider
+
+    proxy_chain = proxy_switcher.chain.Chain(proxies, use_pool=True, pool_where={'country': 'de', 'type': 'socks5'})
+    proxies.get_pool().acquire(where={'provider': 'acme'})
+    proxies.get_attributes('socks5://1.2.3.4:1080')
+
+Пул хранит индексы по атрибутам - подходящий свободный прокси находится без просмотра всего списка.
+Значения из csv - строки.
+
+Закрепление прокси за аккаунтом или сессией (например, для авторизованного обхода с cookies):
+
+    proxy_chain = proxy_switcher.chain.Chain(proxies, use_pool=True, pool_key='account-42')
+    proxies.get_pool().acquire(key='account-42')
+
+Для одного ключа выдается один и тот же прокси (консистентное хеширование, см. `affinity.HashRing`):
+пока он занят или охлаждается - ключ ждет именно его, а если прокси попал в черный список или удален
+из списка - к другим прокси переходят только закрепленные за ним ключи.
+Опция 'affinity_replicas' - кол-во точек на кольце для каждого прокси (по умолчанию 16).
+
+Учет трафика и запросов через прокси (`Client` учитывает каждый запрос, включая перенаправления) и бюджеты:
+
+    proxies = proxy_switcher.chain.Proxies(proxies_url='...', options={
+        'usage': './usage.json',
+        'budget': {'window': 3600, 'bytes': 1000000000, 'requests': 1000},
+        'pool_budget': {'window': 86400, 'bytes': 50000000000},
+    })
+    proxies.get_usage()  # {'1.2.3.4:1080': {'sent': ..., 'received': ..., 'requests': ..., ...}, '*': {...}}
+
+Прокси, исчерпавший 'budget' в текущем окне, охлаждается до его окончания; при исчерпании 'pool_budget'
+пул не выдает прокси до окончания окна. Окно начинается с первого запроса после окончания предыдущего.
+Размер ответа учитывается в том виде, в каком он передавался (до распаковки gzip), при `stream=True` -
+только заголовки. 'pool_budget' не поддерживается вместе с 'shards'.
+
+Пул для большого кол-ва потоков (128+): прокси распределяются по независимым шардам со своими локами,
+поток берет прокси из "своего" шарда, а если свободных в нем нет - из остальных:
+
+    proxies = proxy_switcher.chain.Proxies(['proxy-server.com:8080', ...], options={'shards': 8})
+    proxies.get_pool().get_contention_stats()
+
+Замер времени работы пула по фазам (ожидание лока, перечитывание списка, выбор прокси и т.д.):
+
+    profiler = proxy_switcher.profiling.Profiler(slow_threshold=0.5, on_slow=lambda phase, sec: ...)
+    proxies = proxy_switcher.chain.Proxies(proxies_url='...', profiler=profiler)
+    ...
+    profiler.get_stats()  # {'acquire.lock_wait': {'count': ..., 'total': ..., 'avg': ..., 'max': ...}, ...}
+
+Время импорта (`import proxy_switcher` не загружает chain, json_dict, urllib.request и т.д. -
+они импортируются при первом обращении, файлы состояния читаются при первом использовании пула):
+
+    result = proxy_switcher.profiling.measure_import('proxy_switcher.chain')
+    result['time'], result['modules']
+
+Без `profiler` замеры не выполняются.
+
+Трассировка запросов (ожидание прокси из пула, время до получения заголовков, загрузка тела ответа):
+
+    class MyExporter(proxy_switcher.tracing.Exporter):
+        def export(self, trace):
+            ...  # trace.tags - method, url, chain, proxy; trace.spans - tracing.Span
+
+    tracer = proxy_switcher.tracing.Tracer(MyExporter(), sample_rate=0.1)
+    client = proxy_switcher.client.Client(proxy_chain=proxy_chain, tracer=tracer)
+
+Быстрый старт после перезапуска (снимок списка и состояния пула):
+
+    proxies = proxy_switcher.chain.Proxies.from_cfg_string('''{
+        "url": "http://example.com/get/proxy_list/",
+        "snapshot": "./proxies.snapshot"
+    }''')
+
+Список берется из снимка, а ссылка перепроверяется в фоне условным запросом (ETag/Last-Modified).
+Снимок обновляется при каждой загрузке списка, для сохранения текущего состояния пула - `proxies.save_snapshot()`.
+
+Pre-fork сервер (список загружается до fork и используется дочерними процессами без повторной загрузки):
+
+    proxies = proxy_switcher.chain.Proxies.from_cfg_string('''{
+        "url": "http://example.com/get/proxy_list/",
+        "fork_workers": 8,
+        "stats": "./stats.json"
+    }''')
+    proxies.proxies  # загрузка в родительском процессе
+
+Каждый дочерний процесс получает свою часть списка (без пересечений) и свои файлы состояния ("./stats.json.N").
+Процесс, перезапущенный вместо завершившегося, получает его номер и часть списка.
+Цепочки (`Chain`), созданные до fork, в дочернем процессе берут прокси уже из его пула.
+Если сервер сам нумерует процессы - `proxies.set_worker(worker_id, workers_count)` в дочернем процессе.
+
+Кэш разрешения имен прокси и шлюза (в цепочку попадают ip-адреса, список разрешается в фоне после загрузки):
+
+    proxies = proxy_switcher.chain.Proxies.from_cfg_string('''{
+        "url": "http://example.com/get/proxy_list/",
+        "dns_cache": {"ttl": 300, "negative_ttl": 30}
+    }''')
+
+Мгновенная смена прокси (запасной прокси берется из пула заранее, в фоне):
+
+    proxy_chain = proxy_switcher.chain.Chain(proxies, use_pool=True, prefetch=True, prefetch_ttl=60)
+
+Неиспользованный за `prefetch_ttl` сек. запасной прокси возвращается в пул без охлаждения.
+
+Общие соединения для цепочек (keep-alive соединения через шлюз и прокси переиспользуются
+разными `Chain`/`MultiChain` и сессиями `Client`):
+
+    connection_pool = proxy_switcher.connections.AdapterPool(max_adapters=512, idle_ttl=120)
+    proxy_chain = proxy_switcher.chain.Chain(proxies, proxy_gw=gw, use_pool=True, connection_pool=connection_pool)
+    multi_chain = proxy_switcher.chain.MultiChain(proxies1, proxies2, connection_pool=connection_pool)
+
+Предохранители для шлюзов и источника списка:
+
+    gateway_breakers = proxy_switcher.breaker.BreakerRegistry(failure_threshold=3, recovery_timeout=30)
+    proxy_chain = proxy_switcher.chain.Chain(proxies, proxy_gw=gw, use_pool=True, gateway_breakers=gateway_breakers)
+
+При `switch(bad=True)` доступность шлюза проверяется в фоне (смена прокси не ждет проверки):
+если виноват шлюз - прокси возвращается в пул без охлаждения и черного списка. После нескольких таких ошибок подряд цепочка сразу бросает `CircuitOpenError`
+(`MultiChain` использует пулы за другими шлюзами), через `recovery_timeout` сек. шлюз проверяется повторно.
+Для источника списка - опция 'source_breaker' (см. `Proxies.from_cfg_string`).
+
+Охлаждение и черный список для конкретного ресурса (хоста):
+
+    proxy_chain = proxy_switcher.chain.Chain(proxies, use_pool=True, pool_target='example.com')
+    proxy_chain.switch(bad=True)  # прокси не будет использован для example.com, но доступен для остальных
+
+Состояние хранится только в памяти, кол-во ресурсов ограничено опциями 'max_targets' и 'target_idle_ttl'.
+
+Подбор параметров охлаждения без реальных запросов (моделирование на виртуальном времени):
+
+    report = proxy_switcher.simulation.simulate(
+        ['proxy1:8080', 'proxy2:8080'],
+        ban_model=proxy_switcher.simulation.MinIntervalBanModel({'proxy1:8080': 30, 'proxy2:8080': 60}),
+        # или по записанной трассе банов: TraceBanModel.from_file('./bans.csv')
+        duration=24 * 3600,
+        workers=4,
+        options={'smart_holdout_start': 10, 'smart_holdout_max': 600},
+    )
+    print(report.throughput, report.ban_rate, report.avg_acquire_wait)
+
+Проверка прокси из черного списка в фоне (вместо выдачи их из пула "в последнюю очередь"):
+
+    checker = proxy_switcher.health.HealthChecker(
+        proxies, probe_url='http://myip.ru', proxy_gw='socks5://dts-proxy2.unix.tensor.ru:9999',
+        interval=60, max_workers=10,
+    )
+    checker.start()
+
+Прошедшие проверку прокси изымаются из черного списка (охлаждение продолжает действовать).
+
+Параллельная обработка большого кол-ва ссылок через пул:
+
+    executor = proxy_switcher.executor.PoolExecutor(proxies, proxy_gw=gw, max_workers=50)
+    for url, resp, exc in executor.fetch(urls):
+        ...
+
+Дублирование медленных запросов (только для идемпотентных методов и `Chain` с пулом):
+
+    # если ответ не получен за 2 сек., запрос дублируется через другой прокси из пула
+    client = proxy_switcher.client.Client(proxy_chain=proxy_chain, hedge_after=2)
+
+    # порог - 95-й процентиль времени ответа последних запросов
+    client = proxy_switcher.client.Client(proxy_chain=proxy_chain, hedge_percentile=95, hedge_after=2)
+
+Загрузка больших ответов без накопления тела в памяти:
+
+    with client.stream('GET', url, max_size=100 * 2 ** 20) as resp:
+        with open('file.zip', 'wb') as f:
+            resp.write_to(f)  # или resp.readinto(buffer), или `for chunk in resp: ...`
+
+При превышении `max_size` чтение прерывается (`client.ResponseTooLarge`). Выход из `with` до окончания
+чтения отменяет загрузку: небольшой остаток тела дочитывается, и соединение с прокси переиспользуется.
+
+Нагрузочный тест `Client` + `Chain` + пул без реальных прокси - локальные заглушки SOCKS5/HTTP прокси
+с задержкой, ограничением скорости, ошибками и баном после K запросов (см. модуль loadtest):
+
+    with proxy_switcher.loadtest.Harness(proxies=20, latency=0.05, failure_rate=0.01, ban_after=200) as harness:
+        report = harness.run(requests=5000, workers=50, size=10000)
+        # {'rps': ..., 'latency': {'p50', 'p90', 'p99', 'max'}, 'ban_rate': ..., 'pool_wait': {...}, ...}
+
+    # цепочка через шлюз
+    proxy_switcher.loadtest.Harness(proxies=20, gateway=True)
+
 
 Changelog:
    1.0.0 - Initial release
    1.1.0 - Добавлена возможность одновременного использования нескольких пулов - MultiChain;
    Улучшена работа алгоритма "smart holdout" (+ новая опция 'smart_holdout_max');
    Добавлены опции: 'default_holdout' и 'default_bad_holdout' для интервала охлаждения по умолчанию
+   1.2.0 - Добавлена фоновая проверка прокси из черного списка - health.HealthChecker
+   Добавлена опция 'validation' - проверка новых прокси перед добавлением в список
+   Добавлено дублирование медленных запросов в `Client` (параметры 'hedge_after', 'hedge_percentile')
+   Добавлен executor.PoolExecutor - параллельное выполнение задач через пул
+   Добавлены охлаждение и черный список для конкретного ресурса (`Chain(pool_target=...)`)
+   Добавлены опции 'max_leases' и 'max_leases_per_proxy' - одновременная выдача прокси из пула
+   Добавлены опции 'rate_limit', 'rate_burst' и 'rate_limit_per_target' - ограничение частоты выдачи прокси
+   Добавлен модуль simulation - моделирование работы пула (`Proxies(clock=...)`)
+   MultiChain ожидает свободный прокси сразу во всех пулах (вместо поочередного перебора),
+   пул выбирается по кол-ву свободных прокси или по весам (параметр 'weights')
+   Добавлена опция 'shards' - пул из нескольких шардов с отдельными локами
+   Добавлен модуль profiling - замер времени работы пула по фазам (`Proxies(profiler=...)`)
+   Добавлен модуль tracing - трассировка запросов `Client` (параметр 'tracer')
+   Добавлена опция 'snapshot' - быстрый старт из снимка списка и состояния пула
+   Добавлена опция 'fork_workers' - разделение списка между процессами pre-fork сервера
+   Добавлена опция 'dns_cache' - кэш разрешения имен прокси и шлюза
+   Добавлен запасной прокси для мгновенной смены (`Chain(prefetch=True)`)
+   Добавлен модуль connections - общие соединения для цепочек (параметр 'connection_pool')
+   Добавлены предохранители для шлюзов (`Chain(gateway_breakers=...)`) и источника списка (опция 'source_breaker')
+   Добавлены опции 'priorities', 'priority_mode', 'max_waiters' - классы приоритета при ожидании прокси
+   Добавлена опция 'format' - списки с атрибутами прокси (jsonl, csv) и выбор прокси по ним (`acquire(where=...)`)
+   Добавлен модуль affinity - закрепление прокси за ключом (`acquire(key=...)`, `Chain(pool_key=...)`)
+   Добавлен учет трафика и запросов через прокси и бюджеты (опции 'usage', 'budget', 'pool_budget')
+   Добавлена потоковая загрузка ответов `Client.stream`
+   Добавлен модуль loadtest - нагрузочный тест на локальных заглушках прокси
+   Ускорен импорт пакета: модули, opener и файлы состояния загружаются при первом использовании
 
 """
 
 
-from .chain import Proxies, Chain, MultiChain, ProxyURLRefreshError
-from .client import Client
+import importlib
+
+
+# имя -> подмодуль; загружаются при первом обращении, чтобы `import proxy_switcher` не импортировал
+# chain (json_dict, urllib и т.д.) в процессах, которым он не нужен (см. `profiling.measure_import`)
+_LAZY_ATTRS = {
+    'Proxies': 'chain',
+    'Chain': 'chain',
+    'MultiChain': 'chain',
+    'ProxyURLRefreshError': 'chain',
+    'CircuitOpenError': 'chain',
+    'Client': 'client',
+}
+
+_SUBMODULES = (
+    'affinity', 'breaker', 'chain', 'client', 'connections', 'executor', 'health', 'loadtest',
+    'profiling', 'request_logging', 'resolver', 'simulation', 'snapshot', 'tracing', 'utils',
+)
+
+__all__ = list(_LAZY_ATTRS)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        # `import proxy_switcher; proxy_switcher.chain.Proxies(...)`
+        return importlib.import_module('.' + name, __name__)
+
+    module_name = _LAZY_ATTRS.get(name)
+    if module_name is None:
+        raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+    value = getattr(importlib.import_module('.' + module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()).union(_LAZY_ATTRS, _SUBMODULES))
 
 
-__version__ = '1.1.0'
+__version__ = '1.2.0'
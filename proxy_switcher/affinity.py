@@ -0,0 +1,174 @@
+import bisect
+import struct
+import itertools
+import hashlib
+
+
+_RING_SIZE = 2 ** 64
+# один хеш blake2b (64 байта) - 8 точек кольца
+_BLOCK = struct.Struct('<8Q')
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'little')
+
+
+class HashRing:
+    """Кольцо консистентного хеширования: закрепляет ключи (аккаунты, сессии) за прокси
+
+    Каждый прокси представлен `replicas` точками на кольце, ключ закрепляется за первым прокси
+    по часовой стрелке. Пропущенные при поиске прокси (черный список) и удаленные из списка
+    затрагивают только закрепленные за ними ключи - они переходят к следующему прокси на кольце.
+
+    Поиск - O(log n). При обновлении списка точки удаленных прокси только помечаются удаленными,
+    а точки новых попадают в небольшой отдельный отсортированный список; основной список
+    пересобирается (O(n), без пересчета хешей), только когда изменений накопилось много.
+    """
+
+    def __init__(self, nodes=(), replicas=16):
+        """
+        @param nodes: адреса прокси
+        @param replicas: кол-во точек на кольце для каждого прокси (больше - равномернее распределение ключей)
+        """
+        self.replicas = replicas
+
+        # отсортированные точки (могут содержать удаленные - их нет в `_owners`)
+        self._points = []
+        # отсортированные точки, добавленные после последней пересборки
+        self._added = []
+        # точка -> прокси (только действующие точки)
+        self._owners = {}
+        # удаленные точки, оставшиеся в `_points`
+        self._removed = set()
+        self._nodes = set()
+
+        self.update(nodes)
+
+    def _get_points(self, node):
+        data = node.encode()
+
+        points = []
+        for block in range((self.replicas + 7) // 8):
+            digest = hashlib.blake2b(data, digest_size=64, salt=bytes([block])).digest()
+            points.extend(_BLOCK.unpack(digest))
+
+        return points[:self.replicas]
+
+    def update(self, nodes):
+        """Приводит кольцо к новому списку прокси
+        """
+        nodes = set(nodes)
+
+        added = nodes.difference(self._nodes)
+        removed = self._nodes.difference(nodes)
+        if not added and not removed:
+            return
+
+        if len(added) + len(removed) >= len(nodes):
+            # первое построение или список сменился почти целиком
+            self._build(nodes)
+            return
+
+        for node in removed:
+            for point in self._get_points(node):
+                if self._owners.get(point) == node:
+                    del self._owners[point]
+                    self._removed.add(point)
+
+        added_points = []
+        for node in added:
+            for point in self._get_points(node):
+                # коллизии 64-битных хешей не обрабатываются - точка остается за прежним прокси
+                if point in self._owners:
+                    continue
+
+                self._owners[point] = node
+                if point in self._removed:
+                    # прокси вернулся в список - его точка еще есть в основном списке
+                    self._removed.discard(point)
+                else:
+                    added_points.append(point)
+
+        self._nodes = nodes
+
+        if len(self._added) + len(added_points) + len(self._removed) > max(64, len(self._points) // 8):
+            self._compact(added_points)
+        else:
+            for point in added_points:
+                bisect.insort(self._added, point)
+
+    def _build(self, nodes):
+        owners = {}
+        for node in nodes:
+            owners.update(zip(self._get_points(node), itertools.repeat(node)))
+
+        self._owners = owners
+        self._points = sorted(owners)
+        self._added = []
+        self._removed = set()
+        self._nodes = nodes
+
+    def _compact(self, added_points):
+        if self._removed:
+            points = [point for point in self._points if point in self._owners]
+        else:
+            points = self._points
+
+        points.extend(self._added)
+        points.extend(added_points)
+        # отсортированный список + короткие отрезки - timsort сливает их почти за линейное время
+        points.sort()
+
+        self._points = points
+        self._added = []
+        self._removed = set()
+
+    def _iter_nodes(self, point):
+        """Прокси по часовой стрелке от точки (каждая точка кольца - один раз)
+        """
+        main, added, owners = self._points, self._added, self._owners
+        n, m = len(main), len(added)
+
+        i = bisect.bisect_left(main, point)
+        j = bisect.bisect_left(added, point)
+
+        # сливаем оба списка в порядке удаления от точки
+        taken_main = taken_added = 0
+        while taken_main < n or taken_added < m:
+            a = main[(i + taken_main) % n] if taken_main < n else None
+            b = added[(j + taken_added) % m] if taken_added < m else None
+
+            if b is None or (a is not None and (a - point) % _RING_SIZE <= (b - point) % _RING_SIZE):
+                current = a
+                taken_main += 1
+            else:
+                current = b
+                taken_added += 1
+
+            node = owners.get(current)
+            if node is not None:
+                yield node
+
+    def lookup(self, key, skip=None):
+        """
+        @param key: ключ (приводится к строке)
+        @param skip: функция, возвращающая True для прокси, которые сейчас нельзя использовать
+        @return: прокси или None, если подходящих нет
+        """
+        checked = set()
+
+        for node in self._iter_nodes(_hash(str(key))):
+            if node in checked:
+                continue
+
+            if skip is None or not skip(node):
+                return node
+
+            checked.add(node)
+            if len(checked) == len(self._nodes):
+                break
+
+        return None
+
+    def __len__(self):
+        return len(self._nodes)
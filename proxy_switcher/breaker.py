@@ -0,0 +1,173 @@
+import socket
+import threading
+import functools
+import urllib.parse
+
+from . import utils
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def check_address(address, timeout=2):
+    """Проверяет, что по адресу прокси (`[scheme://][user:password@]host:port`) принимаются соединения
+    """
+    parsed = urllib.parse.urlsplit(address if '://' in address else '//' + address)
+
+    try:
+        with socket.create_connection((parsed.hostname, parsed.port), timeout=timeout):
+            return True
+    except (OSError, ValueError):
+        return False
+
+
+class CircuitBreaker:
+    """Предохранитель: после `failure_threshold` ошибок подряд ресурс считается недоступным
+    на `recovery_timeout` сек., затем проверяется - активно (`probe`) или первым же обращением
+    """
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30, probe=None, clock=None):
+        """
+        @param failure_threshold: кол-во ошибок подряд для размыкания
+        @param recovery_timeout (сек.): время до повторной проверки
+        @param probe: функция без аргументов, возвращающая True, если ресурс доступен;
+         None - проверкой служит следующее обращение к ресурсу
+        @param clock: источник времени (см. `utils.SystemClock`)
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.probe = probe
+
+        self._clock = clock or utils.SystemClock()
+        self._lock = threading.Lock()
+
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        # проверка уже выполняется другим потоком
+        self._probing = False
+        # ожидающие результата фоновой проверки (см. `check_async`), None - проверка не выполняется
+        self._callbacks = None
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def is_open(self):
+        return self._state != CLOSED
+
+    def allow(self):
+        """
+        @return: True - к ресурсу можно обращаться
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+
+            if self._probing or self._clock.time() - self._opened_at < self.recovery_timeout:
+                return False
+
+            self._state = HALF_OPEN
+            self._probing = True
+
+            if self.probe is None:
+                # результат обращения будет передан в `record_success`/`record_failure`
+                return True
+
+        return self.check()
+
+    def check(self):
+        """Проверяет ресурс через `probe` и учитывает результат
+        """
+        try:
+            alive = self.probe()
+        except Exception:
+            alive = False
+
+        if alive:
+            self.record_success()
+        else:
+            self.record_failure()
+
+        return alive
+
+    def check_async(self, callback=None):
+        """Проверяет ресурс через `probe` в фоне (не более одной проверки одновременно)
+
+        @param callback: функция (доступен ли ресурс), вызывается по завершении проверки -
+         в т.ч. уже выполняемой, если она запущена другим потоком
+        """
+        with self._lock:
+            start = self._callbacks is None
+            if start:
+                self._callbacks = []
+            if callback is not None:
+                self._callbacks.append(callback)
+
+        if start:
+            threading.Thread(target=self._check_async, daemon=True).start()
+
+    def _check_async(self):
+        alive = False
+        try:
+            alive = self.check()
+        finally:
+            with self._lock:
+                callbacks, self._callbacks = self._callbacks, None
+
+            for callback in callbacks:
+                callback(alive)
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = self._clock.time()
+
+
+class BreakerRegistry:
+    """Предохранители шлюзов, общие для всех цепочек (`Chain(gateway_breakers=...)`)
+
+    Доступность шлюза проверяется установкой TCP-соединения.
+    """
+
+    def __init__(self, failure_threshold=3, recovery_timeout=30, probe_timeout=2, clock=None):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.probe_timeout = probe_timeout
+
+        self._clock = clock
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, address):
+        with self._lock:
+            breaker = self._breakers.get(address)
+            if breaker is None:
+                breaker = self._breakers[address] = CircuitBreaker(
+                    failure_threshold=self.failure_threshold,
+                    recovery_timeout=self.recovery_timeout,
+                    probe=functools.partial(check_address, address, timeout=self.probe_timeout),
+                    clock=self._clock,
+                )
+
+            return breaker
+
+    def get_states(self):
+        """
+        @return: {адрес шлюза: состояние}
+        """
+        with self._lock:
+            return {address: breaker.state for address, breaker in self._breakers.items()}
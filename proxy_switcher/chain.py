@@ -3,24 +3,27 @@
 import os
 import re
 import sys
-import gzip
+import io
 import time
 import json
-import socket
+import heapq
 import random
+import zlib
 import weakref
 import datetime
 import functools
+import itertools
 import threading
 import collections
-import urllib.error
 import urllib.parse
-import urllib.request
 import collections.abc
 
-import json_dict
+# gzip, socket, hashlib, urllib.request, json_dict импортируются при первом использовании -
+# импорт модуля должен оставаться быстрым для короткоживущих процессов (см. `profiling.measure_import`)
 
 from . import utils
+from . import tracing
+from . import profiling
 
 
 class ProxyURLRefreshError(Exception):
@@ -35,6 +38,98 @@ class NoFreeProxies(Exception):
     pass
 
 
+class CircuitOpenError(Exception):
+    """Шлюз или источник списка недоступен (см. `breaker.CircuitBreaker`)"""
+
+
+# `Proxies`, делящие список между процессами после fork (опция 'fork_workers')
+_fork_aware = weakref.WeakSet()
+# номер процесса -> конец канала, который дочерний процесс держит открытым до своего завершения
+_worker_slots = {}
+# (номер, канал) для процесса, создаваемого текущим fork
+_pending_slot = None
+# текущий процесс - дочерний, его собственные fork список не делят
+_is_worker = False
+
+
+def _get_free_slot():
+    """Наименьший номер, не занятый живым дочерним процессом
+
+    Номер завершившегося процесса (перезапущенного сервером) освобождается, когда закрывается его конец канала -
+    независимо от того, кто и когда вызовет для него `waitpid`.
+    """
+    for slot, fd in list(_worker_slots.items()):
+        try:
+            alive = os.read(fd, 1) != b''
+        except BlockingIOError:
+            alive = True
+
+        if not alive:
+            os.close(fd)
+            del _worker_slots[slot]
+
+    slot = 0
+    while slot in _worker_slots:
+        slot += 1
+    return slot
+
+
+def _before_fork():
+    global _pending_slot
+
+    if _is_worker or not _fork_aware:
+        return
+
+    slot = _get_free_slot()
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(read_fd, False)
+    _pending_slot = slot, read_fd, write_fd
+
+
+def _after_fork_in_parent():
+    global _pending_slot
+
+    if _pending_slot is not None:
+        slot, read_fd, write_fd = _pending_slot
+        _pending_slot = None
+
+        os.close(write_fd)
+        _worker_slots[slot] = read_fd
+
+
+def _after_fork_in_child():
+    global _pending_slot, _is_worker
+
+    if _pending_slot is None:
+        return
+
+    slot, read_fd, _ = _pending_slot
+    _pending_slot = None
+    _is_worker = True
+
+    # конец канала для записи остается открытым до завершения процесса
+    os.close(read_fd)
+    for fd in _worker_slots.values():
+        os.close(fd)
+    _worker_slots.clear()
+
+    for proxies in list(_fork_aware):
+        proxies._after_fork(slot)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(
+        before=_before_fork, after_in_parent=_after_fork_in_parent, after_in_child=_after_fork_in_child,
+    )
+
+
+def _get_worker_index(proxy, count):
+    import hashlib
+
+    # не crc32, как у шардов, иначе в процессе все прокси попадут в один шард
+    return int.from_bytes(hashlib.md5(proxy.encode()).digest()[:4], 'little') % count
+
+
 def _get_missing(target, source):
     """Возвращает присутствующие в `target`, но отсутствующие в `source` элементы
     """
@@ -45,7 +140,135 @@ def _get_missing(target, source):
     return old_target.difference(new_target)
 
 
+# запись `Proxies._usage` с потреблением всего пула (см. опцию 'pool_budget')
+_POOL_USAGE_KEY = '*'
+
+
+def _add_usage(usage, key, now, sent=0, received=0, requests=1, window=None):
+    """Увеличивает счетчики потребления
+
+    @param usage: {прокси: {'sent', 'received', 'requests' - всего,
+     'window_start', 'window_sent', 'window_received', 'window_requests' - в текущем окне бюджета}}
+    @param window (сек.): длина окна бюджета, None - считать только общие счетчики
+    @return: обновленная запись
+    """
+    entry = dict(usage.get(key) or {'sent': 0, 'received': 0, 'requests': 0})
+
+    entry['sent'] += sent
+    entry['received'] += received
+    entry['requests'] += requests
+
+    if window:
+        if entry.get('window_start') is None or now - entry['window_start'] >= window:
+            entry.update(window_start=now, window_sent=0, window_received=0, window_requests=0)
+
+        entry['window_sent'] += sent
+        entry['window_received'] += received
+        entry['window_requests'] += requests
+
+    # как и статистика - присваиванием, чтобы JsonDict сохранил изменения
+    usage[key] = entry
+    return entry
+
+
+def _get_budget_end(entry, budget, now):
+    """
+    @param budget: {'window': сек., 'bytes': ..., 'requests': ...}
+    @return: время окончания окна, если бюджет в нем исчерпан, иначе None
+    """
+    if not entry or entry.get('window_start') is None:
+        return None
+
+    end = entry['window_start'] + budget['window']
+    if now >= end:
+        return None
+
+    max_bytes = budget.get('bytes')
+    max_requests = budget.get('requests')
+    if (
+        (max_bytes is not None and entry['window_sent'] + entry['window_received'] >= max_bytes) or
+        (max_requests is not None and entry['window_requests'] >= max_requests)
+    ):
+        return end
+
+    return None
+
+
+def _parse_record(record):
+    """
+    @param record: {'address': ..., атрибут: значение}
+    @return: (адрес, атрибуты) или None, если адрес не указан
+    """
+    attributes = {k: v for k, v in record.items() if k is not None}
+    address = (attributes.pop('address', None) or '').strip()
+    if not address:
+        return None
+
+    scheme = re.match(r'^(?:(.*?)://)?', address).group(1)
+    if scheme:
+        attributes.setdefault('type', scheme)
+    elif attributes.get('type'):
+        address = '%s://%s' % (attributes['type'], address)  # `socks` format
+
+    return address, attributes
+
+
+def _iter_records(lines, fmt):
+    """Разбирает список прокси с атрибутами по мере чтения строк
+
+    @param lines: итератор строк (файл или ответ сервера)
+    @param fmt: 'jsonl' - объект json в каждой строке, 'csv' - строка заголовка и строки значений;
+     адрес прокси - атрибут 'address'
+    @return: итератор словарей {атрибут: значение} (см. `_split_records`)
+    """
+    if fmt == 'jsonl':
+        return (json.loads(line) for line in lines if line.strip())
+    elif fmt == 'csv':
+        import csv
+        return csv.DictReader(lines, skipinitialspace=True)
+    else:
+        raise RuntimeError("Неизвестный формат списка прокси: %r" % fmt)
+
+
+def _split_records(records):
+    """
+    @param records: адреса и/или словари с атрибутами (см. `_parse_record`)
+    @return: (список адресов, {адрес: атрибуты})
+    """
+    proxies = []
+    metadata = {}
+
+    for record in records:
+        if isinstance(record, dict):
+            parsed = _parse_record(record)
+            if parsed is None:
+                continue
+
+            record, attributes = parsed
+            metadata[record] = attributes
+
+        proxies.append(record)
+
+    return proxies, metadata
+
+
+def build_path(proxy, proxy_gw=None):
+    """Возвращает цепочку адресов до прокси-сервера (с учетом шлюза)
+    """
+
+    path = []
+
+    if proxy_gw:
+        path.append(proxy_gw)
+
+    path.append(proxy)
+
+    return path
+
+
 def _build_opener(proxy=None):
+    import urllib.request
+
     if proxy is not None:
         parsed = urllib.parse.urlparse(proxy)
         handler = urllib.request.ProxyHandler({parsed.scheme: proxy})
@@ -54,8 +277,80 @@ def _build_opener(proxy=None):
         return urllib.request.build_opener()
 
 
+class _DefaultOpener:
+    """`Proxies.default_opener`, создаваемый при первом обращении, а не при импорте модуля
+    """
+
+    def __get__(self, instance, owner):
+        opener = _build_opener()
+
+        # дальше - обычный атрибут класса (может быть переопределен)
+        for cls in owner.__mro__:
+            if cls.__dict__.get('default_opener') is self:
+                cls.default_opener = opener
+                break
+
+        return opener
+
+
+class _StateDict:
+    """Состояние пула (`json_dict`, опционально в файле), которое создается и читается с диска
+    при первом обращении, а не при создании `Proxies`
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, cls_name, option):
+        """
+        @param cls_name: класс из `json_dict`
+        @param option: опция с именем файла
+        """
+        self.cls_name = cls_name
+        self.option = option
+        self.attr = None
+
+    def __set_name__(self, owner, name):
+        self.attr = name + '_state'
+        self.cleanup = '_cleanup' + name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        state = instance.__dict__.get(self.attr)
+        if state is not None:
+            return state
+
+        filename = instance._options.get(self.option)
+
+        with self._lock:
+            state = instance.__dict__.get(self.attr)
+            if state is not None:
+                return state
+
+            import json_dict
+            state = instance.__dict__[self.attr] = utils.get_json_dict(
+                getattr(json_dict, self.cls_name), filename=filename,
+            )
+
+        if filename and instance._proxies is not None:
+            # сохраненное состояние могло остаться от прокси, которых уже нет в списке
+            with instance._cleanup_lock:
+                getattr(instance, self.cleanup)(set(instance._proxies))
+
+        return state
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.attr] = value
+
+
 class Proxies:
-    default_opener = _build_opener()
+    default_opener = _DefaultOpener()
+
+    _blacklist = _StateDict('JsonLastUpdatedOrderedDict', 'blacklist')
+    _cooling_down = _StateDict('JsonOrderedDict', 'cooldown')
+    _stats = _StateDict('JsonDict', 'stats')
+    _usage = _StateDict('JsonDict', 'usage')
 
     def __init__(
         self,
@@ -64,12 +359,17 @@ class Proxies:
         proxies_url_gateway=None,
         proxies_file=None,
         options=None,
+        clock=None,
+        profiler=None,
     ):
         """
         @param proxies: список адресов прокси-серверов
+         (или словарей с атрибутами прокси: {"address": ..., атрибут: значение}, см. `get_attributes`)
         @param proxies_url: ссылка на список прокси-серверов
         @param proxies_file: путь до файла со списком прокси-серверов
         @param options: доп. параметры
+        @param clock: источник времени (см. `utils.SystemClock`), подменяется при моделировании
+        @param profiler: `profiling.Profiler` для замера времени работы пула
         """
 
         if options is None:
@@ -77,8 +377,11 @@ class Proxies:
 
         shuffle = options.get('shuffle', False)
 
+        # прокси -> {атрибут: значение}
+        metadata = {}
+
         if proxies is not None:
-            proxies = list(proxies)
+            proxies, metadata = _split_records(proxies)
             if shuffle:
                 random.shuffle(proxies)
 
@@ -86,45 +389,75 @@ class Proxies:
         if auto_refresh_period:
             auto_refresh_period = datetime.timedelta(**auto_refresh_period)
 
-        blacklist = utils.get_json_dict(json_dict.JsonLastUpdatedOrderedDict, filename=options.get('blacklist'))
-        cooling_down = utils.get_json_dict(json_dict.JsonOrderedDict, filename=options.get('cooldown'))
-        stats = utils.get_json_dict(json_dict.JsonDict, filename=options.get('stats'))
-
-        if proxies_url_gateway:
-            url_opener = _build_opener(proxies_url_gateway)
-        else:
-            url_opener = None
-
-        self._url_opener = url_opener
+        # opener для шлюза создается при первой загрузке списка
+        self._url_gateway = proxies_url_gateway
+        self._url_opener = None
+        self._clock = clock or utils.SystemClock()
+        self._profiler = profiler
 
         self._proxies = proxies
+        self._metadata = metadata
         self.proxies_url = proxies_url
         self.proxies_file = proxies_file
+        self.format = options.get('format')
 
         self._shuffle = shuffle
         self.slice = options.get('slice')
         self.force_type = options.get('type')
         self.auto_refresh_period = auto_refresh_period
 
-        self._blacklist = blacklist
-        self._cooling_down = cooling_down
-        self._stats = stats
         self._cleanup_lock = threading.RLock()
 
         self._last_auto_refresh = None
         self._auto_refresh_lock = threading.Lock()
 
         self._load_lock = threading.Lock()
-        self._modified_at = time.perf_counter()
+        self._modified_at = self._clock.perf_counter()
 
         self.__pool = None
         self._smart_holdout_start = options.get('smart_holdout_start')
 
         self._options = options
+        self._validation = options.get('validation')
+        # последний загруженный из источника список (до карантина): (прокси, атрибуты)
+        self._quarantine_source = None
+        # прокси, проверяемые в фоне
+        self._quarantined = set()
+        # не прошедшие проверку: {прокси: время повторной проверки}
+        self._quarantine_failed = {}
+
+        self._snapshot_file = options.get('snapshot')
+        # ETag/Last-Modified ссылки или mtime файла, из которого загружен текущий список
+        self._source_version = None
+
+        # (номер процесса, кол-во процессов) - используется только часть списка (см. `set_worker`)
+        self._worker = None
+        self._worker_proxies = None
+
+        self._fork_workers = options.get('fork_workers')
+        # увеличивается после fork - цепочки, созданные до него, перепривязываются к новому пулу (см. `Chain`)
+        self._fork_generation = 0
+        if self._fork_workers:
+            _fork_aware.add(self)
+
+        self._source_breaker = None
+        source_breaker = options.get('source_breaker')
+        if source_breaker:
+            from . import breaker
+            self._source_breaker = breaker.CircuitBreaker(
+                clock=self._clock, **(source_breaker if isinstance(source_breaker, dict) else {})
+            )
+
+        self._dns_cache = None
+        dns_cache = options.get('dns_cache')
+        if dns_cache:
+            from . import resolver
+            self._dns_cache = resolver.DNSCache(
+                clock=self._clock, **(dns_cache if isinstance(dns_cache, dict) else {})
+            )
 
-        if self._proxies is not None:
-            proxies = set(self._proxies)
-            self._cleanup_internals(proxies)
+        # состояние из файлов (blacklist, cooldown, stats, usage) читается и очищается при первом обращении,
+        # см. `_StateDict`
 
     @property
     def proxies(self):
@@ -132,43 +465,336 @@ class Proxies:
             with self._load_lock:
                 # Вышли из состояния гонки, теперь можно удостовериться в реальной необходимости
                 if self._proxies is None:
-                    self._proxies = self._load()
-                    self._cleanup_internals(self._proxies)
-                    self._modified_at = time.perf_counter()
+                    if self._snapshot_file and self._load_snapshot():
+                        # список уже доступен, актуальность источника проверяем в фоне
+                        threading.Thread(target=self._refresh, args=(self._source_version,), daemon=True).start()
+                    else:
+                        with self._phase('refresh.load'):
+                            proxies, metadata = self._load()
+
+                        self._set_proxies(proxies, metadata)
+
+                        with self._phase('refresh.cleanup'):
+                            self._cleanup_internals(self._proxies)
+
+                        self.save_snapshot()
+
+                    self._prefetch_dns()
+                    self._modified_at = self._clock.perf_counter()
+
+        if self._worker is not None:
+            return self._get_worker_proxies()
 
         return self._proxies
 
-    def _load(self):
+    def get_attributes(self, proxy):
+        """Атрибуты прокси из списка с метаданными (опция 'format' или словари в `proxies`)
+
+        @return: {атрибут: значение}, пустой словарь - атрибуты не указаны
+        """
+        return self._metadata.get(proxy) or {}
+
+    def _get_worker_proxies(self):
+        proxies = self._proxies
+        cached = self._worker_proxies
+
+        if cached is None or cached[0] is not proxies:
+            index, count = self._worker
+            part = [p for p in proxies if _get_worker_index(p, count) == index]
+
+            if not part and proxies:
+                # прокси меньше, чем процессов - без пересечений не обойтись
+                part = [proxies[index % len(proxies)]]
+
+            cached = self._worker_proxies = (proxies, part)
+
+        return cached[1]
+
+    def set_worker(self, index, count):
+        """Ограничивает список частью, не пересекающейся с частями других процессов
+
+        Вызывается автоматически в дочернем процессе (опция 'fork_workers'),
+        вручную - если сервер сам нумерует процессы или меняет их кол-во (перебалансировка).
+
+        @param index: номер процесса (0 .. count - 1)
+        @param count: кол-во процессов, None - использовать весь список
+        """
+        self._worker = (index % count, count) if count else None
+        self._worker_proxies = None
+        # пул перечитает список (см. `_Pool._is_proxies_changed`)
+        self._modified_at = self._clock.perf_counter()
+
+    def _after_fork(self, fork_index):
+        # локи могли быть захвачены другими потоками родителя в момент fork,
+        # пул (очереди и локи) создается заново
+        self._cleanup_lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._auto_refresh_lock = threading.Lock()
+        self.__pool = None
+        self._fork_generation += 1
+        # фоновые проверки остались в родителе
+        self._quarantined = set()
+
+        self.set_worker(fork_index, self._fork_workers)
+        index = self._worker[0]
+
+        # у каждого процесса свои файлы состояния, начальное состояние - унаследованное от родителя
+        for attr, option in (
+            ('_blacklist', 'blacklist'), ('_cooling_down', 'cooldown'), ('_stats', 'stats'), ('_usage', 'usage'),
+        ):
+            filename = self._options.get(option)
+            if filename:
+                inherited = getattr(self, attr)
+                state = utils.get_json_dict(type(inherited), filename='%s.%s' % (filename, index))
+                if not state:
+                    state.update(inherited)
+                setattr(self, attr, state)
+
+        # снимок сохраняет только родительский процесс
+        self._snapshot_file = None
+
+    def _load(self, source_version=None):
+        """
+        @param source_version: версия источника, если он не изменился - возвращается None
+        @return: (список адресов, {адрес: атрибуты})
+        """
         if self.proxies_url:
-            proxies = self.read_url(self.proxies_url, opener=self._url_opener)
+            loaded = self._read_source_url(source_version)
         elif self.proxies_file:
-            proxies = self.read_file(self.proxies_file)
+            loaded = self._read_source_file(source_version)
         else:
             raise NotImplementedError(
                 "Can't load proxies: "
                 "please specify one of the sources ('proxies_url' or 'proxies_file')"
             )
 
+        if loaded is None:
+            return None
+
+        proxies, metadata = loaded
+
         if self.slice:
             proxies = proxies[slice(*self.slice)]
 
         if self.force_type:
             new_type = self.force_type + '://'  # `socks` format
-            proxies = [
+            typed = [
                 re.sub(r'^(?:(.*?)://)?', new_type, proxy)
                 for proxy in proxies
             ]
 
+            if metadata:
+                metadata = {
+                    new: dict(metadata[old], type=self.force_type)
+                    for old, new in zip(proxies, typed)
+                    if old in metadata
+                }
+
+            proxies = typed
+
         if self._shuffle:
             random.shuffle(proxies)
 
-        return proxies
+        return proxies, metadata
+
+    def _read_source_url(self, source_version=None):
+        headers = {}
+        if source_version:
+            if source_version.get('etag'):
+                headers['If-None-Match'] = source_version['etag']
+            if source_version.get('last_modified'):
+                headers['If-Modified-Since'] = source_version['last_modified']
+
+        import urllib.error
+
+        if self._url_opener is None and self._url_gateway:
+            self._url_opener = _build_opener(self._url_gateway)
+
+        try:
+            resp = self._open_url(
+                self.proxies_url, opener=self._url_opener, headers=headers, breaker=self._source_breaker,
+            )
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+
+        if self.format:
+            loaded = _split_records(self._read_resp_records(resp, self.format))
+        else:
+            loaded = self._read_resp(resp), {}
+
+        self._source_version = {
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+        }
+        return loaded
+
+    def _read_source_file(self, source_version=None):
+        mtime = os.stat(self.proxies_file).st_mtime
+        if source_version and source_version.get('mtime') == mtime:
+            return None
+
+        if self.format:
+            with open(self.proxies_file, newline='') as f:
+                loaded = _split_records(_iter_records(f, self.format))
+        else:
+            loaded = self.read_file(self.proxies_file), {}
+
+        self._source_version = {'mtime': mtime}
+        return loaded
+
+    def _get_snapshot_source(self):
+        return [self.proxies_url or self.proxies_file, self.slice, self.force_type, self.format]
+
+    def _get_snapshot_state_dicts(self):
+        # состояние, хранящееся в собственных файлах, в снимок не попадает
+        return {
+            name: state
+            for name, state in (
+                ('cooldown', self._cooling_down), ('blacklist', self._blacklist), ('stats', self._stats),
+                ('usage', self._usage),
+            )
+            if not self._options.get(name)
+        }
+
+    def _load_snapshot(self):
+        from . import snapshot
+
+        snap = snapshot.load(self._snapshot_file)
+        if snap is None or snap.source != self._get_snapshot_source():
+            return False
+
+        with self._cleanup_lock:
+            for name, state in self._get_snapshot_state_dicts().items():
+                state.update(snap.state.get(name) or {})
+
+        self._metadata = snap.metadata
+        self._proxies = snap.proxies
+        self._source_version = snap.source_version
+        self._cleanup_internals(self._proxies)
+
+        # источник перепроверяется в фоне, автообновление при первом обращении не требуется
+        if self.proxies_file and snap.source_version:
+            self._last_auto_refresh = datetime.datetime.fromtimestamp(snap.source_version['mtime'])
+        elif self.proxies_url:
+            self._last_auto_refresh = datetime.datetime.fromtimestamp(self._clock.time())
+
+        return True
+
+    def save_snapshot(self):
+        """Сохраняет текущий список и состояние пула в файл снимка (опция 'snapshot')
+
+        Снимок также сохраняется автоматически при каждой загрузке списка из источника.
+        """
+        from . import snapshot
+
+        if not self._snapshot_file or self._proxies is None:
+            return
+
+        with self._cleanup_lock:
+            state = {name: dict(state) for name, state in self._get_snapshot_state_dicts().items()}
+
+        try:
+            snapshot.save(
+                self._snapshot_file, self._get_snapshot_source(), self._source_version, self._proxies, state,
+                metadata=self._metadata,
+            )
+        except OSError:
+            import problems
+            problems.error()
+
+    def _set_proxies(self, proxies, metadata):
+        with self._cleanup_lock:
+            if self._validation:
+                proxies = self._pass_quarantine(proxies, metadata)
+
+            if metadata:
+                metadata = {proxy: metadata[proxy] for proxy in proxies if proxy in metadata}
+
+            self._metadata = metadata
+            self._proxies = proxies
+
+    def _pass_quarantine(self, proxies, metadata):
+        """Возвращает список без новых прокси, еще не прошедших проверку
+
+        Новыми считаются прокси, которых нет ни в текущем списке, ни в статистике.
+        При первой загрузке (текущего списка еще нет) новые прокси проверяются сразу,
+        иначе - в фоне (см. `_validate`), а прошедшие проверку добавляются в список по ее завершении.
+        Не прошедшие проверку повторно проверяются не раньше, чем через `retry_after` сек.
+        """
+        now = self._clock.time()
+        source = set(proxies)
+
+        for proxy, retry_at in list(self._quarantine_failed.items()):
+            if now >= retry_at or proxy not in source:
+                del self._quarantine_failed[proxy]
+
+        known = set(self._proxies or ())
+        known.update(self._stats)
+
+        quarantine = [
+            p for p in proxies
+            if p not in known and p not in self._quarantined and p not in self._quarantine_failed
+        ]
+
+        if quarantine:
+            if self._proxies is None:
+                self._validate(quarantine)
+                known.update(self._stats)
+            else:
+                self._quarantined.update(quarantine)
+                threading.Thread(target=self._validate, args=(quarantine, True), daemon=True).start()
+
+        self._quarantine_source = proxies, metadata
+        return [p for p in proxies if p in known]
+
+    def _validate(self, quarantine, merge=False):
+        """Проверяет прокси из карантина, результат и время ответа сохраняются в статистику
+
+        @param merge: добавить прошедшие проверку в текущий список
+        """
+        from . import health
+
+        try:
+            results = list(health.probe_many(
+                quarantine,
+                self._validation['url'],
+                proxy_gw=self._validation.get('gateway'),
+                timeout=self._validation.get('timeout', 5),
+                max_workers=self._validation.get('max_workers', 10),
+            ))
+        finally:
+            with self._cleanup_lock:
+                self._quarantined.difference_update(quarantine)
+
+        retry_at = self._clock.time() + self._validation.get('retry_after', 600)
+        passed = False
+
+        with self._cleanup_lock:
+            for proxy, latency in results:
+                if latency is None:
+                    self._quarantine_failed[proxy] = retry_at
+                else:
+                    self._stats[proxy] = {'uptime': (1, 0), 'last_holdout': None, 'latency': latency}
+                    passed = True
+
+            if not merge or not passed:
+                return
+
+            self._set_proxies(*self._quarantine_source)
+            self._cleanup_internals(self._proxies)
+            self._modified_at = self._clock.perf_counter()
+
+        self.save_snapshot()
+        self._prefetch_dns()
 
     def _cleanup_internals(self, proxies):
         with self._cleanup_lock:
             self._cleanup_blacklist(proxies)
             self._cleanup_cooling_down(proxies)
             self._cleanup_stats(proxies)
+            self._cleanup_usage(proxies)
 
     def _cleanup_cooling_down(self, proxies):
         for proxy in _get_missing(self._cooling_down, proxies):
@@ -182,6 +808,36 @@ class Proxies:
         for proxy in _get_missing(self._stats, proxies):
             self._stats.pop(proxy)
 
+    def _cleanup_usage(self, proxies):
+        for proxy in _get_missing(self._usage, proxies):
+            if proxy != _POOL_USAGE_KEY:
+                self._usage.pop(proxy)
+
+    def record_usage(self, proxy, sent=0, received=0, requests=1):
+        """Учитывает трафик (байт отправлено/получено) и кол-во запросов через прокси
+
+        Для пула используйте `_Pool.record_usage` - он также проверяет бюджеты (опции 'budget', 'pool_budget').
+        """
+        window = (self._options.get('budget') or {}).get('window')
+
+        with self._cleanup_lock:
+            _add_usage(self._usage, proxy, self._clock.time(), sent, received, requests, window)
+
+    def get_usage(self, proxy=None):
+        """
+        @return: потребление прокси (см. `_add_usage`) или {прокси: потребление} для всех прокси
+         (потребление всего пула - под ключом '*')
+        """
+        with self._cleanup_lock:
+            if proxy is not None:
+                return dict(self._usage.get(proxy) or {})
+            return {key: dict(entry) for key, entry in self._usage.items()}
+
+    def _phase(self, name):
+        if self._profiler is None:
+            return profiling.NULL_PHASE
+        return self._profiler.phase(name)
+
     def _get_options(self, *options, missing_ok=True):
         if missing_ok:
             return {k: self._options.get(k) for k in options}
@@ -194,23 +850,57 @@ class Proxies:
 
     @classmethod
     def read_url(cls, url, sep='\n', retry=10, sleep_range=(2, 10), timeout=2, opener=None):
+        resp = cls._open_url(url, retry=retry, sleep_range=sleep_range, timeout=timeout, opener=opener)
+        return cls._read_resp(resp, sep=sep)
+
+    @classmethod
+    def _open_url(cls, url, retry=10, sleep_range=(2, 10), timeout=2, opener=None, headers=None, breaker=None):
+        """
+        @param breaker: `breaker.CircuitBreaker` источника - после размыкания повторы прекращаются,
+         а новые обращения сразу завершаются `CircuitOpenError`
+        """
+        import socket
+        import urllib.error
+        import urllib.request
+
         if opener is None:
             opener = cls.default_opener
 
+        request = urllib.request.Request(url, headers=headers or {})
+
         while True:
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError(url)
+
             try:
-                resp = opener.open(url, timeout=timeout)
-                break
-            except (urllib.error.HTTPError, socket.timeout):
-                if not retry:
+                resp = opener.open(request, timeout=timeout)
+            except (urllib.error.URLError, socket.timeout) as e:
+                # 304 - ответ на условный запрос, а не ошибка
+                if getattr(e, 'code', None) == 304:
+                    if breaker is not None:
+                        breaker.record_success()
+                    raise
+
+                if breaker is not None:
+                    breaker.record_failure()
+
+                retryable = isinstance(e, (urllib.error.HTTPError, socket.timeout))
+                if not retry or not retryable or (breaker is not None and breaker.is_open):
                     raise
 
                 retry -= 1
                 time.sleep(random.randint(*sleep_range))
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return resp
 
+    @classmethod
+    def _read_resp(cls, resp, sep='\n'):
         content = resp.read()
 
         if resp.headers.get('Content-Encoding', 'identity') == 'gzip':
+            import gzip
             content = gzip.decompress(content)
 
         charset = resp.headers.get_content_charset('utf-8')
@@ -218,23 +908,65 @@ class Proxies:
 
         return cls.read_string(content, sep=sep)
 
+    @classmethod
+    def _read_resp_records(cls, resp, fmt):
+        stream = resp
+        if resp.headers.get('Content-Encoding', 'identity') == 'gzip':
+            import gzip
+            stream = gzip.GzipFile(fileobj=resp)
+
+        charset = resp.headers.get_content_charset('utf-8')
+        return _iter_records(io.TextIOWrapper(stream, encoding=charset, newline=''), fmt)
+
     @classmethod
     def read_file(cls, file_name, sep='\n'):
         with open(file_name) as f:
             return cls.read_string(f.read(), sep=sep)
 
     def refresh(self):
+        self._refresh()
+
+    def _refresh(self, source_version=None):
+        """
+        @param source_version: не обновлять список, если источник не изменился с указанной версии
+        """
         if not self.proxies_url and not self.proxies_file:
             return
 
+        import urllib.error
+
         try:
-            self._proxies = self._load()
-            self._cleanup_internals(self._proxies)
+            with self._phase('refresh.load'):
+                loaded = self._load(source_version)
+
+            if loaded is None:
+                return
+
+            self._set_proxies(*loaded)
+
+            with self._phase('refresh.cleanup'):
+                self._cleanup_internals(self._proxies)
         except urllib.error.HTTPError:
             import problems
             problems.handle(ProxyURLRefreshError, extra={'url': self.proxies_url})
+        except CircuitOpenError:
+            # источник недоступен - продолжаем использовать текущий список
+            pass
         else:
-            self._modified_at = time.perf_counter()
+            self._modified_at = self._clock.perf_counter()
+            self.save_snapshot()
+            self._prefetch_dns()
+
+    def _prefetch_dns(self):
+        if self._dns_cache is not None:
+            self._dns_cache.prefetch(self._proxies)
+
+    def resolve_address(self, address):
+        """Адрес с разрешенным через кэш именем хоста (опция 'dns_cache')
+        """
+        if self._dns_cache is None:
+            return address
+        return self._dns_cache.resolve_address(address)
 
     def _auto_refresh(self):
         if self.proxies_file:
@@ -251,7 +983,7 @@ class Proxies:
                 return
 
             with self._auto_refresh_lock:
-                now = datetime.datetime.now()
+                now = datetime.datetime.fromtimestamp(self._clock.time())
 
                 if self._last_auto_refresh is not None:
                     if now - self._last_auto_refresh < self.auto_refresh_period:
@@ -269,17 +1001,35 @@ class Proxies:
             with self._cleanup_lock:  # оптимизация: используем уже существующий лок
                 # Вышли из состояния гонки, теперь можно удостовериться в реальной необходимости
                 if self.__pool is None:
-                    options = self._get_options('default_holdout', 'default_bad_holdout', 'force_defaults')
+                    options = self._get_options(
+                        'default_holdout', 'default_bad_holdout', 'force_defaults',
+                        'max_targets', 'target_idle_ttl', 'max_leases', 'max_leases_per_proxy',
+                        'rate_limit', 'rate_burst', 'rate_limit_per_target',
+                        'priorities', 'priority_mode', 'default_priority', 'max_waiters',
+                        'affinity_replicas', 'budget', 'pool_budget',
+                    )
 
                     if self._smart_holdout_start is not None:
                         options['smart_holdout'] = True
                         options['smart_holdout_start'] = self._smart_holdout_start
                         options.update(self._get_options('smart_holdout_min', 'smart_holdout_max'))
 
-                    self.__pool = _Pool(
-                        self, self._cooling_down, self._blacklist, self._stats, self._cleanup_lock,
-                        **options
-                    )
+                    shards = self._options.get('shards')
+                    if shards and shards > 1:
+                        if options['priorities'] or options['max_waiters'] or options['pool_budget']:
+                            raise RuntimeError(
+                                "Опции 'priorities', 'max_waiters' и 'pool_budget' не поддерживаются вместе с 'shards'"
+                            )
+
+                        self.__pool = _ShardedPool(
+                            self, shards, self._cooling_down, self._blacklist, self._stats, self._cleanup_lock,
+                            **options
+                        )
+                    else:
+                        self.__pool = _Pool(
+                            self, self._cooling_down, self._blacklist, self._stats, self._cleanup_lock,
+                            **options
+                        )
 
         return self.__pool
 
@@ -293,6 +1043,10 @@ class Proxies:
             type ('socks5', 'http'; для полного списка типов см. модуль socks):
             все прокси будут автоматически промаркированы этип типом
 
+            format ('jsonl', 'csv'):
+            список с атрибутами прокси - объект json в каждой строке или csv со строкой заголовка,
+            адрес - атрибут 'address' (см. `get_attributes`, `_Pool.acquire(where=...)`)
+
             slice (tuple c аргументами для builtins.slice):
             будет взят только указанный фрагмент списка прокси-серверов
 
@@ -302,6 +1056,30 @@ class Proxies:
             url_gateway:
             адрес proxy, через которые будет загружаться список прокси по url
 
+            source_breaker (dict или true): {"failure_threshold": 5, "recovery_timeout": 30}
+            после указанного кол-ва ошибок подряд источник (`url`) не запрашивается `recovery_timeout` сек.
+            (обновление списка пропускается, первая загрузка завершается `CircuitOpenError`)
+
+            dns_cache (dict или true): {"ttl": 300, "negative_ttl": 30, "refresh_ahead": 0.8}
+            кэш разрешения имен прокси и шлюза - в цепочку попадают ip-адреса (см. `resolver.DNSCache`)
+
+            fork_workers:
+            кол-во процессов pre-fork сервера - после fork каждый дочерний процесс использует
+            свою часть списка и свои файлы состояния (blacklist, cooldown, stats с суффиксом номера процесса),
+            см. `Proxies.set_worker`; номер завершившегося процесса получает следующий созданный вместо него
+
+            snapshot:
+            файл снимка списка и состояния пула - при старте список берется из него,
+            а источник (с учетом ETag/Last-Modified или mtime) перепроверяется в фоне (только для `url` и `file`)
+
+            validation (dict): {"url": ..., "gateway": ..., "timeout": 5, "max_workers": 10, "retry_after": 600}
+            новые прокси попадают в список только после успешного запроса на `url` через `gateway`
+            (только для `url` и `file`); при обновлении списка проверка идет в фоне,
+            не прошедшие ее прокси перепроверяются не раньше, чем через `retry_after` сек.
+
+            usage:
+            файл учета трафика и запросов через прокси (см. `get_usage`, опции пула 'budget', 'pool_budget')
+
             (url, file, list) - может быть именем файла, ссылкой или списком в формате json
 
             Параметры slice и force_type являются необязательными
@@ -310,9 +1088,13 @@ class Proxies:
             option = {"list": ["127.0.0.1:3128"]}
             option = {"list": ["127.0.0.1:3128", "127.0.0.1:9999"]}
             option = {"file": "./my_new_proxies.txt", "type": "socks5"}
+            option = {"file": "./my_new_proxies.jsonl", "format": "jsonl"}
+            option = {"list": [{"address": "127.0.0.1:3128", "country": "de"}]}
             option = {"url": "http://example.com/get/proxy_list/", "slice": [35, null], "type": "http"}
             option = {"url": "http://example.com/get/proxy_list/", "auto_refresh_period": {"days": 1}}
             option = {"url": "http://example.com/get/proxy_list/", "url_gateway": "http://proxy.example.com:9999"}
+            option = {"url": "http://example.com/get/proxy_list/", "validation": {"url": "http://myip.ru"}}
+            option = {"url": "http://example.com/get/proxy_list/", "snapshot": "./proxies.snapshot"}
         """
 
         cfg = json.loads(cfg_string)
@@ -331,12 +1113,191 @@ class Proxies:
         )
 
 
-class _Pool:
-    def __init__(
-            self, proxies: "`Proxies` instance", cooling_down, blacklist, stats, _cleanup_lock=None,
-            smart_holdout=False, smart_holdout_start=None, smart_holdout_min=None, smart_holdout_max=None,
+class _TargetState:
+    """Охлаждение, черный список и статистика прокси для конкретного ресурса (хоста)
+    """
+
+    __slots__ = ('cooling_down', 'blacklist', 'stats', 'buckets', 'last_used')
+
+    def __init__(self):
+        self.cooling_down = {}
+        self.blacklist = {}
+        self.stats = {}
+        self.buckets = {}
+        self.last_used = None
+
+    def cool_released(self, now):
+        cooled = [proxy for proxy, holdout in self.cooling_down.items() if now >= holdout]
+        for proxy in cooled:
+            self.cooling_down.pop(proxy)
+
+    def remove_outdated(self, full_list):
+        for storage in (self.cooling_down, self.blacklist, self.stats, self.buckets):
+            for proxy in _get_missing(storage, full_list):
+                storage.pop(proxy)
+
+
+class _FreeQueue:
+    """Очередь свободных прокси
+
+    В отличие от `collections.deque`, проверка наличия и изъятие прокси из середины очереди - O(1),
+    а повторное добавление прокси, уже стоящего в очереди, ничего не меняет.
+    """
+
+    def __init__(self, proxies=()):
+        self._queue = collections.OrderedDict.fromkeys(proxies)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def __contains__(self, proxy):
+        return proxy in self._queue
+
+    def append(self, proxy):
+        if proxy not in self._queue:
+            self._queue[proxy] = None
+            self._add(proxy)
+
+    def extend(self, proxies):
+        for proxy in proxies:
+            self.append(proxy)
+
+    def popleft(self):
+        proxy, _ = self._queue.popitem(last=False)
+        self._discard(proxy)
+        return proxy
+
+    def remove(self, proxy):
+        try:
+            del self._queue[proxy]
+        except KeyError:
+            raise ValueError(proxy)
+
+        self._discard(proxy)
+
+    def clear(self):
+        self._queue.clear()
+
+    def _add(self, proxy):
+        pass
+
+    def _discard(self, proxy):
+        pass
+
+
+class _IndexedFree(_FreeQueue):
+    """Очередь свободных прокси с инвертированными индексами по атрибутам (см. `_Pool.acquire(where=...)`)
+
+    Заменяет `_FreeQueue` в пуле, если у прокси есть атрибуты: прокси, найденный по индексу,
+    изымается из середины очереди без ее просмотра.
+    Для каждой пары (атрибут, значение) и для запросов из нескольких атрибутов (до `max_queries`
+    различных) свободные прокси хранятся в порядке очереди.
+    Индексируются только простые значения (строки, числа, bool, null).
+    """
+
+    max_queries = 64
+
+    def __init__(self, proxies, metadata):
+        super().__init__()
+        self._metadata = metadata
+        # (атрибут, значение) -> {прокси: None} (упорядоченное множество)
+        self._index = collections.defaultdict(dict)
+        # frozenset((атрибут, значение), ...) -> {прокси: None}
+        self._queries = {}
+
+        self.extend(proxies)
+
+    def _get_keys(self, proxy):
+        return [
+            (attr, value) for attr, value in (self._metadata.get(proxy) or {}).items()
+            if value is None or isinstance(value, (str, int, float))
+        ]
+
+    def _matches(self, proxy, query):
+        attributes = self._metadata.get(proxy) or {}
+        return all(attributes.get(attr) == value for attr, value in query)
+
+    def _add(self, proxy):
+        for key in self._get_keys(proxy):
+            self._index[key][proxy] = None
+
+        for query, proxies in self._queries.items():
+            if self._matches(proxy, query):
+                proxies[proxy] = None
+
+    def _discard(self, proxy):
+        for key in self._get_keys(proxy):
+            proxies = self._index.get(key)
+            if proxies is not None:
+                proxies.pop(proxy, None)
+                if not proxies:
+                    del self._index[key]
+
+        for proxies in self._queries.values():
+            proxies.pop(proxy, None)
+
+    def clear(self):
+        super().clear()
+        self._index.clear()
+        for proxies in self._queries.values():
+            proxies.clear()
+
+    def iter_matching(self, where):
+        """Свободные прокси с указанными атрибутами в порядке очереди
+
+        Очередь нельзя изменять, пока итерация не завершена.
+        """
+        if len(where) == 1:
+            return iter(self._index.get(next(iter(where.items()))) or ())
+
+        query = frozenset(where.items())
+
+        proxies = self._queries.get(query)
+        if proxies is None:
+            smallest = min((self._index.get(key) or {} for key in query), key=len)
+            matching = (proxy for proxy in smallest if self._matches(proxy, query))
+
+            if len(self._queries) >= self.max_queries:
+                return matching
+
+            # повторяющийся запрос - ведем для него отдельный индекс
+            proxies = self._queries[query] = dict.fromkeys(matching)
+
+        return iter(proxies)
+
+
+class _Pool:
+    def __init__(
+            self, proxies: "`Proxies` instance", cooling_down, blacklist, stats, _cleanup_lock=None,
+            smart_holdout=False, smart_holdout_start=None, smart_holdout_min=None, smart_holdout_max=None,
             default_holdout=None, default_bad_holdout=None, force_defaults=False,
+            max_targets=None, target_idle_ttl=None, max_leases=None, max_leases_per_proxy=None,
+            rate_limit=None, rate_burst=None, rate_limit_per_target=False,
+            priorities=None, priority_mode=None, default_priority=None, max_waiters=None,
+            affinity_replicas=None, budget=None, pool_budget=None,
     ):
+        """
+        @param max_targets: сколько ресурсов (хостов) хранить для `acquire(target=...)`,
+         при превышении забываются давно не использованные
+        @param target_idle_ttl (сек.): забывать ресурс, если он не использовался указанное время
+        @param max_leases: сколько раз один прокси может быть выдан одновременно (по умолчанию 1)
+        @param max_leases_per_proxy: то же, для отдельных прокси ({прокси: кол-во})
+        @param rate_limit: максимальное кол-во выдач прокси в секунду (token bucket)
+        @param rate_burst: сколько выдач подряд допускается без ожидания (по умолчанию 1)
+        @param rate_limit_per_target: ограничивать частоту отдельно для каждого ресурса (см. `acquire`)
+        @param priorities: классы приоритета и их веса ({класс: вес}, см. `acquire`)
+        @param priority_mode: 'strict' - класс ждет, пока ждут классы с большим весом,
+         'weighted' - классы получают прокси пропорционально весам
+        @param default_priority: класс для `acquire` без `priority` (по умолчанию - класс с наименьшим весом)
+        @param max_waiters: максимальное кол-во ожидающих потоков, при превышении сразу бросается `NoFreeProxies`
+        @param affinity_replicas: кол-во точек на кольце для каждого прокси при закреплении ключей (см. `acquire`)
+        @param budget: бюджет прокси {'window': сек., 'bytes': ..., 'requests': ...} - прокси, исчерпавший
+         бюджет (см. `record_usage`), не выдается до окончания окна
+        @param pool_budget: то же для всего пула - при исчерпании прокси не выдаются до окончания окна
+        """
         if smart_holdout:
             if smart_holdout_start in (None, 0):
                 raise RuntimeError("Вы должны указать начальное время охлаждения")
@@ -344,18 +1305,47 @@ class _Pool:
             if smart_holdout_max is None:
                 smart_holdout_max = float('inf')
 
+        if priority_mode not in (None, 'strict', 'weighted'):
+            raise RuntimeError("Неизвестный режим приоритетов: %r" % priority_mode)
+
+        if _cleanup_lock is None:
+            _cleanup_lock = threading.RLock()
+
         self._used = set()
         self._cond = threading.Condition(lock=_cleanup_lock)
 
-        self._free = collections.deque(
+        # прокси из `_used` -> кол-во одновременных выдач
+        self._leases = {}
+        # (кол-во выдач, N, прокси) для используемых прокси, которые могут быть выданы еще раз;
+        # устаревшие записи не удаляются, а пропускаются при извлечении
+        self._loaded = []
+        self._loaded_seq = itertools.count()
+        self._max_leases = max_leases or 1
+        self._max_leases_per_proxy = max_leases_per_proxy or {}
+
+        self._rate_limit = rate_limit
+        self._rate_burst = rate_burst or 1
+        self._rate_limit_per_target = rate_limit_per_target
+        # прокси -> (кол-во токенов, время обновления)
+        self._buckets = {}
+        # прокси, исчерпавшие токены -> время появления следующего токена
+        self._paced_until = {}
+        # (время появления токена, прокси); устаревшие записи пропускаются
+        self._paced = []
+
+        free = [
             p for p in proxies.proxies
             if (
                 p not in blacklist and
                 p not in cooling_down
             )
-        )
+        ]
+        # индексы по атрибутам нужны, только если они есть в списке (см. `acquire(where=...)`)
+        self._free = _IndexedFree(free, proxies._metadata) if proxies._metadata else _FreeQueue(free)
 
         self._proxies = proxies
+        self._clock = proxies._clock
+        self._profiler = proxies._profiler
         self._cooling_down = cooling_down
         self._blacklist = blacklist
         self._stats = stats
@@ -369,6 +1359,53 @@ class _Pool:
         self._default_bad_holdout = default_bad_holdout
         self._force_defaults = force_defaults
 
+        self._targets = collections.OrderedDict()
+        self._max_targets = max_targets or 1000
+        self._target_idle_ttl = target_idle_ttl
+
+        # события ожидающих сразу несколько пулов (см. `MultiChain`)
+        self._listeners = set()
+
+        self._priorities = priorities or None
+        self._priority_mode = priority_mode or 'strict'
+        self._max_waiters = max_waiters
+
+        if self._priorities:
+            # от большего веса к меньшему
+            self._priority_order = sorted(priorities, key=priorities.get, reverse=True)
+            self._default_priority = default_priority if default_priority is not None else self._priority_order[-1]
+            # у каждого класса свое условие ожидания - будится только класс, чья очередь
+            self._priority_conds = {
+                priority: threading.Condition(lock=_cleanup_lock) for priority in self._priority_order
+            }
+        else:
+            self._priority_order = [None]
+            self._default_priority = None
+            self._priority_conds = {None: self._cond}
+
+        # класс -> кол-во ожидающих потоков
+        self._waiting = collections.Counter()
+        # класс -> "пройденный путь" для режима 'weighted' (stride scheduling)
+        self._passes = dict.fromkeys(self._priority_order, 0.0)
+        self._virtual_time = 0.0
+        # класс -> [получено, отклонено, таймаутов, суммарное ожидание, максимальное ожидание]
+        self._wait_stats = {}
+
+        # `affinity.HashRing` для `acquire(key=...)`, создается при первом использовании
+        self._ring = None
+        self._affinity_replicas = affinity_replicas or 16
+        # кол-во ожидающих конкретный прокси (`key`) или прокси с атрибутами (`where`)
+        self._selective_waiting = 0
+
+        self._budget = budget
+        self._pool_budget = pool_budget
+        # время окончания окна исчерпанного бюджета пула
+        self._paused_until = None
+        if pool_budget:
+            self._paused_until = _get_budget_end(
+                proxies._usage.get(_POOL_USAGE_KEY), pool_budget, self._clock.time(),
+            )
+
         self._proxies_modified_at = proxies._modified_at
 
     @property
@@ -376,7 +1413,7 @@ class _Pool:
         return len(self._free) + len(self._used) + len(self._cooling_down) + len(self._blacklist)
 
     def _cool_released(self):
-        now = time.time()
+        now = self._clock.time()
 
         cooled = []
 
@@ -386,8 +1423,273 @@ class _Pool:
 
         for proxy in cooled:
             self._cooling_down.pop(proxy, None)
-            if proxy not in self._blacklist:
-                self._free.append(proxy)
+            if proxy not in self._blacklist and proxy not in self._paced_until:
+                self._make_available(proxy)
+
+        while self._paced and self._paced[0][0] <= now:
+            ready_at, proxy = heapq.heappop(self._paced)
+            if self._paced_until.get(proxy) != ready_at:
+                continue
+
+            del self._paced_until[proxy]
+            if proxy not in self._blacklist and proxy not in self._cooling_down:
+                self._make_available(proxy)
+
+    def _take_token(self, buckets, proxy, now):
+        """Забирает токен из "ведра" прокси
+
+        @return: через сколько секунд появится следующий токен (0 - токен уже есть)
+        """
+        tokens, updated_at = buckets.get(proxy, (self._rate_burst, now))
+
+        tokens = min(self._rate_burst, tokens + (now - updated_at) * self._rate_limit) - 1
+        buckets[proxy] = tokens, now
+
+        if tokens >= 1:
+            return 0
+
+        return (1 - tokens) / self._rate_limit
+
+    def _spend_rate(self, proxy, target_state=None):
+        if self._rate_limit is None:
+            return
+
+        now = self._clock.time()
+
+        if target_state is not None and self._rate_limit_per_target:
+            delay = self._take_token(target_state.buckets, proxy, now)
+            if delay:
+                # для ресурса "пустое ведро" равносильно охлаждению
+                ready_at = now + delay
+                target_state.cooling_down[proxy] = max(ready_at, target_state.cooling_down.get(proxy, 0))
+            return
+
+        delay = self._take_token(self._buckets, proxy, now)
+        if delay:
+            ready_at = now + delay
+            self._paced_until[proxy] = ready_at
+            heapq.heappush(self._paced, (ready_at, proxy))
+
+    def _is_available(self, proxy):
+        return (
+            proxy not in self._blacklist and
+            proxy not in self._cooling_down and
+            proxy not in self._paced_until
+        )
+
+    def _get_max_leases(self, proxy):
+        return self._max_leases_per_proxy.get(proxy, self._max_leases)
+
+    def _lease(self, proxy):
+        leases = self._leases.get(proxy, 0) + 1
+
+        self._leases[proxy] = leases
+        self._used.add(proxy)
+
+        if leases < self._get_max_leases(proxy):
+            self._push_loaded(proxy, leases)
+
+    def _unlease(self, proxy):
+        """Уменьшает кол-во выдач прокси
+
+        @return: кол-во оставшихся выдач
+        """
+        leases = self._leases.pop(proxy) - 1
+
+        if leases:
+            self._leases[proxy] = leases
+        else:
+            self._used.remove(proxy)
+
+        return leases
+
+    def _push_loaded(self, proxy, leases):
+        if len(self._loaded) > 2 * len(self._leases) + 64:
+            # слишком много устаревших записей
+            self._loaded = [item for item in self._loaded if self._is_loaded_valid(*item)]
+            heapq.heapify(self._loaded)
+
+        heapq.heappush(self._loaded, (leases, next(self._loaded_seq), proxy))
+
+    def _is_loaded_valid(self, leases, _, proxy):
+        return self._leases.get(proxy) == leases and self._is_available(proxy)
+
+    def _pop_loaded(self, skip=None):
+        """Возвращает наименее загруженный из используемых прокси
+
+        @param skip: функция, возвращающая True для прокси, которые брать нельзя (остаются в очереди)
+        """
+        skipped = []
+
+        proxy = None
+        while self._loaded:
+            item = heapq.heappop(self._loaded)
+            if not self._is_loaded_valid(*item):
+                continue
+
+            if skip is not None and skip(item[2]):
+                skipped.append(item)
+                continue
+
+            proxy = item[2]
+            break
+
+        for item in skipped:
+            heapq.heappush(self._loaded, item)
+
+        return proxy
+
+    def _make_available(self, proxy):
+        if proxy in self._free:
+            return
+
+        leases = self._leases.get(proxy)
+
+        if leases is None:
+            self._free.append(proxy)
+        elif leases < self._get_max_leases(proxy):
+            self._push_loaded(proxy, leases)
+        else:
+            return
+
+        self._notify()
+
+    def _phase(self, name):
+        if self._profiler is None:
+            return profiling.NULL_PHASE
+        return self._profiler.phase(name)
+
+    def _locked(self, name):
+        if self._profiler is None:
+            return self._cond
+        return self._profiler.locked(self._cond, name)
+
+    def _notify(self):
+        for event in self._listeners:
+            event.set()
+
+        if self._priorities is None:
+            if self._targets or self._selective_waiting:
+                # ожидающие другой ресурс (прокси, атрибуты) не смогут взять прокси, будим всех
+                self._cond.notify_all()
+            else:
+                self._cond.notify()
+        elif self._targets or self._selective_waiting:
+            for cond in self._priority_conds.values():
+                cond.notify_all()
+        else:
+            self._wake_next()
+
+    def _wake_next(self):
+        priority = self._get_next_priority()
+        if priority is not None:
+            self._priority_conds[priority].notify()
+
+    def _resolve_priority(self, priority):
+        if self._priorities is None:
+            return None
+
+        if priority is None:
+            return self._default_priority
+
+        if priority not in self._priorities:
+            raise ValueError("Неизвестный класс приоритета: %r" % (priority,))
+
+        return priority
+
+    def _get_next_priority(self):
+        """Класс, чья очередь получать прокси (среди ожидающих)
+        """
+        waiting = [priority for priority in self._priority_order if self._waiting[priority]]
+        if not waiting:
+            return None
+
+        if self._priority_mode == 'strict':
+            return waiting[0]
+
+        return min(waiting, key=self._passes.get)
+
+    def _may_acquire(self, priority):
+        if self._priorities is None:
+            return True
+
+        if self._priority_mode == 'strict':
+            for other in self._priority_order:
+                if other == priority:
+                    return True
+                if self._waiting[other]:
+                    return False
+
+        own = self._passes[priority]
+        return all(
+            own <= self._passes[other]
+            for other in self._priority_order
+            if other != priority and self._waiting[other]
+        )
+
+    def _charge_priority(self, priority):
+        if self._priorities is None or self._priority_mode != 'weighted':
+            return
+
+        if not self._waiting[priority]:
+            # класс не ожидал прокси - за время простоя он не должен накопить право получить их все разом
+            self._passes[priority] = max(self._passes[priority], self._virtual_time)
+
+        self._virtual_time = self._passes[priority]
+        self._passes[priority] += 1 / self._priorities[priority]
+
+    def _record_wait(self, priority, waited=None, rejected=False, timeout=False):
+        stat = self._wait_stats.get(priority)
+        if stat is None:
+            stat = self._wait_stats[priority] = [0, 0, 0, 0.0, 0.0]
+
+        if rejected:
+            stat[1] += 1
+        elif timeout:
+            stat[2] += 1
+        else:
+            stat[0] += 1
+            stat[3] += waited
+            stat[4] = max(stat[4], waited)
+
+    def get_wait_stats(self):
+        """
+        @return: {класс приоритета: {'acquired', 'rejected', 'timeouts', 'avg_wait', 'max_wait', 'waiting'}}
+        """
+        with self._cond:
+            return {
+                priority: {
+                    'acquired': acquired,
+                    'rejected': rejected,
+                    'timeouts': timeouts,
+                    'avg_wait': total_wait / acquired if acquired else 0,
+                    'max_wait': max_wait,
+                    'waiting': self._waiting[priority],
+                }
+                for priority, (acquired, rejected, timeouts, total_wait, max_wait) in self._wait_stats.items()
+            }
+
+    def _get_target(self, target):
+        now = self._clock.time()
+
+        if self._target_idle_ttl is not None:
+            # ресурсы упорядочены по времени использования
+            while self._targets:
+                state = next(iter(self._targets.values()))
+                if now - state.last_used < self._target_idle_ttl:
+                    break
+                self._targets.popitem(last=False)
+
+        state = self._targets.get(target)
+        if state is None:
+            state = self._targets[target] = _TargetState()
+            while len(self._targets) > self._max_targets:
+                self._targets.popitem(last=False)
+        else:
+            self._targets.move_to_end(target)
+
+        state.last_used = now
+        return state
 
     def _is_proxies_changed(self):
         self._proxies._auto_refresh()
@@ -406,31 +1708,62 @@ class _Pool:
 
         for proxy in _get_missing(self._used, full_list):
             self._used.remove(proxy)
+            self._leases.pop(proxy, None)
 
         for proxy in _get_missing(self._stats, full_list):
             self._stats.pop(proxy, None)
 
+        # потребление общее для всех шардов - очищается по всему списку в `Proxies._cleanup_internals`
+
+        for proxy in _get_missing(self._buckets, full_list):
+            self._buckets.pop(proxy)
+
+        for proxy in _get_missing(self._paced_until, full_list):
+            self._paced_until.pop(proxy)
+
+        for state in self._targets.values():
+            state.remove_outdated(full_list)
+
+        self._rebuild_free(full_list)
+
+        if self._ring is not None:
+            self._ring.update(full_list)
+
+        metadata = self._proxies._metadata
+        if metadata or isinstance(self._free, _IndexedFree):
+            # атрибуты прокси могли измениться вместе со списком
+            self._free = _IndexedFree(self._free, metadata)
+
+        self._proxies_modified_at = self._proxies._modified_at
+
+    def _rebuild_free(self, full_list):
+        """Приводит очередь свободных прокси к новому списку
+
+        Удаленные из списка прокси убираются из очереди, а добавленные (свободные) попадают в ее конец -
+        без этого прокси, появившиеся при обновлении списка, не выдавались бы до перезапуска.
+        """
         free = set(
             p for p in full_list
             if (
                 p not in self._used and
                 p not in self._blacklist and
-                p not in self._cooling_down
+                p not in self._cooling_down and
+                p not in self._paced_until
             )
         )
 
         old_free = set(self._free)
-        new_free = old_free.intersection(free)
 
-        if old_free.difference(new_free):
+        if old_free != free:
+            # сохраняем порядок оставшихся, новые прокси добавляем в конец
+            new_free = [p for p in self._free if p in free]
+            new_free.extend(free.difference(old_free))
+
             self._free.clear()
             self._free.extend(new_free)
 
-        self._proxies_modified_at = self._proxies._modified_at
-
-    def _update_stats(self, proxy, bad=False, holdout=None):
-        proxy_stat = self._stats.get(proxy) or {}
-
+    @staticmethod
+    def _inc_uptime(proxy_stat, bad=False):
         ok, fail = proxy_stat.get('uptime', (0, 0))
 
         if not bad:
@@ -439,6 +1772,14 @@ class _Pool:
             fail += 1
 
         proxy_stat['uptime'] = ok, fail
+
+    def _update_stats(self, proxy, bad=False, holdout=None, stats=None):
+        if stats is None:
+            stats = self._stats
+
+        proxy_stat = stats.get(proxy) or {}
+
+        self._inc_uptime(proxy_stat, bad=bad)
         proxy_stat['last_holdout'] = holdout
         if (
             not bad or
@@ -451,25 +1792,32 @@ class _Pool:
 
         # универсальный способ сказать что статистика обновилась
         # тк без вызова метода .save будет работать и с обычным словарем (не только с JsonDict)
-        self._stats[proxy] = proxy_stat
+        stats[proxy] = proxy_stat
 
-    def _get_next_holdout(self, proxy, bad=False):
+    def _get_next_holdout(self, proxy, bad=False, stats=None):
         """Рассчитывает время охлаждения.
 
         @param proxy: прокси, для которого необходимо вычислить
         @param bad: True - вычисляем охлаждение для неудачи, иначе False
+        @param stats: статистика, по которой производится расчет (по умолчанию - общая)
         @return: рекомендуемое время охлаждения в секундах или None, если недостаточно данных
         """
 
         # Алгоритм основан на бинарном поиске,
         # в отличии от которого нам не известна верхняя граница
 
-        proxy_stat = self._stats.get(proxy)
+        if stats is None:
+            stats = self._stats
+
+        proxy_stat = stats.get(proxy)
         if proxy_stat is None:
             return None
 
-        last_holdout = proxy_stat['last_holdout']
-        last_good_holdout = proxy_stat.get('last_good_holdout', 0)
+        last_holdout = proxy_stat.get('last_holdout')
+        if last_holdout is None:
+            return None
+
+        last_good_holdout = proxy_stat.get('last_good_holdout') or 0
 
         lo = last_holdout  # предыдущее время охлаждения (нижняя граница)
 
@@ -488,66 +1836,397 @@ class _Pool:
 
         return holdout
 
-    def acquire(self, timeout=None):
-        start = time.perf_counter()
+    @staticmethod
+    def _get_uptime(stats, proxy):
+        uptime = float('inf')
+
+        p_stat = stats.get(proxy)
+        if p_stat is not None:
+            ok, failed = p_stat.get('uptime', (0, 0))
+            if failed != 0:
+                uptime = ok // failed
+            else:
+                uptime = ok
+
+        return uptime
+
+    def _pop_blacklisted(self, target_state=None, where=None):
+        # Возвращаем самый стабильный из блеклиста. Возможно бан снят.
+
+        blacklist = self._blacklist
+        if where:
+            blacklist = [p for p in blacklist if self._matches(p, where)]
+
+        with self._phase('acquire.blacklist_sort'):
+            blacklist = sorted(blacklist, key=functools.partial(self._get_uptime, self._stats), reverse=True)
+
+        proxy = next((
+            p for p in blacklist
+            if (
+                p not in self._cooling_down and
+                self._leases.get(p, 0) < self._get_max_leases(p) and
+                (target_state is None or p not in target_state.cooling_down)
+            )
+        ), None)
+
+        if proxy is not None:
+            self._blacklist.pop(proxy)
+
+        # None - все прокси из блеклиста находятся на охлаждении
+        return proxy
+
+    def _pop_free(self, allow_blacklisted=True, exclude=()):
+        if self._free:
+            return self._free.popleft()
+
+        proxy = self._pop_loaded(skip=exclude.__contains__ if exclude else None)
+        if proxy is not None:
+            return proxy
+
+        if allow_blacklisted and self._blacklist:
+            return self._pop_blacklisted()
+
+        return None
+
+    def _pop_target_free(self, state, allow_blacklisted=True, exclude=()):
+        state.cool_released(self._clock.time())
+
+        if self._free:
+            if not state.blacklist and not state.cooling_down:
+                return self._free.popleft()
+
+            # перед подходящим прокси в очереди могут стоять только заблокированные ресурсом,
+            # поэтому просмотр ограничен их числом, а найденный прокси изымается за O(1)
+            proxy = next(
+                (p for p in self._free if p not in state.blacklist and p not in state.cooling_down),
+                None,
+            )
+
+            if proxy is not None:
+                self._free.remove(proxy)
+                return proxy
+
+        proxy = self._pop_loaded(skip=lambda p: p in state.blacklist or p in state.cooling_down or p in exclude)
+        if proxy is not None:
+            return proxy
+
+        if not allow_blacklisted:
+            return None
+
+        # Свободны только заблокированные ресурсом: возвращаем самый стабильный из них
+        candidates = [p for p in self._free if p not in state.cooling_down]
+        if candidates:
+            proxy = max(candidates, key=functools.partial(self._get_uptime, state.stats))
+            state.blacklist.pop(proxy)
+            self._free.remove(proxy)
+            return proxy
+
+        if self._blacklist:
+            proxy = self._pop_blacklisted(target_state=state)
+            if proxy is not None:
+                state.blacklist.pop(proxy, None)
+            return proxy
+
+        return None
+
+    def _matches(self, proxy, where):
+        attributes = self._proxies._metadata.get(proxy)
+        return attributes is not None and all(attributes.get(attr) == value for attr, value in where.items())
+
+    def _iter_free_matching(self, where):
+        if isinstance(self._free, _IndexedFree):
+            return self._free.iter_matching(where)
+
+        # в списке нет атрибутов
+        return iter(())
+
+    def _pop_where(self, where, state=None, allow_blacklisted=True, exclude=()):
+        """Берет прокси с указанными атрибутами (см. `acquire`)
+        """
+        if state is not None:
+            state.cool_released(self._clock.time())
+
+        def _is_blocked(p):
+            return state is not None and (p in state.blacklist or p in state.cooling_down)
+
+        proxy = next((p for p in self._iter_free_matching(where) if not _is_blocked(p)), None)
+        if proxy is not None:
+            self._free.remove(proxy)
+            return proxy
+
+        proxy = self._pop_loaded(skip=lambda p: _is_blocked(p) or p in exclude or not self._matches(p, where))
+        if proxy is not None:
+            return proxy
+
+        if not allow_blacklisted:
+            return None
+
+        if state is not None:
+            # Свободны только заблокированные ресурсом: возвращаем самый стабильный из них
+            candidates = [p for p in self._iter_free_matching(where) if p not in state.cooling_down]
+            if candidates:
+                proxy = max(candidates, key=functools.partial(self._get_uptime, state.stats))
+                state.blacklist.pop(proxy)
+                self._free.remove(proxy)
+                return proxy
 
+        if self._blacklist:
+            proxy = self._pop_blacklisted(target_state=state, where=where)
+            if proxy is not None and state is not None:
+                state.blacklist.pop(proxy, None)
+            return proxy
+
+        return None
+
+    def _get_ring(self):
+        if self._ring is None:
+            from . import affinity
+
+            self._ring = affinity.HashRing(self._proxies.proxies, replicas=self._affinity_replicas)
+
+            if not isinstance(self._free, _IndexedFree):
+                # закрепленный прокси изымается из середины очереди - нужна очередь с изъятием за O(1)
+                self._free = _IndexedFree(self._free, self._proxies._metadata)
+
+        return self._ring
+
+    def _pop_key(self, key, state=None, allow_blacklisted=True, exclude=()):
+        """Берет прокси, закрепленный за ключом (см. `acquire`)
+
+        @return: прокси или None, если закрепленный прокси сейчас занят или охлаждается
+        """
+        if state is not None:
+            state.cool_released(self._clock.time())
+
+        def _is_banned(p):
+            return p in self._blacklist or (state is not None and p in state.blacklist)
+
+        ring = self._get_ring()
+
+        proxy = ring.lookup(key, skip=_is_banned)
+        if proxy is None:
+            if not allow_blacklisted:
+                return None
+
+            # Все прокси в черном списке: берем закрепленный за ключом. Возможно бан снят.
+            proxy = ring.lookup(key)
+            if proxy is None:
+                return None
+
+        if (
+            proxy in exclude or
+            proxy in self._cooling_down or
+            proxy in self._paced_until or
+            (state is not None and proxy in state.cooling_down) or
+            self._leases.get(proxy, 0) >= self._get_max_leases(proxy)
+        ):
+            # ключ ждет свой прокси, а не переходит к другому
+            return None
+
+        if proxy in self._free:
+            self._free.remove(proxy)
+
+        self._blacklist.pop(proxy, None)
+        if state is not None:
+            state.blacklist.pop(proxy, None)
+
+        return proxy
+
+    def _try_acquire(self, target=None, allow_blacklisted=True, where=None, key=None, exclude=()):
+        """Одна попытка взять прокси (вызывается под локом)
+
+        @param allow_blacklisted: False - не брать прокси из черного списка, даже если других нет
+        @param where: атрибуты прокси (см. `acquire`)
+        @param key: ключ закрепления (см. `acquire`)
+        @param exclude: прокси, которые брать нельзя (уже используемые вызывающим, см. 'max_leases')
+        @return: (прокси или None, состояние ресурса `target`)
+        """
+        with self._phase('acquire.auto_refresh'):
+            is_changed = self._is_proxies_changed()
+
+        if is_changed:
+            with self._phase('acquire.remove_outdated'):
+                self._remove_outdated()
+
+        with self._phase('acquire.cool_released'):
+            self._cool_released()
+
+        if self._paused_until is not None:
+            if self._clock.time() < self._paused_until:
+                # бюджет пула исчерпан
+                return None, None
+            self._paused_until = None
+
+        with self._phase('acquire.pop'):
+            target_state = None if target is None else self._get_target(target)
+
+            if key is not None:
+                proxy = self._pop_key(key, target_state, allow_blacklisted, exclude)
+            elif where:
+                proxy = self._pop_where(where, target_state, allow_blacklisted, exclude)
+            elif target_state is None:
+                proxy = self._pop_free(allow_blacklisted, exclude)
+            else:
+                proxy = self._pop_target_free(target_state, allow_blacklisted, exclude)
+
+        if proxy is not None:
+            self._spend_rate(proxy, target_state)
+            self._lease(proxy)
+
+        return proxy, target_state
+
+    def try_acquire(self, target=None, allow_blacklisted=True, priority=None, where=None, key=None, exclude=()):
+        """Берет прокси без ожидания
+
+        @param priority: класс приоритета (см. `acquire`)
+        @param where: атрибуты прокси (см. `acquire`)
+        @param key: ключ закрепления (см. `acquire`)
+        @param exclude: прокси, которые брать нельзя, даже если они допускают еще одну выдачу ('max_leases')
+        @return: (прокси или None, через сколько секунд стоит повторить попытку - None, если неизвестно)
+        """
+        priority = self._resolve_priority(priority)
+
+        with self._locked('acquire.lock_wait'):
+            if not self._may_acquire(priority):
+                return None, None
+
+            proxy, target_state = self._try_acquire(target, allow_blacklisted, where, key, exclude)
+            if proxy is not None:
+                self._charge_priority(priority)
+                return proxy, 0
+
+            return None, self._get_wait_time(None, target_state)
+
+    def add_listener(self, event):
+        """Подписывает `threading.Event` на появление свободных прокси (см. `MultiChain`)
+        """
         with self._cond:
-            while True:
-                if self._is_proxies_changed():
-                    self._remove_outdated()
-
-                self._cool_released()
-
-                if self._free:
-                    proxy = self._free.popleft()
-                    self._used.add(proxy)
-                    return proxy
-
-                if self._blacklist:
-                    # Возвращаем самый стабильный из блеклиста. Возможно бан снят.
-
-                    def _uptime(p):
-                        uptime = float('inf')
-
-                        p_stat = self._stats.get(p)
-                        if p_stat is not None:
-                            ok, failed = p_stat.get('uptime', (0, 0))
-                            if failed != 0:
-                                uptime = ok // failed
-                            else:
-                                uptime = ok
-
-                        return uptime
-
-                    proxy = next((
-                        p for p in sorted(self._blacklist, key=_uptime, reverse=True)
-                        if p not in self._cooling_down
-                    ), None)
-
-                    if proxy is not None:
-                        self._blacklist.pop(proxy)
-                        self._used.add(proxy)
-                        return proxy
-                    else:
-                        # Все прокси из блеклиста находятся на охлаждении
-                        pass
+            self._listeners.add(event)
 
-                if self._cooling_down:
-                    self._cond.wait(1)
-                else:
-                    self._cond.wait(timeout)
+    def remove_listener(self, event):
+        with self._cond:
+            self._listeners.discard(event)
+
+    @property
+    def free_capacity(self):
+        """Оценка кол-ва прокси, которые можно взять без ожидания
+        """
+        return len(self._free) + len(self._loaded)
 
-                if timeout is not None:
-                    if time.perf_counter() - start > timeout:
-                        raise NoFreeProxies
+    @property
+    def capacity(self):
+        """Сколько раз прокси из списка могут быть выданы одновременно (с учетом 'max_leases')
+        """
+        return sum(self._get_max_leases(proxy) for proxy in self._proxies.proxies)
+
+    def acquire(self, timeout=None, target=None, priority=None, where=None, key=None):
+        """Берет прокси из пула
+
+        @param timeout (сек.): None - ждать до появления свободного прокси, иначе бросить `NoFreeProxies`
+        @param target: ресурс (например, хост), для которого берется прокси:
+         охлаждение и черный список, указанные при `release` с тем же `target`, действуют только для него
+        @param priority: класс приоритета (опция 'priorities'), None - класс по умолчанию
+        @param where: атрибуты, которые должны быть у прокси ({атрибут: значение}, см. `Proxies.get_attributes`),
+         например {'country': 'de', 'type': 'socks5'}; свободный прокси ищется по индексам, без просмотра очереди
+        @param key: ключ закрепления (аккаунт, сессия) - для одного ключа выдается один и тот же прокси
+         (консистентное хеширование, см. `affinity.HashRing`); если он занят или охлаждается - ожидается именно он,
+         если в черном списке или удален из списка - ключ переходит к другому прокси (остальные ключи не меняются);
+         `where` при этом не учитывается
+        """
+        start = self._clock.perf_counter()
+        priority = self._resolve_priority(priority)
+        cond = self._priority_conds[priority]
+        waiting = False
+        selective = key is not None or bool(where)
+
+        with self._locked('acquire.lock_wait'):
+            try:
+                while True:
+                    target_state = None
+
+                    if self._may_acquire(priority):
+                        proxy, target_state = self._try_acquire(target, where=where, key=key)
+                        if proxy is not None:
+                            self._charge_priority(priority)
+                            self._record_wait(priority, self._clock.perf_counter() - start)
+                            return proxy
+
+                    if not waiting:
+                        if self._max_waiters is not None and sum(self._waiting.values()) >= self._max_waiters:
+                            self._record_wait(priority, rejected=True)
+                            raise NoFreeProxies
+
+                        self._waiting[priority] += 1
+                        self._selective_waiting += selective
+                        waiting = True
+
+                    with self._phase('acquire.wait'):
+                        self._clock.wait(cond, self._get_wait_time(timeout, target_state))
+
+                    if timeout is not None:
+                        if self._clock.perf_counter() - start >= timeout:
+                            self._record_wait(priority, timeout=True)
+                            raise NoFreeProxies
+            finally:
+                if waiting:
+                    self._waiting[priority] -= 1
+                    self._selective_waiting -= selective
+
+                    if self._priorities is not None and self.free_capacity:
+                        # очередь могла перейти к другому классу
+                        self._wake_next()
+
+    def _get_wait_time(self, timeout, target_state=None):
+        wait_time = timeout
+
+        def _min(value):
+            return value if wait_time is None else min(wait_time, value)
+
+        if self._cooling_down:
+            wait_time = _min(1)
+
+        now = self._clock.time()
+
+        if self._paced:
+            # ждем ровно до появления токена у "ближайшего" прокси
+            wait_time = _min(max(0, self._paced[0][0] - now))
+
+        if self._paused_until is not None:
+            wait_time = _min(max(0, self._paused_until - now))
+
+        if target_state is not None and target_state.cooling_down:
+            if self._rate_limit is not None and self._rate_limit_per_target:
+                wait_time = _min(max(0, min(target_state.cooling_down.values()) - now))
+            else:
+                wait_time = _min(1)
 
-    def release(self, proxy, bad=False, holdout=None, bad_reason=None):
+        return wait_time
+
+    def _get_next_release_time(self):
+        """Возвращает ближайшее время окончания охлаждения или ограничения частоты (None - неизвестно)
+        """
+        times = []
+
+        if self._cooling_down:
+            times.append(min(self._cooling_down.values()))
+
+        if self._paced:
+            times.append(self._paced[0][0])
+
+        if self._paused_until is not None:
+            times.append(self._paused_until)
+
+        return min(times, default=None)
+
+    def release(self, proxy, bad=False, holdout=None, bad_reason=None, target=None):
         """Возвращает прокси в пул
 
         @param proxy: прокси
         @param holdout (сек): None - вернуть сразу, иначе прокси не будет использован до истечения указанного интервала
+        @param target: ресурс, для которого действуют `bad` и `holdout` (см. `acquire`),
+         для остальных ресурсов прокси возвращается в пул сразу
         """
-        with self._cond:
+        with self._locked('release.lock_wait'):
             is_outdated = proxy not in self._used
 
             if is_outdated:
@@ -555,14 +2234,21 @@ class _Pool:
                 # И был удален из списка
                 return
 
-            self._used.remove(proxy)
+            self._unlease(proxy)
+
+            if target is None:
+                target_state = None
+                stats = self._stats
+            else:
+                target_state = self._get_target(target)
+                stats = target_state.stats
 
             if holdout is None or self._force_defaults:
                 holdout = self._default_holdout if not bad else self._default_bad_holdout
 
             if self._smart_holdout:
                 _holdout = (
-                    self._get_next_holdout(proxy, bad=bad) or
+                    self._get_next_holdout(proxy, bad=bad, stats=stats) or
                     holdout or
                     self._smart_holdout_start
                 )
@@ -575,17 +2261,439 @@ class _Pool:
                 else:
                     holdout = max(self._smart_holdout_min, _holdout)
 
+            if target_state is not None:
+                if holdout is not None:
+                    target_state.cooling_down[proxy] = self._clock.time() + holdout
+
+                if bad:
+                    target_state.blacklist[proxy] = bad_reason
+
+                if self._is_available(proxy):
+                    self._make_available(proxy)
+
+                with self._phase('release.stats_save'):
+                    self._update_stats(proxy, bad=bad, holdout=holdout, stats=stats)
+
+                    # общая статистика надежности (без влияния на общее охлаждение)
+                    proxy_stat = self._stats.get(proxy) or {}
+                    self._inc_uptime(proxy_stat, bad=bad)
+                    self._stats[proxy] = proxy_stat
+                return
+
             if holdout is not None:
-                self._cooling_down[proxy] = time.time() + holdout
+                with self._phase('release.cooldown_save'):
+                    self._cooling_down[proxy] = self._clock.time() + holdout
 
+            # охлаждение и черный список действуют на все одновременные выдачи прокси
             if bad:
-                self._blacklist[proxy] = bad_reason
-            elif holdout is None:
+                with self._phase('release.blacklist_save'):
+                    self._blacklist[proxy] = bad_reason
+            elif holdout is None and self._is_available(proxy):
                 # прокси не требует остывания
-                self._free.append(proxy)
-                self._cond.notify()
+                self._make_available(proxy)
+
+            with self._phase('release.stats_save'):
+                self._update_stats(proxy, bad=bad, holdout=holdout)
+
+    def record_usage(self, proxy, sent=0, received=0, requests=1):
+        """Учитывает трафик (байт отправлено/получено) и кол-во запросов через прокси (см. `client.Client`)
+
+        Прокси, исчерпавший бюджет (опция 'budget'), охлаждается до окончания окна;
+        при исчерпании бюджета пула (опция 'pool_budget') прокси не выдаются до окончания его окна.
+        """
+        with self._locked('usage.lock_wait'):
+            now = self._clock.time()
+            usage = self._proxies._usage
+
+            budget = self._budget
+            # словарь общий для шардов пула - изменяется под локом `Proxies`
+            with self._proxies._cleanup_lock:
+                entry = _add_usage(usage, proxy, now, sent, received, requests, budget and budget['window'])
+
+            end = budget and _get_budget_end(entry, budget, now)
+            if end and self._cooling_down.get(proxy, 0) < end:
+                self._cooling_down[proxy] = end
+                if proxy in self._free:
+                    self._free.remove(proxy)
+
+            if self._pool_budget:
+                with self._proxies._cleanup_lock:
+                    entry = _add_usage(
+                        usage, _POOL_USAGE_KEY, now, sent, received, requests, self._pool_budget['window'],
+                    )
+                self._paused_until = _get_budget_end(entry, self._pool_budget, now)
+
+    def return_unused(self, proxy):
+        """Возвращает в пул прокси, через который не выполнялись запросы (см. `Chain(prefetch=True)`):
+        без охлаждения и без учета в статистике
+        """
+        with self._locked('release.lock_wait'):
+            if proxy not in self._used:
+                return
+
+            self._unlease(proxy)
+
+            if self._is_available(proxy):
+                self._make_available(proxy)
+
+    def probe_candidates(self):
+        """Возвращает прокси из черного списка, которые стоит проверить (см. `health.HealthChecker`)
+        """
+        with self._cond:
+            if self._is_proxies_changed():
+                self._remove_outdated()
+
+            return list(self._blacklist)
+
+    def report_probe(self, proxy, alive):
+        """Учитывает результат проверки прокси из черного списка
+
+        @param proxy: прокси
+        @param alive: True - прокси работает и может быть возвращен в пул
+        @return: True, если прокси был изъят из черного списка
+        """
+        with self._cond:
+            if proxy not in self._blacklist:
+                # Пока шла проверка прокси был взят из пула или удален из списка
+                return False
+
+            proxy_stat = self._stats.get(proxy) or {}
+            self._inc_uptime(proxy_stat, bad=not alive)
+            self._stats[proxy] = proxy_stat
+
+            if not alive:
+                return False
+
+            self._blacklist.pop(proxy)
+
+            # Охлаждение продолжает действовать, прокси вернется в пул по его истечении
+            if self._is_available(proxy):
+                self._make_available(proxy)
+
+            return True
+
+
+def _acquire_any(attempts, timeout=None, clock=None):
+    """Ждет свободный прокси сразу в нескольких пулах
+
+    @param attempts: функция, возвращающая последовательность (ключ, пул, параметры `try_acquire`)
+     в порядке приоритета
+    @param timeout (сек.): None - ждать до появления свободного прокси, иначе бросить `NoFreeProxies`
+    @return: (ключ, прокси)
+    """
+    if clock is None:
+        clock = utils.SystemClock()
+
+    start = clock.perf_counter()
+    event = threading.Event()
+    pools = set()
+
+    try:
+        while True:
+            event.clear()
+
+            if timeout is None:
+                wait_time = None
+            else:
+                wait_time = timeout - (clock.perf_counter() - start)
+
+            for key, pool, kw in attempts():
+                if pool not in pools:
+                    pool.add_listener(event)
+                    pools.add(pool)
+
+                proxy, retry_after = pool.try_acquire(**kw)
+                if proxy is not None:
+                    return key, proxy
+
+                if retry_after is not None:
+                    wait_time = retry_after if wait_time is None else min(wait_time, retry_after)
+
+            if timeout is not None and clock.perf_counter() - start >= timeout:
+                raise NoFreeProxies
+
+            clock.wait(event, wait_time)
+    finally:
+        for pool in pools:
+            pool.remove_listener(event)
+
+
+class _ContentionLock:
+    """RLock со статистикой конкуренции (сколько раз и сколько времени потоки ждали лок)
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+        self.acquires = 0
+        self.contended = 0
+        self.wait_time = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self.acquires += 1
+            return True
+
+        if not blocking:
+            return False
+
+        start = time.perf_counter()
+        if not self._lock.acquire(True, timeout):
+            return False
+
+        # счетчики изменяются только под локом
+        self.acquires += 1
+        self.contended += 1
+        self.wait_time += time.perf_counter() - start
+        return True
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    # для `threading.Condition`
+    def _is_owned(self):
+        return self._lock._is_owned()
+
+    def _release_save(self):
+        return self._lock._release_save()
+
+    def _acquire_restore(self, state):
+        self._lock._acquire_restore(state)
+
+
+class _ShardStorage(dict):
+    """Часть общего хранилища (черный список, охлаждение, статистика), относящаяся к шарду
+
+    Чтение - из локальной копии (под локом шарда), изменения дублируются в общее хранилище под общим локом
+    """
+
+    def __init__(self, shared, lock, keys):
+        with lock:
+            super().__init__((k, shared[k]) for k in keys if k in shared)
+
+        self._shared = shared
+        self._lock = lock
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        with self._lock:
+            self._shared[key] = value
 
-            self._update_stats(proxy, bad=bad, holdout=holdout)
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        with self._lock:
+            self._shared.pop(key, None)
+
+    def pop(self, key, *default):
+        result = super().pop(key, *default)
+        with self._lock:
+            self._shared.pop(key, None)
+        return result
+
+
+class _ShardProxies:
+    """Часть списка `Proxies`, обслуживаемая одним шардом
+    """
+
+    def __init__(self, proxies, index, count):
+        self._parent = proxies
+        self._index = index
+        self._count = count
+
+        self._cached = None
+        self._cached_at = None
+
+    @property
+    def _clock(self):
+        return self._parent._clock
+
+    @property
+    def _profiler(self):
+        return self._parent._profiler
+
+    @property
+    def _modified_at(self):
+        return self._parent._modified_at
+
+    @property
+    def _metadata(self):
+        return self._parent._metadata
+
+    @property
+    def _usage(self):
+        return self._parent._usage
+
+    @property
+    def _cleanup_lock(self):
+        return self._parent._cleanup_lock
+
+    def _auto_refresh(self):
+        self._parent._auto_refresh()
+
+    @property
+    def proxies(self):
+        proxies = self._parent.proxies
+        modified_at = self._parent._modified_at
+
+        if self._cached is None or self._cached_at != modified_at:
+            self._cached = [p for p in proxies if _ShardedPool.get_shard_index(p, self._count) == self._index]
+            self._cached_at = modified_at
+
+        return self._cached
+
+
+class _ShardedPool:
+    """Пул, разделенный на несколько независимых шардов со своими локами.
+
+    Каждый поток в первую очередь берет прокси из "своего" шарда,
+    а если в нем нет свободных - из остальных (work-stealing).
+    Прокси из черного списка выдаются, только если свободных нет ни в одном шарде.
+    """
+
+    def __init__(self, proxies, shards, cooling_down, blacklist, stats, _cleanup_lock, **options):
+        self._shards = []
+
+        for index in range(shards):
+            shard_proxies = _ShardProxies(proxies, index, shards)
+            keys = set(shard_proxies.proxies)
+
+            self._shards.append(_Pool(
+                shard_proxies,
+                _ShardStorage(cooling_down, _cleanup_lock, keys),
+                _ShardStorage(blacklist, _cleanup_lock, keys),
+                _ShardStorage(stats, _cleanup_lock, keys),
+                _ContentionLock(),
+                **options
+            ))
+
+        self._clock = proxies._clock
+        self._local = threading.local()
+        self._next_home = itertools.count()
+        self._steals = 0
+
+    @staticmethod
+    def get_shard_index(proxy, count):
+        return zlib.crc32(proxy.encode()) % count
+
+    def _get_shard(self, proxy):
+        return self._shards[self.get_shard_index(proxy, len(self._shards))]
+
+    def _get_ordered_shards(self):
+        home = getattr(self._local, 'home', None)
+        if home is None:
+            home = self._local.home = next(self._next_home) % len(self._shards)
+
+        return self._shards[home:] + self._shards[:home]
+
+    def _attempts(self, target=None, where=None):
+        shards = self._get_ordered_shards()
+
+        for allow_blacklisted in (False, True):
+            for idx, shard in enumerate(shards):
+                yield idx, shard, {'target': target, 'allow_blacklisted': allow_blacklisted, 'where': where}
+
+    def _get_key_shard(self, key):
+        # ключ закрепляется за шардом, а внутри него - за прокси
+        return self._shards[self.get_shard_index(str(key), len(self._shards))]
+
+    def try_acquire(self, target=None, allow_blacklisted=True, priority=None, where=None, key=None, exclude=()):
+        if key is not None:
+            return self._get_key_shard(key).try_acquire(
+                target=target, allow_blacklisted=allow_blacklisted, key=key, exclude=exclude,
+            )
+
+        retry_after = None
+
+        for idx, shard, kw in self._attempts(target, where):
+            if kw['allow_blacklisted'] and not allow_blacklisted:
+                break
+
+            proxy, shard_retry_after = shard.try_acquire(exclude=exclude, **kw)
+            if proxy is not None:
+                if idx:
+                    self._steals += 1
+                return proxy, 0
+
+            if shard_retry_after is not None:
+                retry_after = shard_retry_after if retry_after is None else min(retry_after, shard_retry_after)
+
+        return None, retry_after
+
+    def acquire(self, timeout=None, target=None, priority=None, where=None, key=None):
+        if key is not None:
+            return self._get_key_shard(key).acquire(timeout=timeout, target=target, key=key)
+
+        proxy, _ = self.try_acquire(target, where=where)
+        if proxy is not None:
+            return proxy
+
+        idx, proxy = _acquire_any(lambda: self._attempts(target, where), timeout=timeout, clock=self._clock)
+        if idx:
+            self._steals += 1
+        return proxy
+
+    def release(self, proxy, bad=False, holdout=None, bad_reason=None, target=None):
+        self._get_shard(proxy).release(proxy, bad=bad, holdout=holdout, bad_reason=bad_reason, target=target)
+
+    def return_unused(self, proxy):
+        self._get_shard(proxy).return_unused(proxy)
+
+    def record_usage(self, proxy, sent=0, received=0, requests=1):
+        self._get_shard(proxy).record_usage(proxy, sent=sent, received=received, requests=requests)
+
+    def add_listener(self, event):
+        for shard in self._shards:
+            shard.add_listener(event)
+
+    def remove_listener(self, event):
+        for shard in self._shards:
+            shard.remove_listener(event)
+
+    @property
+    def free_capacity(self):
+        return sum(shard.free_capacity for shard in self._shards)
+
+    @property
+    def capacity(self):
+        return sum(shard.capacity for shard in self._shards)
+
+    def probe_candidates(self):
+        return [proxy for shard in self._shards for proxy in shard.probe_candidates()]
+
+    def report_probe(self, proxy, alive):
+        return self._get_shard(proxy).report_probe(proxy, alive)
+
+    def _get_next_release_time(self):
+        return min(
+            (t for t in (shard._get_next_release_time() for shard in self._shards) if t is not None),
+            default=None,
+        )
+
+    def get_contention_stats(self):
+        """Статистика конкуренции за локи шардов
+
+        @return: {'steals': кол-во прокси, взятых из "чужого" шарда,
+                  'shards': [{'size', 'acquires', 'contended', 'wait_time'}, ...]}
+        """
+        return {
+            'steals': self._steals,
+            'shards': [
+                {
+                    'size': len(shard._proxies.proxies),
+                    'acquires': shard._cond._lock.acquires,
+                    'contended': shard._cond._lock.contended,
+                    'wait_time': shard._cond._lock.wait_time,
+                }
+                for shard in self._shards
+            ],
+        }
 
 
 class IChain:
@@ -604,6 +2712,23 @@ class IChain:
     def wrap_session(self, session):
         raise NotImplementedError
 
+    def record_usage(self, sent=0, received=0, requests=1):
+        """Учитывает трафик и запросы через текущий прокси (см. `_Pool.record_usage`)
+        """
+        pass
+
+    def bind_usage(self):
+        """Функция учета трафика (аргументы - как у `record_usage`), привязанная к текущему прокси
+
+        Для запросов, которые могут завершиться уже после смены прокси цепочки.
+        """
+        return self.record_usage
+
+    def pop_untraced_spans(self):
+        """Интервалы (название, начало, длительность, теги), записанные вне активной трассы (см. `tracing`)
+        """
+        return []
+
     def wrap_module(self, module, all_threads=False):
         """
         Attempts to replace a module's socket library with a SOCKS socket.
@@ -621,12 +2746,39 @@ class IChain:
             socks.monkey_socket.socks_wrap_module_global(routes, module)
 
 
+class _Spare:
+    __slots__ = ('proxy', 'path', 'adapter', 'timer')
+
+    def __init__(self, proxy, path, adapter):
+        self.proxy = proxy
+        self.path = path
+        self.adapter = adapter
+        self.timer = None
+
+
+def _release_after_gateway_check(pool, proxy, gateway_alive, holdout=None, bad_reason=None, target=None):
+    if gateway_alive:
+        pool.release(proxy, bad=True, holdout=holdout, bad_reason=bad_reason, target=target)
+    else:
+        pool.return_unused(proxy)
+
+
+def _expire_spare(chain_ref, spare):
+    chain = chain_ref()
+    if chain is not None:
+        chain._drop_spare(spare)
+
+
 class Chain(IChain):
     """
     Не является потокобезопасным.
     """
 
-    def __init__(self, proxies, proxy_gw=None, use_pool=False, pool_acquire_timeout=None):
+    def __init__(
+        self, proxies, proxy_gw=None, use_pool=False, pool_acquire_timeout=None, pool_target=None,
+        prefetch=False, prefetch_ttl=60, connection_pool=None, gateway_breakers=None, pool_priority=None,
+        pool_where=None, pool_key=None,
+    ):
         """
         @param proxies: список адресов прокси-серверов
         @param proxy_gw: прокси-сервер, который должен стоять во главе цепочки
@@ -634,8 +2786,19 @@ class Chain(IChain):
         @param use_pool: использовать список прокси в качестве пула
         @param pool_acquire_timeout (сек.): если за указанный период не удастся получить свободный прокси
          будет брошено исключение `NoFreeProxies`, None - ждать до появления свободного адреса
+        @param pool_target: ресурс (хост), к которому относятся охлаждение и черный список (см. `_Pool.acquire`)
+        @param prefetch: держать взятым из пула запасной прокси с заранее подготовленной цепочкой,
+         чтобы `switch` не ждал пул (только вместе с `use_pool`)
+        @param prefetch_ttl (сек.): неиспользованный запасной прокси возвращается в пул по истечении этого времени
+        @param connection_pool: `connections.AdapterPool` - соединения, общие для цепочек с одинаковым путем
+        @param gateway_breakers: `breaker.BreakerRegistry` - при недоступности шлюза `switch(bad=True)`
+         не помещает прокси в черный список, а после размыкания цепочка сразу завершается `CircuitOpenError`
+        @param pool_priority: класс приоритета при получении прокси из пула (см. `_Pool.acquire`)
+        @param pool_where: атрибуты прокси, получаемых из пула (см. `_Pool.acquire`)
+        @param pool_key: ключ закрепления (аккаунт, сессия) - цепочки с одним ключом получают из пула
+         один и тот же прокси (см. `_Pool.acquire`); `prefetch` при этом не используется
         """
-        if not isinstance(proxies, Proxies) and isinstance(proxies, collections.Sequence):
+        if not isinstance(proxies, Proxies) and isinstance(proxies, collections.abc.Sequence):
             proxies = Proxies(proxies)
 
         if use_pool:
@@ -646,11 +2809,34 @@ class Chain(IChain):
         self.proxies = proxies
         self.proxy_gw = proxy_gw
 
-        self._proxies_pool = pool
+        self._pool = pool
+        self._pool_generation = proxies._fork_generation
         self._current_pool_proxy = None
+        # прокси текущей цепочки (в т.ч. без пула) - для учета потребления
+        self._current_proxy = None
         self._pool_acquire_timeout = pool_acquire_timeout
+        self._pool_target = pool_target
+        self._pool_priority = pool_priority
+        self._pool_where = pool_where
+        self._pool_key = pool_key
+
+        # следующий прокси для ключа определяется только после смены текущего
+        self._prefetch = prefetch and pool is not None and pool_key is None
+        self._prefetch_ttl = prefetch_ttl
+        self._spare = None
+        self._spare_pending = False
+        self._spare_lock = threading.Lock()
+        self._prepared_adapter = None
+        self._connection_pool = connection_pool
+
+        self._gateway_breakers = gateway_breakers
+        self._gateway_breaker = None
+        if gateway_breakers is not None and proxy_gw:
+            self._gateway_breaker = gateway_breakers.get(proxy_gw)
 
         self.__path = []
+        # получение прокси вне активной трассы (например, `switch` между запросами клиента)
+        self._untraced_spans = collections.deque(maxlen=16)
 
         # fix http://bugs.python.org/issue23841
         if sys.version_info >= (3, 4, 0):
@@ -662,17 +2848,86 @@ class Chain(IChain):
         if self.finalizer is None:
             self.finalize()
 
+    @property
+    def _proxies_pool(self):
+        if self._pool is not None and self._pool_generation != self.proxies._fork_generation:
+            self._rebind_pool()
+        return self._pool
+
+    def _rebind_pool(self):
+        # цепочка создана до fork (опция 'fork_workers'): пул родителя и взятые из него прокси
+        # в дочернем процессе не используются
+        self._pool = self.proxies.get_pool()
+        self._pool_generation = self.proxies._fork_generation
+
+        self._current_pool_proxy = None
+        self._current_proxy = None
+        self._prepared_adapter = None
+        self._spare = None
+        self._spare_pending = False
+        self._spare_lock = threading.Lock()
+        self.__path = []
+
     def finalize(self):
         if self._proxies_pool is not None:
             self._release_pool_proxy()
 
-    def _build_path(self, proxy):
-        path = []
+            if self._prefetch:
+                self._drop_spare()
+
+    def clone(self, **kw):
+        """Создает новую цепочку с теми же параметрами (и тем же пулом, если он используется)
+
+        @param kw: параметры, которые необходимо переопределить (см. `Chain.__init__`)
+        """
+        params = {
+            'proxy_gw': self.proxy_gw,
+            'use_pool': self._proxies_pool is not None,
+            'pool_acquire_timeout': self._pool_acquire_timeout,
+            'pool_target': self._pool_target,
+            'prefetch': self._prefetch,
+            'prefetch_ttl': self._prefetch_ttl,
+            'connection_pool': self._connection_pool,
+            'gateway_breakers': self._gateway_breakers,
+            'pool_priority': self._pool_priority,
+            'pool_where': self._pool_where,
+            'pool_key': self._pool_key,
+        }
+        params.update(kw)
+        return type(self)(self.proxies, **params)
+
+    def clone_alternate(self):
+        """Создает цепочку с другим прокси из того же пула без ожидания (для дублирования запроса)
+
+        Прокси из черного списка и текущий прокси цепочки (при 'max_leases' > 1) не берутся.
+
+        @return: новая цепочка или None, если подходящего свободного прокси нет
+        """
+        pool = self._proxies_pool
+        if pool is None or (self._gateway_breaker is not None and self._gateway_breaker.is_open):
+            return None
+
+        proxy, _ = pool.try_acquire(
+            target=self._pool_target, allow_blacklisted=False, priority=self._pool_priority,
+            where=self._pool_where, exclude=(self._current_pool_proxy,) if self._current_pool_proxy else (),
+        )
+        if proxy is None:
+            return None
+
+        chain = self.clone(prefetch=False, pool_key=None)
+        try:
+            chain._set_pool_proxy(proxy)
+        except Exception:
+            pool.return_unused(proxy)
+            raise
+
+        return chain
 
-        if self.proxy_gw:
-            path.append(self.proxy_gw)
+    def _build_path(self, proxy):
+        path = build_path(proxy, self.proxy_gw)
 
-        path.append(proxy)
+        if self.proxies._dns_cache is not None:
+            path = [self.proxies.resolve_address(address) for address in path]
 
         return path
 
@@ -681,10 +2936,27 @@ class Chain(IChain):
             proxy = self._current_pool_proxy
 
             self._current_pool_proxy = None
-            self._proxies_pool.release(proxy, bad=bad, holdout=holdout, bad_reason=bad_reason)
+            with self.proxies._phase('chain.release'):
+                self._proxies_pool.release(
+                    proxy, bad=bad, holdout=holdout, bad_reason=bad_reason, target=self._pool_target,
+                )
 
     def _acquire_pool_proxy(self):
-        proxy = self._proxies_pool.acquire(timeout=self._pool_acquire_timeout)
+        proxy = None
+        start = time.perf_counter()
+        try:
+            with self.proxies._phase('chain.acquire'):
+                proxy = self._proxies_pool.acquire(
+                    timeout=self._pool_acquire_timeout, target=self._pool_target, priority=self._pool_priority,
+                    where=self._pool_where, key=self._pool_key,
+                )
+        finally:
+            duration = time.perf_counter() - start
+            if tracing.get_current_trace() is not None:
+                tracing.add_span('pool.acquire', start, duration, proxy=proxy)
+            else:
+                self._untraced_spans.append(('pool.acquire', start, duration, {'proxy': proxy}))
+
         self._current_pool_proxy = proxy
         return proxy
 
@@ -694,27 +2966,163 @@ class Chain(IChain):
         else:
             return self.proxies.get_random_address()
 
+    def _is_gateway_allowed(self):
+        return self._gateway_breaker is None or self._gateway_breaker.allow()
+
+    def _new_path(self):
+        if not self._is_gateway_allowed():
+            raise CircuitOpenError(self.proxy_gw)
+
+        spare = self._take_spare() if self._prefetch else None
+
+        if spare is not None:
+            self._current_pool_proxy = proxy = spare.proxy
+            self._prepared_adapter = spare.adapter
+            path = spare.path
+        else:
+            self._prepared_adapter = None
+            proxy = self._get_proxy()
+            path = self._build_path(proxy)
+
+        self._current_proxy = proxy
+
+        if self._prefetch:
+            self._start_prefetch()
+
+        return path
+
+    def _start_prefetch(self):
+        with self._spare_lock:
+            if self._spare is not None or self._spare_pending:
+                return
+            self._spare_pending = True
+
+        threading.Thread(target=self._prepare_spare, daemon=True).start()
+
+    def _prepare_spare(self):
+        spare = None
+        try:
+            # без ожидания и без прокси из черного списка - запасной прокси не должен мешать другим потокам
+            proxy, _ = self._proxies_pool.try_acquire(
+                target=self._pool_target, allow_blacklisted=False, priority=self._pool_priority,
+                where=self._pool_where,
+            )
+            if proxy is None:
+                return
+
+            try:
+                path = self._build_path(proxy)
+                spare = _Spare(proxy, path, self._new_adapter(path))
+            except Exception:
+                self._proxies_pool.return_unused(proxy)
+                raise
+
+            spare.timer = threading.Timer(self._prefetch_ttl, _expire_spare, args=(weakref.ref(self), spare))
+            spare.timer.daemon = True
+
+            with self._spare_lock:
+                self._spare = spare
+            spare.timer.start()
+        finally:
+            with self._spare_lock:
+                self._spare_pending = False
+
+    def _take_spare(self):
+        with self._spare_lock:
+            spare, self._spare = self._spare, None
+
+        if spare is not None:
+            spare.timer.cancel()
+
+        return spare
+
+    def _drop_spare(self, spare=None):
+        """Возвращает запасной прокси в пул
+
+        @param spare: вернуть, только если запасным все еще является указанный
+        """
+        with self._spare_lock:
+            if self._spare is None or (spare is not None and self._spare is not spare):
+                return
+            spare, self._spare = self._spare, None
+
+        spare.timer.cancel()
+        self._proxies_pool.return_unused(spare.proxy)
+
     @property
     def _path(self):
+        if self._pool is not None and self._pool_generation != self.proxies._fork_generation:
+            self._rebind_pool()
+
         if not self.__path:
-            self.__path = self._build_path(self._get_proxy())
+            self.__path = self._new_path()
         return self.__path
 
     def get_path(self):
         return self._path
 
+    def _is_path_built(self):
+        return bool(self.__path)
+
+    def _set_pool_proxy(self, proxy):
+        """Использует прокси, уже взятый из пула этой цепочки (см. `MultiChain`)
+        """
+        self._current_pool_proxy = proxy
+        self._current_proxy = proxy
+        self._prepared_adapter = None
+        self.__path = self._build_path(proxy)
+
     def switch(self, bad=False, holdout=None, bad_reason=None, lazy=False):
+        if bad and self._connection_pool is not None and self.__path:
+            self._connection_pool.evict(self.__path)
+
         self.__path.clear()
 
+        if self._gateway_breaker is not None:
+            if not bad:
+                if not self._gateway_breaker.is_open:
+                    # сбрасываем счетчик ошибок подряд
+                    self._gateway_breaker.record_success()
+            elif self._gateway_breaker.is_open:
+                # ошибка из-за шлюза, а не прокси - возвращаем прокси без охлаждения и черного списка
+                if self._current_pool_proxy:
+                    proxy, self._current_pool_proxy = self._current_pool_proxy, None
+                    self._proxies_pool.return_unused(proxy)
+            else:
+                # виноват может быть шлюз: проверяем его в фоне, не задерживая смену прокси,
+                # прокси остается взятым из пула до результата проверки
+                callback = None
+                if self._current_pool_proxy:
+                    proxy, self._current_pool_proxy = self._current_pool_proxy, None
+                    callback = functools.partial(
+                        _release_after_gateway_check, self._proxies_pool, proxy,
+                        holdout=holdout, bad_reason=bad_reason, target=self._pool_target,
+                    )
+
+                self._gateway_breaker.check_async(callback)
+
         if self._proxies_pool is not None:
             self._release_pool_proxy(bad, holdout, bad_reason)
 
         if not lazy:
-            self.__path = self._build_path(self._get_proxy())
+            self.__path = self._new_path()
+
+    def _new_adapter(self, path):
+        if self._connection_pool is not None:
+            return self._connection_pool.get(path)
 
-    def get_adapter(self):
         import socks.adapters
-        return socks.adapters.ChainedProxyHTTPAdapter(chain=self._path)
+        return socks.adapters.ChainedProxyHTTPAdapter(chain=path)
+
+    def get_adapter(self):
+        path = self._path
+
+        # адаптер, подготовленный вместе с запасным прокси
+        adapter, self._prepared_adapter = self._prepared_adapter, None
+        if adapter is not None:
+            return adapter
+
+        return self._new_adapter(path)
 
     def get_handler(self):
         import socks.handlers
@@ -726,6 +3134,26 @@ class Chain(IChain):
         session.mount('https://', adapter)
         return session
 
+    def record_usage(self, sent=0, received=0, requests=1):
+        self._record_proxy_usage(self._current_proxy, sent=sent, received=received, requests=requests)
+
+    def bind_usage(self):
+        return functools.partial(self._record_proxy_usage, self._current_proxy)
+
+    def pop_untraced_spans(self):
+        spans = list(self._untraced_spans)
+        self._untraced_spans.clear()
+        return spans
+
+    def _record_proxy_usage(self, proxy, sent=0, received=0, requests=1):
+        if proxy is None:
+            return
+
+        if self._proxies_pool is not None:
+            self._proxies_pool.record_usage(proxy, sent=sent, received=received, requests=requests)
+        else:
+            self.proxies.record_usage(proxy, sent=sent, received=received, requests=requests)
+
     @classmethod
     def from_config(cls, cfg):
         proxy_cfg_string = cfg.get('Прокси')
@@ -740,19 +3168,31 @@ class Chain(IChain):
 
 
 class MultiChain(IChain):
-    def __init__(self, *proxies_all, use_pool=True, pool_acquire_timeout=None):
-        if use_pool:
-            pool_kw = {'use_pool': True, 'pool_acquire_timeout': 1}
-        else:
-            pool_kw = {}
-
+    def __init__(
+        self, *proxies_all, use_pool=True, pool_acquire_timeout=None, weights=None, connection_pool=None,
+        gateway_breakers=None,
+    ):
+        """
+        @param proxies_all: `Proxies` или пары (`Proxies`, шлюз)
+        @param use_pool: (см. `Chain`)
+        @param pool_acquire_timeout: (см. `Chain`), время ожидания свободного прокси из любого пула
+        @param weights: веса пулов (в порядке `proxies_all`), по умолчанию - пул с наибольшим кол-вом свободных прокси
+        @param connection_pool: (см. `Chain`)
+        @param gateway_breakers: (см. `Chain`), пулы за недоступными шлюзами пропускаются
+        """
+        self._use_pool = use_pool
         self._pool_acquire_timeout = pool_acquire_timeout
 
         self._chains = collections.deque(
-           Chain(p, gw, **pool_kw)
+           Chain(p, gw, use_pool=use_pool, connection_pool=connection_pool, gateway_breakers=gateway_breakers)
            for p, gw in self._unwrap_proxies_all(proxies_all)
         )
 
+        if weights is not None:
+            weights = dict(zip(self._chains, weights))
+
+        self._weights = weights
+
     @staticmethod
     def _unwrap_proxies_all(proxies_all):
         for p in proxies_all:
@@ -765,27 +3205,62 @@ class MultiChain(IChain):
 
             yield p, gw
 
-    def _self_auto_rotate(func):
-        @functools.wraps(func)
-        def wrapped(self, *args, **kw):
-            start = time.perf_counter()
-            while True:
-                try:
-                    return func(self, *args, **kw)
-                except NoFreeProxies:
-                    self._rotate()  # FIXME: cycle rotate is normal?
-                    if (
-                        self._pool_acquire_timeout is not None and
-                        time.perf_counter() - start > self._pool_acquire_timeout
-                    ):
-                        raise
-        return wrapped
-
     @property
     def _current(self):
         return self._chains[-1]
 
+    def _make_current(self, chain):
+        self._chains.remove(chain)
+        self._chains.append(chain)
+
+    def _get_ordered_chains(self):
+        if self._weights is not None:
+            # случайный порядок пропорционально весам (Efraimidis-Spirakis)
+            return sorted(
+                self._chains,
+                key=lambda c: random.random() ** (1 / self._weights[c]) if self._weights[c] > 0 else -1,
+                reverse=True,
+            )
+
+        return sorted(self._chains, key=lambda c: c._proxies_pool.free_capacity, reverse=True)
+
+    def _acquire_any(self):
+        """Ждет свободный прокси сразу во всех пулах
+
+        @return: цепочка, для пула которой получен прокси, и сам прокси
+        """
+        def _attempts():
+            chains = [c for c in self._get_ordered_chains() if c._is_gateway_allowed()]
+            if not chains:
+                raise CircuitOpenError(*(c.proxy_gw for c in self._chains))
+
+            for chain in chains:
+                yield chain, chain._proxies_pool, {
+                    'target': chain._pool_target, 'where': chain._pool_where, 'key': chain._pool_key,
+                }
+
+        return _acquire_any(_attempts, timeout=self._pool_acquire_timeout)
+
+    def _ensure_current(self):
+        if not self._use_pool:
+            # цепочки за недоступными шлюзами пропускаем (если недоступны все - ошибку бросит `get_path`)
+            for _ in range(len(self._chains) - 1):
+                if self._current._is_path_built() or self._current._is_gateway_allowed():
+                    break
+                self._rotate()
+
+            self._current.get_path()
+            return
+
+        if self._current._is_path_built():
+            return
+
+        chain, proxy = self._acquire_any()
+        chain._set_pool_proxy(proxy)
+        self._make_current(chain)
+
     def get_path(self):
+        self._ensure_current()
         return self._current.get_path()
 
     def _rotate(self):
@@ -793,26 +3268,37 @@ class MultiChain(IChain):
 
     def switch(self, bad=False, holdout=None, bad_reason=None, lazy=False):
         self._current.switch(bad=bad, holdout=holdout, bad_reason=bad_reason, lazy=True)
-        self._rotate()
-        if not lazy:
-            self._enforce_current_path_build()
 
-    @_self_auto_rotate
-    def _enforce_current_path_build(self):
-        _ = self._current._path  # FIXME: ugly enforce path building after switching
+        if not self._use_pool:
+            if self._weights is not None:
+                self._make_current(self._get_ordered_chains()[0])
+            else:
+                self._rotate()
+
+        if not lazy:
+            self._ensure_current()
 
-    @_self_auto_rotate
     def get_adapter(self):
+        self._ensure_current()
         return self._current.get_adapter()
 
-    @_self_auto_rotate
     def get_handler(self):
+        self._ensure_current()
         return self._current.get_handler()
 
-    @_self_auto_rotate
     def wrap_session(self, session):
+        self._ensure_current()
         return self._current.wrap_session(session)
 
-    @_self_auto_rotate
-    def wrap_module(self, module):
-        return self._current.wrap_module(module)
+    def record_usage(self, sent=0, received=0, requests=1):
+        self._current.record_usage(sent=sent, received=received, requests=requests)
+
+    def bind_usage(self):
+        return self._current.bind_usage()
+
+    def pop_untraced_spans(self):
+        return [span for chain in self._chains for span in chain.pop_untraced_spans()]
+
+    def wrap_module(self, module, all_threads=False):
+        self._ensure_current()
+        return self._current.wrap_module(module, all_threads=all_threads)
@@ -1,5 +1,32 @@
-import cgi
+import time
+import queue
 import warnings
+import functools
+import threading
+import collections
+
+
+class ResponseTooLarge(Exception):
+    """Тело ответа превышает `max_size` (см. `Client.stream`)
+    """
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_content_type(value):
+    """Разбирает заголовок Content-Type (значения у ответов обычно повторяются - результат кэшируется)
+
+    @return: (тип в нижнем регистре, charset или None)
+    """
+    content_type, _, params = value.partition(';')
+
+    charset = None
+    for param in params.split(';'):
+        name, sep, param_value = param.partition('=')
+        if sep and name.strip().lower() == 'charset':
+            charset = param_value.strip().strip('\'"')
+            break
+
+    return content_type.strip().lower(), charset
 
 
 def get_encoding_from_headers(headers, rfc2616_missing_charset=None):
@@ -15,10 +42,10 @@ def get_encoding_from_headers(headers, rfc2616_missing_charset=None):
     if not content_type:
         return None
 
-    content_type, params = cgi.parse_header(content_type)
+    content_type, charset = _parse_content_type(content_type)
 
-    if 'charset' in params:
-        return params['charset'].strip("'\"")
+    if charset is not None:
+        return charset
 
     if 'text' in content_type:
         if rfc2616_missing_charset is None:
@@ -29,6 +56,196 @@ def get_encoding_from_headers(headers, rfc2616_missing_charset=None):
     return None
 
 
+def _get_request_size(request):
+    """Примерный размер запроса в байтах: строка запроса, заголовки и тело (тело-итератор не учитывается)
+    """
+    size = len(request.method) + len(request.url) + 12
+    size += sum(len(name) + len(value) + 4 for name, value in request.headers.items())
+
+    if isinstance(request.body, (bytes, str)):
+        size += len(request.body)
+
+    return size
+
+
+def _get_response_size(resp, stream=False):
+    """Примерный размер ответа в байтах: заголовки и тело в том виде, в каком оно передавалось (до распаковки)
+
+    @param stream: тело еще не прочитано и не учитывается
+    """
+    size = 15 + sum(len(name) + len(value) + 4 for name, value in resp.headers.items())
+
+    if not stream:
+        tell = getattr(resp.raw, 'tell', None)
+        size += (tell() if tell is not None else 0) or len(resp.content or b'')
+
+    return size
+
+
+class StreamingResponse:
+    """Ответ, тело которого читается по частям и не накапливается в памяти (см. `Client.stream`)
+
+    Использование:
+        with client.stream('GET', url, max_size=100 * 2 ** 20) as resp:
+            with open('file.zip', 'wb') as f:
+                resp.write_to(f)
+
+    Закрытие до окончания чтения отменяет загрузку: если до конца тела осталось не больше `DRAIN_LIMIT` байт,
+    остаток дочитывается и соединение с прокси возвращается в пул сессии, иначе соединение закрывается.
+    """
+
+    DRAIN_LIMIT = 64 * 1024
+
+    def __init__(self, resp, max_size=None, chunk_size=64 * 1024, on_close=None):
+        """
+        @param resp: ответ `requests` с непрочитанным телом (`stream=True`)
+        @param max_size: максимальный размер тела (после распаковки), при превышении - `ResponseTooLarge`
+        @param chunk_size: размер части по умолчанию
+        @param on_close: функция, вызываемая с этим объектом после закрытия
+        """
+        self.response = resp
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+
+        self._on_close = on_close
+        self._consumed = False
+        self._closed = False
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    @property
+    def url(self):
+        return self.response.url
+
+    @property
+    def encoding(self):
+        return self.response.encoding
+
+    @property
+    def content_type(self):
+        value = self.headers.get('content-type')
+        return _parse_content_type(value)[0] if value else None
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def raise_for_status(self):
+        self.response.raise_for_status()
+
+    def _check_length(self):
+        if self.max_size is None or self.headers.get('content-encoding'):
+            return
+
+        length = self.headers.get('content-length')
+        if length and length.isdigit() and int(length) > self.max_size:
+            self.close()
+            raise ResponseTooLarge('Content-Length %s > %s' % (length, self.max_size))
+
+    def iter_content(self, chunk_size=None):
+        """
+        @raise ResponseTooLarge: тело больше `max_size` (ответ закрывается)
+        """
+        if self._closed:
+            raise RuntimeError('Response is closed')
+
+        self._check_length()
+
+        for chunk in self.response.iter_content(chunk_size or self.chunk_size):
+            self.bytes_read += len(chunk)
+            if self.max_size is not None and self.bytes_read > self.max_size:
+                self.close()
+                raise ResponseTooLarge('Body exceeds %s bytes' % self.max_size)
+
+            yield chunk
+
+        self._consumed = True
+
+    __iter__ = iter_content
+
+    def write_to(self, fileobj, chunk_size=None):
+        """Записывает тело в файл (поток) по частям
+
+        @return: кол-во записанных байт
+        """
+        written = 0
+        for chunk in self.iter_content(chunk_size):
+            fileobj.write(chunk)
+            written += len(chunk)
+
+        return written
+
+    def readinto(self, buffer, chunk_size=None):
+        """Читает тело в заранее выделенный буфер (bytearray, memoryview, mmap и т.д.)
+
+        @return: кол-во прочитанных байт
+        @raise ResponseTooLarge: тело не помещается в буфер
+        """
+        view = memoryview(buffer).cast('B')
+        size = len(view)
+
+        pos = 0
+        for chunk in self.iter_content(chunk_size):
+            end = pos + len(chunk)
+            if end > size:
+                self.close()
+                raise ResponseTooLarge('Body exceeds buffer size %s' % size)
+
+            view[pos:end] = chunk
+            pos = end
+
+        return pos
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        raw = self.response.raw
+        if self._consumed or self._drain(raw):
+            # соединение остается открытым и возвращается в пул
+            raw.release_conn()
+        else:
+            self.response.close()
+
+        if self._on_close is not None:
+            self._on_close(self)
+
+    def _drain(self, raw):
+        length = self.headers.get('content-length')
+        if not length or not length.isdigit() or not hasattr(raw, 'drain_conn'):
+            return False
+
+        if int(length) - raw.tell() > self.DRAIN_LIMIT:
+            return False
+
+        try:
+            raw.drain_conn()
+        except Exception:
+            return False
+
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _close_session(session):
+    # original requests session does not have `closed` attr
+    session._proxy_sw_closed = True
+    session.close()
+
+
 class _RequestsClient:
     def __init__(self, proxy_chain=None, default_headers=None):
         default_headers_ = self._make_default_headers()
@@ -45,14 +262,17 @@ class _RequestsClient:
             'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:40.0) Gecko/20100101 Firefox/40.0',
         }
 
-    def _new_sess(self):
+    def _new_sess(self, proxy_chain=None):
         import requests
 
+        if proxy_chain is None:
+            proxy_chain = self.proxy_chain
+
         session = requests.Session()
         if self.default_headers is not None:
             session.headers.update(self.default_headers)
-        if self.proxy_chain:
-            self.proxy_chain.wrap_session(session)
+        if proxy_chain:
+            proxy_chain.wrap_session(session)
 
         return session
 
@@ -70,16 +290,18 @@ class _RequestsClient:
 
             self._session = self._new_sess()
         finally:
-            # original requests session does not have `closed` attr
-            old_session._proxy_sw_closed = True
-            old_session.close()
+            _close_session(old_session)
 
 
 class Client(_RequestsClient):
+    HEDGE_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'))
+    HEDGE_MIN_SAMPLES = 20
+
     def __init__(
         self, ssl_verify=False, timeout=10, apparent_encoding=None, rfc2616_missing_charset=False,
         raise_conn_problem=True, raise_for_status=False,
-        request_logger=None, **kw
+        request_logger=None, hedge_after=None, hedge_percentile=None, hedge_window=1000, hedge_holdout=60,
+        hedge_workers=4, tracer=None, **kw
     ):
         """
         @param ssl_verify: (см. Session.request)
@@ -89,6 +311,15 @@ class Client(_RequestsClient):
             False - `apparent_encoding` по возможности
         @param raise_for_status: надо ли вызывать resp.raise_for_status при получении ответа
         @param request_logger: request_logging.Logger для логирования запросов
+        @param hedge_after (сек.): если ответ на идемпотентный запрос не получен за указанное время,
+            запрос будет продублирован через другой прокси из того же пула (используется первый ответ)
+        @param hedge_percentile: вычислять `hedge_after` как указанный процентиль (0-100)
+            времени ответа последних `hedge_window` запросов (`hedge_after` - значение, пока данных мало)
+        @param hedge_holdout (сек.): прокси, ответивший позже дублирующего запроса, возвращается в пул
+            с этим охлаждением (None - без охлаждения)
+        @param hedge_workers: максимум одновременно выполняемых потоков для основного и дублирующего запросов
+            (в т.ч. еще не завершившихся проигравших), при нехватке запрос не дублируется
+        @param tracer: tracing.Tracer для трассировки запросов
         """
         if 'request_logging' in kw:
             kw.pop('request_logging', None)
@@ -108,6 +339,7 @@ class Client(_RequestsClient):
 
         # _new_sess override require
         self._request_logger = request_logger
+        self._tracer = tracer
 
         super().__init__(**kw)
 
@@ -119,15 +351,80 @@ class Client(_RequestsClient):
         self._raise_conn_problem = raise_conn_problem
         self._raise_for_status = raise_for_status
 
-    def _new_sess(self):
-        session = super()._new_sess()
+        self.hedge_after = hedge_after
+        self.hedge_percentile = hedge_percentile
+        self._latencies = collections.deque(maxlen=hedge_window)
+        self.hedge_holdout = hedge_holdout
+        self._hedge_slots = threading.BoundedSemaphore(hedge_workers)
+        self._hedge_workers = hedge_workers
+        self._hedge_executor = None
+
+    def _new_sess(self, proxy_chain=None):
+        session = super()._new_sess(proxy_chain=proxy_chain)
 
         if self._request_logger:
             from . import request_logging
             request_logging.add_session_send_logging(session, logger=self._request_logger)
 
+        if self._tracer is not None:
+            if proxy_chain is None:
+                proxy_chain = self.proxy_chain
+
+            # цепочка, через которую сессия отправляет запросы (уже построена при создании сессии);
+            # запоминаем копию - цепочка сессии не меняется, даже если `proxy_chain` сменит прокси
+            path = tuple(proxy_chain.get_path()) if proxy_chain else None
+            session.hooks['response'].append(functools.partial(self._trace_response_hook, path))
+
         return session
 
+    @staticmethod
+    def _trace_response_hook(path, resp, **kw):
+        from . import tracing
+
+        resp._proxy_sw_path = path
+
+        trace = tracing.get_current_trace()
+        if trace is not None:
+            # хук вызывается сразу после получения заголовков, до чтения тела ответа
+            now = time.perf_counter()
+            ttfb = resp.elapsed.total_seconds()
+            trace.add_span('ttfb', now - ttfb, ttfb, status=resp.status_code)
+            resp._proxy_sw_headers_at = now
+
+    @staticmethod
+    def _trace_response(trace, resp, end, stream=False):
+        headers_at = getattr(resp, '_proxy_sw_headers_at', None)
+        if headers_at is not None and not stream:
+            trace.add_span('download', headers_at, end - headers_at)
+
+        path = getattr(resp, '_proxy_sw_path', None)
+        if path:
+            trace.tags['chain'] = ' > '.join(path)
+            trace.tags['proxy'] = path[-1]
+
+    @staticmethod
+    def _record_usage(record_usage, resp, stream=False):
+        """
+        @param record_usage: `IChain.record_usage` или функция из `IChain.bind_usage`, None - не учитывать
+        """
+        if record_usage is None:
+            return
+
+        # перенаправления - отдельные запросы через тот же прокси
+        sent = received = 0
+        for item in resp.history + [resp]:
+            sent += _get_request_size(item.request)
+            received += _get_response_size(item, stream=stream and item is resp)
+
+        record_usage(sent=sent, received=received, requests=len(resp.history) + 1)
+
+    @staticmethod
+    def _record_stream_usage(record_usage, stream_resp):
+        # заголовки учтены при запросе, здесь - прочитанная часть тела
+        tell = getattr(stream_resp.response.raw, 'tell', None)
+        received = tell() if tell is not None else stream_resp.bytes_read
+        record_usage(received=received, requests=0)
+
     def _setdefault_resp_encoding(self, resp):
         if not self.rfc2616_missing_charset:
             resp.encoding = get_encoding_from_headers(resp.headers, self.apparent_encoding)
@@ -144,29 +441,212 @@ class Client(_RequestsClient):
 
         super().switch_session(bad=bad, holdout=holdout, bad_reason=bad_reason)
 
+    def _get_hedge_threshold(self):
+        threshold = self.hedge_after
+
+        if self.hedge_percentile is not None and len(self._latencies) >= self.HEDGE_MIN_SAMPLES:
+            latencies = sorted(self._latencies)
+            idx = min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))
+            threshold = latencies[idx]
+
+        return threshold
+
+    def _can_hedge(self, method):
+        from . import chain
+
+        return (
+            (self.hedge_after is not None or self.hedge_percentile is not None) and
+            method.upper() in self.HEDGE_METHODS and
+            isinstance(self.proxy_chain, chain.Chain) and
+            self.proxy_chain._proxies_pool is not None
+        )
+
+    def _submit_hedge(self, fn, *args):
+        """Запускает `fn` в потоке для дублируемых запросов
+
+        @return: False - все `hedge_workers` потоков заняты
+        """
+        if not self._hedge_slots.acquire(blocking=False):
+            return False
+
+        if self._hedge_executor is None:
+            import concurrent.futures
+            self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._hedge_workers, thread_name_prefix='proxy_switcher-hedge',
+            )
+
+        def _run():
+            try:
+                fn(*args)
+            finally:
+                self._hedge_slots.release()
+
+        try:
+            self._hedge_executor.submit(_run)
+        except BaseException:
+            self._hedge_slots.release()
+            raise
+
+        return True
+
+    def _hedged_request(self, method, url, trace=None, **kw):
+        """Выполняет запрос, при необходимости дублируя его через второй прокси из пула.
+
+        Используется первый полученный ответ, проигравший запрос отменяется (закрытием сессии).
+        Прокси дублирующего запроса возвращается в пул, если он проиграл, а прокси основного -
+        с охлаждением `hedge_holdout` (следующий запрос клиента пойдет через другой прокси).
+        """
+        threshold = self._get_hedge_threshold()
+        results = queue.Queue()
+
+        def _run(session, record_usage):
+            if trace is not None:
+                trace.activate()
+            try:
+                resp = session.request(method, url, **kw)
+                self._record_usage(record_usage, resp)
+                results.put((session, resp, None))
+            except Exception as exc:
+                results.put((session, None, exc))
+            finally:
+                if trace is not None:
+                    trace.deactivate()
+
+        primary = self.session
+        # учитываем трафик на прокси, через который запрос выполнялся, даже если цепочка уже сменила его
+        if not self._submit_hedge(_run, primary, self.proxy_chain.bind_usage()):
+            resp = primary.request(method, url, **kw)
+            self._record_usage(self.proxy_chain.record_usage, resp)
+            return resp
+
+        try:
+            session, resp, exc = results.get(timeout=threshold)
+        except queue.Empty:
+            pass
+        else:
+            if exc is not None:
+                raise exc
+            return resp
+
+        # другой прокси не из черного списка, без ожидания; если такого нет - не дублируем
+        hedge = None
+        hedge_chain = self.proxy_chain.clone_alternate()
+        if hedge_chain is not None:
+            try:
+                hedge = self._new_sess(proxy_chain=hedge_chain)
+            except Exception:
+                hedge_chain.finalize()
+                raise
+
+            if not self._submit_hedge(_run, hedge, hedge_chain.bind_usage()):
+                _close_session(hedge)
+                hedge_chain.finalize()
+                hedge = None
+
+        if hedge is None:
+            session, resp, exc = results.get()
+            if exc is not None:
+                raise exc
+            return resp
+
+        if trace is not None:
+            trace.tags['hedged'] = True
+
+        try:
+            session, resp, exc = results.get()
+            if exc is not None:
+                # первый запрос завершился ошибкой, ждем второй
+                session, resp, _ = results.get()
+                if resp is None:
+                    raise exc
+
+            return resp
+        finally:
+            _close_session(hedge)
+            if session is hedge and resp is not None:
+                # отменяем "медленный" запрос, а его прокси возвращаем в пул с охлаждением -
+                # сессия с другим прокси будет создана при следующем запросе
+                _close_session(primary)
+                self.proxy_chain.switch(holdout=self.hedge_holdout, lazy=True)
+            hedge_chain.finalize()
+
     def request(self, method, url, headers=None, data=None, **kw):
         from _УтилитыSbis import conn_problem_detector
 
         self._update_params_defaults(kw)
 
+        trace = None
+        if self._tracer is not None:
+            trace = self._tracer.start_trace(method=method, url=url)
+
+            # прокси мог быть получен до запроса (`switch_session`), интервалы отбрасываются и для
+            # запросов вне выборки, чтобы не попасть в трассу другого запроса
+            untraced = self.proxy_chain.pop_untraced_spans() if self.proxy_chain else ()
+            if trace is not None:
+                for name, start, duration, tags in untraced:
+                    trace.add_span(name, start, duration, **tags)
+
         def _request():
-            resp = self.session.request(
-                method, url, headers=headers, data=data, **kw
-            )
+            start = time.perf_counter()
+
+            if self._can_hedge(method) and not kw.get('stream'):
+                resp = self._hedged_request(method, url, trace=trace, headers=headers, data=data, **kw)
+            else:
+                resp = self.session.request(
+                    method, url, headers=headers, data=data, **kw
+                )
+                if self.proxy_chain:
+                    self._record_usage(self.proxy_chain.record_usage, resp, stream=kw.get('stream', False))
+
+            end = time.perf_counter()
+            self._latencies.append(end - start)
+
+            if trace is not None:
+                self._trace_response(trace, resp, end, stream=kw.get('stream', False))
+
             if self._raise_for_status:
                 resp.raise_for_status()
 
             return resp
 
-        if self._raise_conn_problem:
-            with conn_problem_detector():
+        if trace is not None:
+            trace.activate()
+
+        try:
+            if self._raise_conn_problem:
+                with conn_problem_detector():
+                    resp = _request()
+            else:
                 resp = _request()
-        else:
-            resp = _request()
+        except Exception as exc:
+            if trace is not None:
+                trace.tags['error'] = repr(exc)
+            raise
+        finally:
+            if trace is not None:
+                trace.deactivate()
+                trace.finish()
 
         self._setdefault_resp_encoding(resp)
         return resp
 
+    def stream(self, method, url, max_size=None, chunk_size=64 * 1024, **kw):
+        """Выполняет запрос, не загружая тело ответа в память
+
+        @param max_size: максимальный размер тела, при превышении чтение прерывается (`ResponseTooLarge`)
+        @param chunk_size: размер части по умолчанию
+        @return: StreamingResponse (закрывается явно или через `with`)
+        """
+        kw['stream'] = True
+        resp = self.request(method, url, **kw)
+
+        on_close = None
+        if self.proxy_chain:
+            # тело может дочитываться уже после смены прокси цепочки - учитываем на прокси, ответивший на запрос
+            on_close = functools.partial(self._record_stream_usage, self.proxy_chain.bind_usage())
+
+        return StreamingResponse(resp, max_size=max_size, chunk_size=chunk_size, on_close=on_close)
+
     def get(self, url, **kwargs):
         kwargs.setdefault('allow_redirects', True)
         return self.request('GET', url, **kwargs)
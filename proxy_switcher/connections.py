@@ -0,0 +1,127 @@
+import threading
+import collections
+
+from . import utils
+
+
+class _SharedAdapter:
+    """Адаптер сессии, использующий общий адаптер из `AdapterPool`
+
+    Закрытие сессии (`Client.switch_session`) не закрывает соединения - ими управляет пул.
+    """
+
+    def __init__(self, pool, key, adapter):
+        self._pool = pool
+        self._key = key
+        self._adapter = adapter
+
+    def send(self, request, **kw):
+        self._pool._touch(self._key)
+        return self._adapter.send(request, **kw)
+
+    def close(self):
+        pass
+
+
+class AdapterPool:
+    """Общие для всех цепочек адаптеры (и их соединения) по цепочкам адресов
+
+    Соединения через шлюз и прокси до ресурса (keep-alive) переиспользуются сессиями
+    разных `Chain`/`MultiChain` с той же цепочкой, в т.ч. после смены прокси и возврата к прежнему.
+    Проверку разорванных соединений перед повторным использованием выполняет urllib3.
+
+    Использование:
+        connection_pool = proxy_switcher.connections.AdapterPool(max_adapters=512, idle_ttl=120)
+        proxy_chain = proxy_switcher.chain.Chain(proxies, proxy_gw=gw, use_pool=True, connection_pool=connection_pool)
+    """
+
+    def __init__(self, max_adapters=256, idle_ttl=300, clock=None):
+        """
+        @param max_adapters: максимальное кол-во цепочек, давно не используемые закрываются
+        @param idle_ttl (сек.): цепочки, не используемые указанное время, закрываются
+        @param clock: источник времени (см. `utils.SystemClock`)
+        """
+        self.max_adapters = max_adapters
+        self.idle_ttl = idle_ttl
+
+        self._clock = clock or utils.SystemClock()
+        # цепочка -> [адаптер, время последнего использования], от давно используемых к недавним
+        self._adapters = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._next_sweep = None
+
+    @staticmethod
+    def _new_adapter(path):
+        import socks.adapters
+        return socks.adapters.ChainedProxyHTTPAdapter(chain=list(path))
+
+    def get(self, path):
+        """
+        @param path: цепочка адресов (см. `chain.build_path`)
+        @return: адаптер для `requests.Session.mount`
+        """
+        key = tuple(path)
+        now = self._clock.time()
+
+        with self._lock:
+            closed = self._sweep(now)
+
+            item = self._adapters.get(key)
+            if item is None:
+                item = self._adapters[key] = [self._new_adapter(key), now]
+                while len(self._adapters) > self.max_adapters:
+                    closed.append(self._adapters.popitem(last=False)[1][0])
+            else:
+                item[1] = now
+                self._adapters.move_to_end(key)
+
+        self._close(closed)
+        return _SharedAdapter(self, key, item[0])
+
+    def _touch(self, key):
+        with self._lock:
+            item = self._adapters.get(key)
+            if item is not None:
+                item[1] = self._clock.time()
+                self._adapters.move_to_end(key)
+
+    def _sweep(self, now):
+        if self._next_sweep is not None and now < self._next_sweep:
+            return []
+
+        self._next_sweep = now + self.idle_ttl / 4
+
+        closed = []
+        while self._adapters:
+            key, (adapter, last_used) = next(iter(self._adapters.items()))
+            if now - last_used < self.idle_ttl:
+                break
+
+            del self._adapters[key]
+            closed.append(adapter)
+
+        return closed
+
+    @staticmethod
+    def _close(adapters):
+        for adapter in adapters:
+            adapter.close()
+
+    def evict(self, path):
+        """Закрывает соединения цепочки (например, прокси помещен в черный список)
+        """
+        with self._lock:
+            item = self._adapters.pop(tuple(path), None)
+
+        if item is not None:
+            item[0].close()
+
+    def close(self):
+        with self._lock:
+            adapters = [adapter for adapter, _ in self._adapters.values()]
+            self._adapters.clear()
+
+        self._close(adapters)
+
+    def __len__(self):
+        return len(self._adapters)
@@ -0,0 +1,215 @@
+import queue
+import threading
+import collections
+
+from . import chain
+from . import client
+
+
+TaskResult = collections.namedtuple('TaskResult', 'item result exc')
+
+_STOP = object()
+_DONE = object()
+
+
+class _WorkerError:
+    """Ошибка потока вне выполнения задачи (см. `PoolExecutor.map`)
+    """
+
+    __slots__ = ('exc',)
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def is_proxy_error(exc):
+    """Ошибка, вызванная прокси (соединение, таймаут), а не задачей или ответом ресурса
+
+    Используется `PoolExecutor` по умолчанию: только после таких ошибок прокси помещается в черный список
+    и задача повторяется.
+    """
+    import requests
+
+    if isinstance(exc, requests.exceptions.RequestException):
+        # в т.ч. ProxyError, SSLError, ConnectTimeout, ReadTimeout
+        return isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+    # ошибки сокета и SOCKS-прокси при использовании цепочки без requests
+    return isinstance(exc, OSError)
+
+
+def _put(q, item, stop):
+    """Кладет элемент в ограниченную очередь, пока не выставлен флаг остановки
+
+    @return: True - элемент добавлен, False - выполнение остановлено
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+class PoolExecutor:
+    """Параллельное выполнение задач через пул прокси.
+
+    Каждый поток владеет собственными `Chain(use_pool=True)` и `Client`,
+    кол-во потоков не превышает емкость пула - кол-во прокси с учетом 'max_leases'
+    (лишние потоки все равно ждали бы в пуле).
+
+    Использование:
+        executor = proxy_switcher.executor.PoolExecutor(proxies, proxy_gw=gw, max_workers=50)
+
+        for item, resp, exc in executor.fetch(urls):
+            ...
+
+        for item, result, exc in executor.map(lambda client, url: client.get(url).json(), urls):
+            ...
+
+    Результаты возвращаются в порядке завершения задач.
+    При ошибке прокси (см. `is_proxy_error`) прокси помещается в черный список (`Client.switch_session(bad=True)`)
+    и задача повторяется не более `retries` раз, остальные ошибки возвращаются сразу без смены прокси.
+    """
+
+    def __init__(
+        self, proxies, proxy_gw=None, max_workers=10, queue_size=None, retries=2,
+        rotate=False, holdout=None, pool_acquire_timeout=None, client_kw=None, is_proxy_error=is_proxy_error,
+    ):
+        """
+        @param proxies: `chain.Proxies`, используемый как пул
+        @param proxy_gw: шлюз (см. `Chain`)
+        @param max_workers: максимальное кол-во потоков
+        @param queue_size: размер очереди задач и результатов (по умолчанию - удвоенное кол-во потоков)
+        @param retries: кол-во повторов задачи при ошибке
+        @param rotate: менять прокси после каждой успешной задачи
+        @param holdout (сек.): время охлаждения прокси при смене (см. `Chain.switch`)
+        @param pool_acquire_timeout: (см. `Chain`)
+        @param client_kw: параметры для `client.Client`
+        @param is_proxy_error: функция (исключение) -> True, если ошибка вызвана прокси
+        """
+        self.proxies = proxies
+        self.proxy_gw = proxy_gw
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.retries = retries
+        self.rotate = rotate
+        self.holdout = holdout
+        self.pool_acquire_timeout = pool_acquire_timeout
+        self.client_kw = client_kw or {}
+        self.is_proxy_error = is_proxy_error
+
+    def _get_workers_count(self):
+        return max(1, min(self.max_workers, self.proxies.get_pool().capacity))
+
+    def _new_client(self):
+        proxy_chain = chain.Chain(
+            self.proxies, proxy_gw=self.proxy_gw,
+            use_pool=True, pool_acquire_timeout=self.pool_acquire_timeout,
+        )
+        return client.Client(proxy_chain=proxy_chain, **self.client_kw)
+
+    def _run_task(self, cli, fn, item):
+        exc = None
+
+        for _ in range(self.retries + 1):
+            try:
+                result = fn(cli, item)
+            except Exception as e:
+                exc = e
+
+                if not self.is_proxy_error(e):
+                    break
+            else:
+                if self.rotate:
+                    try:
+                        cli.switch_session(holdout=self.holdout)
+                    except chain.NoFreeProxies:
+                        pass  # прокси будет получен при выполнении следующей задачи
+                return TaskResult(item, result, None)
+
+            try:
+                cli.switch_session(bad=True, holdout=self.holdout, bad_reason=repr(exc))
+            except chain.NoFreeProxies as e:
+                # повторить не на чем - возвращаем и причину, и ошибку задачи
+                e.__cause__ = exc
+                exc = e
+                break
+
+        return TaskResult(item, None, exc)
+
+    def _worker(self, fn, tasks, results, stop):
+        cli = None
+        try:
+            cli = self._new_client()
+
+            while not stop.is_set():
+                try:
+                    item = tasks.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if item is _STOP:
+                    break
+
+                if not _put(results, self._run_task(cli, fn, item), stop):
+                    break
+        except Exception as exc:
+            # `map` пробросит ошибку (например, неверные `client_kw`), а не будет ждать завершения потока
+            _put(results, _WorkerError(exc), stop)
+        finally:
+            if cli is not None:
+                if cli._session is not None:
+                    cli._session.close()
+                cli.proxy_chain.finalize()
+            _put(results, _DONE, stop)
+
+    def _feeder(self, items, tasks, stop, workers_count):
+        try:
+            for item in items:
+                if not _put(tasks, item, stop):
+                    break
+        finally:
+            for _ in range(workers_count):
+                _put(tasks, _STOP, stop)
+
+    def map(self, fn, items):
+        """Выполняет `fn(client, item)` для каждого элемента `items`
+
+        @return: итератор `TaskResult(item, result, exc)` в порядке завершения задач
+        @raise: ошибка создания клиента в потоке (например, неверные `client_kw` или опции пула)
+        """
+        workers_count = self._get_workers_count()
+        queue_size = self.queue_size or workers_count * 2
+
+        tasks = queue.Queue(maxsize=queue_size)
+        results = queue.Queue(maxsize=queue_size)
+        stop = threading.Event()
+
+        threading.Thread(target=self._feeder, args=(items, tasks, stop, workers_count), daemon=True).start()
+
+        for _ in range(workers_count):
+            threading.Thread(target=self._worker, args=(fn, tasks, results, stop), daemon=True).start()
+
+        done = 0
+        try:
+            while done < workers_count:
+                result = results.get()
+                if result is _DONE:
+                    done += 1
+                    continue
+
+                if isinstance(result, _WorkerError):
+                    raise result.exc
+
+                yield result
+        finally:
+            stop.set()
+
+    def fetch(self, urls, method='GET', **kw):
+        """Выполняет запрос для каждой ссылки (см. `map`)
+        """
+        return self.map(lambda cli, url: cli.request(method, url, **kw), urls)
+
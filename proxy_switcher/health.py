@@ -0,0 +1,124 @@
+import time
+import threading
+import urllib.request
+import concurrent.futures
+
+from . import chain
+
+
+def probe(proxy, url, proxy_gw=None, timeout=5):
+    """Проверяет работоспособность прокси запросом на `url`
+
+    @return: время ответа в секундах или None, если прокси не работает
+    """
+    import socks.handlers
+
+    handler = socks.handlers.ChainProxyHandler(chain=chain.build_path(proxy, proxy_gw))
+    opener = urllib.request.build_opener(handler)
+
+    start = time.perf_counter()
+    try:
+        with opener.open(url, timeout=timeout) as resp:
+            resp.read()
+    except Exception:
+        return None
+
+    return time.perf_counter() - start
+
+
+def probe_many(proxies, url, proxy_gw=None, timeout=5, max_workers=10):
+    """Параллельно проверяет список прокси (не более `max_workers` одновременно)
+
+    @return: генератор пар (прокси, время ответа или None) в порядке завершения проверок
+    """
+    if not proxies:
+        return
+
+    max_workers = min(max_workers, len(proxies))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(probe, proxy, url, proxy_gw=proxy_gw, timeout=timeout): proxy
+            for proxy in proxies
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+
+
+class HealthChecker:
+    """Фоновая проверка прокси из черного списка.
+
+    Прокси проверяются параллельно (не более `max_workers` одновременно) запросом на `probe_url`
+    через ту же цепочку, что использует `Chain` (с учетом шлюза).
+    Прошедшие проверку прокси изымаются из черного списка и возвращаются в пул,
+    не дожидаясь пока пул сам отдаст их "в последнюю очередь".
+
+    Использование:
+        checker = proxy_switcher.health.HealthChecker(proxies, 'http://myip.ru', proxy_gw=gw, interval=60)
+        checker.start()
+        ...
+        checker.stop()
+    """
+
+    def __init__(self, proxies, probe_url, proxy_gw=None, interval=60, max_workers=10, timeout=5):
+        """
+        @param proxies: `chain.Proxies`, с пулом которого необходимо работать
+        @param probe_url: ссылка, по которой проверяется работоспособность прокси
+        @param proxy_gw: шлюз (см. `Chain`)
+        @param interval (сек.): период между проверками
+        @param max_workers: максимальное кол-во одновременных проверок
+        @param timeout (сек.): таймаут одной проверки
+        """
+        self.proxies = proxies
+        self.probe_url = probe_url
+        self.proxy_gw = proxy_gw
+        self.interval = interval
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self):
+        """Выполняет один цикл проверки
+
+        @return: список прокси, возвращенных в пул
+        """
+        pool = self.proxies.get_pool()
+        candidates = pool.probe_candidates()
+
+        recovered = []
+
+        results = probe_many(
+            candidates, self.probe_url, proxy_gw=self.proxy_gw,
+            timeout=self.timeout, max_workers=self.max_workers,
+        )
+        for proxy, latency in results:
+            if pool.report_probe(proxy, alive=latency is not None):
+                recovered.append(proxy)
+
+        return recovered
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                import problems
+                problems.error()
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ProxyHealthChecker', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        if self._thread is None:
+            return
+
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
@@ -0,0 +1,573 @@
+import time
+import random
+import socket
+import struct
+import select
+import itertools
+import threading
+import collections
+import socketserver
+import http.server
+import urllib.parse
+
+from . import chain
+
+
+_BUFFER_SIZE = 64 * 1024
+
+# коды ответа SOCKS5
+_SOCKS_OK = 0
+_SOCKS_FAILURE = 1
+_SOCKS_NOT_ALLOWED = 2
+
+_HTTP_FAILURE = b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+_HTTP_BANNED = b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+OK = 'ok'
+FAILED = 'failed'
+BANNED = 'banned'
+
+# коды ответа, которыми ресурс (или прокси) сообщает о бане прокси
+BAN_STATUSES = (403, 429)
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed by client')
+        data += chunk
+
+    return data
+
+
+def _recv_head(sock):
+    """Читает заголовок HTTP-запроса
+
+    @return: (заголовок без завершающей пустой строки, прочитанное сверх заголовка)
+    """
+    data = b''
+    while b'\r\n\r\n' not in data:
+        chunk = sock.recv(_BUFFER_SIZE)
+        if not chunk:
+            raise ConnectionError('Connection closed by client')
+        data += chunk
+
+    head, _, rest = data.partition(b'\r\n\r\n')
+    return head, rest
+
+
+class _Throttle:
+    """Ограничение скорости передачи (байт/сек.) для одного соединения
+    """
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self._start = time.monotonic()
+        self._sent = 0
+
+    def consume(self, size):
+        if not self.bandwidth:
+            return
+
+        self._sent += size
+        delay = self._sent / self.bandwidth - (time.monotonic() - self._start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _ProxyHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        proxy = self.server.fake_proxy
+        sock = self.request
+
+        try:
+            first = sock.recv(1, socket.MSG_PEEK)
+            if not first:
+                return
+
+            if first == b'\x05':
+                upstream, first_data = self._handle_socks5(proxy, sock), b''
+            else:
+                upstream, first_data = self._handle_http(proxy, sock)
+        except (OSError, ValueError):
+            return
+
+        if upstream is not None:
+            with upstream:
+                _relay(proxy, sock, upstream, first_data)
+
+    @staticmethod
+    def _handle_socks5(proxy, sock):
+        _, methods_count = _recv_exact(sock, 2)
+        methods = _recv_exact(sock, methods_count)
+
+        if b'\x00' in methods:
+            sock.sendall(b'\x05\x00')
+        elif b'\x02' in methods:
+            # логин и пароль принимаются любые
+            sock.sendall(b'\x05\x02')
+            _, login_size = _recv_exact(sock, 2)
+            _recv_exact(sock, login_size)
+            password_size, = _recv_exact(sock, 1)
+            _recv_exact(sock, password_size)
+            sock.sendall(b'\x01\x00')
+        else:
+            sock.sendall(b'\x05\xff')
+            return None
+
+        _, command, _, address_type = _recv_exact(sock, 4)
+        if address_type == 1:
+            host = socket.inet_ntop(socket.AF_INET, _recv_exact(sock, 4))
+        elif address_type == 4:
+            host = socket.inet_ntop(socket.AF_INET6, _recv_exact(sock, 16))
+        else:
+            host = _recv_exact(sock, _recv_exact(sock, 1)[0]).decode('idna')
+        port, = struct.unpack('!H', _recv_exact(sock, 2))
+
+        def _reply(code):
+            sock.sendall(struct.pack('!BBBB4sH', 5, code, 0, 1, b'\x00' * 4, 0))
+
+        if command != 1:  # только CONNECT
+            _reply(_SOCKS_FAILURE)
+            return None
+
+        if proxy._check_banned():
+            _reply(_SOCKS_NOT_ALLOWED)
+            return None
+
+        try:
+            upstream = socket.create_connection((host, port), timeout=proxy.connect_timeout)
+        except OSError:
+            _reply(_SOCKS_FAILURE)
+            return None
+
+        upstream.settimeout(None)
+        _reply(_SOCKS_OK)
+        return upstream
+
+    @staticmethod
+    def _handle_http(proxy, sock):
+        head, rest = _recv_head(sock)
+        request_line, _, headers = head.partition(b'\r\n')
+        method, target, version = request_line.decode('latin-1').split(' ', 2)
+
+        if proxy._check_banned():
+            sock.sendall(_HTTP_BANNED)
+            return None, b''
+
+        if method.upper() == 'CONNECT':
+            host, _, port = target.rpartition(':')
+            first_data = rest
+        else:
+            # запрос с абсолютным адресом - передаем ресурсу в обычном виде
+            parsed = urllib.parse.urlsplit(target)
+            host, port = parsed.hostname, parsed.port or 80
+            path = urllib.parse.urlunsplit(('', '', parsed.path or '/', parsed.query, ''))
+            first_data = ('%s %s %s\r\n' % (method, path, version)).encode('latin-1') + headers + b'\r\n\r\n' + rest
+
+        try:
+            upstream = socket.create_connection((host.strip('[]'), int(port)), timeout=proxy.connect_timeout)
+        except (OSError, ValueError):
+            sock.sendall(_HTTP_FAILURE)
+            return None, b''
+
+        upstream.settimeout(None)
+        if method.upper() == 'CONNECT':
+            sock.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+
+        return upstream, first_data
+
+
+def _relay(proxy, client, upstream, first_data=b''):
+    """Передает данные в обе стороны до закрытия одного из соединений
+
+    Запросом считается очередная порция данных от клиента после ответа ресурса
+    (соединения keep-alive несут несколько запросов; для TLS запросом считается и рукопожатие).
+    """
+    for sock in (client, upstream):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    throttle = _Throttle(proxy.bandwidth)
+    sockets = [client, upstream]
+    in_request = False
+
+    def _forward(data):
+        nonlocal in_request
+
+        if not in_request:
+            result = proxy._begin()
+            if result != OK:
+                if result == BANNED:
+                    client.sendall(_HTTP_BANNED)
+                return False
+            in_request = True
+
+        upstream.sendall(data)
+        return True
+
+    try:
+        if first_data and not _forward(first_data):
+            return
+
+        while True:
+            readable, _, _ = select.select(sockets, [], [])
+
+            for sock in readable:
+                data = sock.recv(_BUFFER_SIZE)
+                if not data:
+                    return
+
+                throttle.consume(len(data))
+
+                if sock is client:
+                    if not _forward(data):
+                        return
+                else:
+                    in_request = False
+                    client.sendall(data)
+    except OSError:
+        return
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class FakeProxy:
+    """Локальная заглушка прокси: SOCKS5 и HTTP (CONNECT и запросы с абсолютным адресом) на одном порту
+
+    Перед каждым запросом через прокси выдерживается `latency`, с вероятностью `failure_rate`
+    соединение обрывается, а после `ban_after` запросов прокси отвечает отказом, как забаненный
+    (HTTP 403, новые соединения SOCKS5 - "запрещено правилами").
+    Может использоваться и как шлюз (`Chain(proxy_gw=...)`).
+    """
+
+    def __init__(
+        self, proxy_type='socks5', latency=0, bandwidth=None, failure_rate=0, ban_after=None,
+        host='127.0.0.1', port=0, connect_timeout=5, seed=None,
+    ):
+        """
+        @param proxy_type: тип в адресе прокси ('socks5', 'http') - протокол определяется по первому байту
+        @param latency (сек.): задержка перед соединением с ресурсом
+        @param bandwidth (байт/сек.): ограничение скорости каждого соединения (None - без ограничения)
+        @param failure_rate: доля соединений, завершающихся ошибкой (0-1)
+        @param ban_after: после указанного кол-ва запросов все соединения отклоняются (None - не банить)
+        @param port: 0 - свободный порт
+        @param seed: зерно генератора ошибок
+        """
+        self.proxy_type = proxy_type
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.ban_after = ban_after
+        self.connect_timeout = connect_timeout
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+
+        self._server = _ThreadingTCPServer((host, port), _ProxyHandler, bind_and_activate=True)
+        self._server.fake_proxy = self
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return '%s://%s:%s' % (self.proxy_type, host, port)
+
+    def _check_banned(self):
+        """Проверяет бан при установке соединения (отклоненное соединение считается запросом)
+        """
+        with self._lock:
+            if self.ban_after is None or self._counters['requests'] < self.ban_after:
+                return False
+
+            self._counters['requests'] += 1
+            self._counters[BANNED] += 1
+            return True
+
+    def _begin(self):
+        with self._lock:
+            self._counters['requests'] += 1
+
+            if self.ban_after is not None and self._counters['requests'] > self.ban_after:
+                result = BANNED
+            elif self.failure_rate and self._random.random() < self.failure_rate:
+                result = FAILED
+            else:
+                result = OK
+
+            self._counters[result] += 1
+
+        if result == OK and self.latency:
+            time.sleep(self.latency)
+
+        return result
+
+    def get_stats(self):
+        """
+        @return: {'requests', 'ok', 'failed', 'banned'}
+        """
+        with self._lock:
+            return {key: self._counters[key] for key in ('requests', OK, FAILED, BANNED)}
+
+    def reset(self):
+        """Сбрасывает счетчики (в т.ч. бан)
+        """
+        with self._lock:
+            self._counters.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _TargetHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # заголовки и тело пишутся отдельно - без этого задержка подтверждений TCP добавляет ~40 мс к каждому ответу
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+
+        # /bytes/<размер> - тело указанного размера, иначе - `body_size`
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        size = server.body_size
+        if len(parts) == 2 and parts[0] == 'bytes' and parts[1].isdigit():
+            size = int(parts[1])
+
+        if server.delay:
+            time.sleep(server.delay)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+
+        chunk = b'x' * min(size, _BUFFER_SIZE)
+        while size > 0:
+            self.wfile.write(chunk[:size])
+            size -= len(chunk)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class TargetServer:
+    """Локальный HTTP-сервер - ресурс для нагрузочного теста
+    """
+
+    def __init__(self, body_size=1024, delay=0, host='127.0.0.1', port=0):
+        """
+        @param body_size: размер ответа по умолчанию (`/bytes/<размер>` - произвольный)
+        @param delay (сек.): время обработки запроса
+        """
+        self._server = http.server.ThreadingHTTPServer((host, port), _TargetHandler)
+        self._server.daemon_threads = True
+        self._server.body_size = body_size
+        self._server.delay = delay
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s/' % (host, port)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def is_proxy_error(exc):
+    """`executor.is_proxy_error` + ответы о бане (`BAN_STATUSES`): после бана прокси надо сменить,
+    а не считать ошибку ошибкой задачи
+    """
+    from . import executor
+    import requests
+
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        return exc.response.status_code in BAN_STATUSES
+
+    return executor.is_proxy_error(exc)
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Harness:
+    """Нагрузочный тест `Client` + `Chain` + пул без реальных прокси: локальные заглушки прокси,
+    (опционально) шлюз и ресурс, нагрузка - через `executor.PoolExecutor`
+
+    Использование:
+        with proxy_switcher.loadtest.Harness(proxies=20, latency=0.05, failure_rate=0.01, ban_after=200) as harness:
+            report = harness.run(requests=5000, workers=50, size=10000)
+
+        # прокси с разными характеристиками и цепочка через шлюз
+        profiles = [{'latency': 0.01}, {'latency': 0.5, 'bandwidth': 100000}]
+        with proxy_switcher.loadtest.Harness(proxies=profiles * 10, gateway=True) as harness:
+            ...
+    """
+
+    def __init__(self, proxies=10, gateway=False, options=None, target_kw=None, **proxy_kw):
+        """
+        @param proxies: кол-во прокси или список параметров `FakeProxy` для каждого
+        @param gateway: True или параметры `FakeProxy` - запросы идут через шлюз (`Chain(proxy_gw=...)`)
+        @param options: опции `chain.Proxies` (бюджеты, охлаждение, шарды и т.д.)
+        @param target_kw: параметры `TargetServer`
+        @param proxy_kw: параметры `FakeProxy`, общие для всех прокси
+        """
+        if isinstance(proxies, int):
+            proxies = [{}] * proxies
+
+        self.fake_proxies = [FakeProxy(**dict(proxy_kw, **kw)) for kw in proxies]
+        self.gateway = None
+        if gateway:
+            self.gateway = FakeProxy(**(gateway if isinstance(gateway, dict) else {}))
+        self.target = TargetServer(**(target_kw or {}))
+
+        self.options = options or {}
+        self.proxies = None
+
+    def start(self):
+        self.target.start()
+        for fake_proxy in self.fake_proxies:
+            fake_proxy.start()
+        if self.gateway is not None:
+            self.gateway.start()
+
+        self.proxies = chain.Proxies([fake_proxy.address for fake_proxy in self.fake_proxies], options=self.options)
+        return self
+
+    def stop(self):
+        for server in self.fake_proxies + [self.gateway, self.target]:
+            if server is not None:
+                server.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def run(self, requests=1000, workers=10, size=None, retries=2, client_kw=None, **executor_kw):
+        """Выполняет `requests` GET-запросов к ресурсу в `workers` потоков
+
+        @param size: размер ответа (None - `TargetServer.body_size`)
+        @param client_kw: параметры `client.Client`
+        @param executor_kw: параметры `executor.PoolExecutor` (rotate, holdout, pool_acquire_timeout...);
+            по умолчанию `is_proxy_error` - `loadtest.is_proxy_error` (бан считается ошибкой прокси)
+        @return: {'requests', 'succeeded', 'failed', 'duration', 'rps', 'latency': {'p50', 'p90', 'p99', 'max'},
+                  'errors': {тип ошибки: кол-во}, 'proxy_requests', 'ban_rate', 'failure_rate',
+                  'bad_switches': кол-во ошибок прокси (смен с помещением прокси в черный список),
+                  'pool_wait': `_Pool.get_wait_stats()` (None для пула с шардами)}
+        """
+        from . import executor
+
+        url = self.target.url
+        if size is not None:
+            url += 'bytes/%s' % size
+
+        bad_switches = collections.Counter()
+        bad_switches_lock = threading.Lock()
+        check_proxy_error = executor_kw.pop('is_proxy_error', is_proxy_error)
+
+        def _is_proxy_error(exc):
+            result = check_proxy_error(exc)
+            if result:
+                with bad_switches_lock:
+                    bad_switches['count'] += 1
+            return result
+
+        client_kw = dict({'raise_conn_problem': False, 'raise_for_status': True}, **(client_kw or {}))
+        pool_executor = executor.PoolExecutor(
+            self.proxies, proxy_gw=self.gateway and self.gateway.address,
+            max_workers=workers, retries=retries, client_kw=client_kw,
+            is_proxy_error=_is_proxy_error, **executor_kw
+        )
+
+        def _fetch(cli, url):
+            start = time.perf_counter()
+            resp = cli.get(url)
+            resp.content  # noqa
+            return time.perf_counter() - start
+
+        before = [fake_proxy.get_stats() for fake_proxy in self.fake_proxies]
+
+        latencies = []
+        errors = collections.Counter()
+
+        start = time.perf_counter()
+        for _, latency, exc in pool_executor.map(_fetch, itertools.repeat(url, requests)):
+            if exc is None:
+                latencies.append(latency)
+            else:
+                errors[type(exc).__name__] += 1
+        duration = time.perf_counter() - start
+
+        proxy_stats = collections.Counter()
+        for fake_proxy, stats in zip(self.fake_proxies, before):
+            proxy_stats.update(fake_proxy.get_stats())
+            proxy_stats.subtract(stats)
+
+        latencies.sort()
+        proxy_requests = proxy_stats['requests']
+
+        get_wait_stats = getattr(self.proxies.get_pool(), 'get_wait_stats', None)
+
+        return {
+            'requests': requests,
+            'succeeded': len(latencies),
+            'failed': sum(errors.values()),
+            'duration': duration,
+            'rps': len(latencies) / duration if duration else 0,
+            'latency': {
+                'p50': _percentile(latencies, 50),
+                'p90': _percentile(latencies, 90),
+                'p99': _percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+            },
+            'errors': dict(errors),
+            'proxy_requests': proxy_requests,
+            'ban_rate': proxy_stats[BANNED] / proxy_requests if proxy_requests else 0,
+            'failure_rate': proxy_stats[FAILED] / proxy_requests if proxy_requests else 0,
+            'bad_switches': bad_switches['count'],
+            'pool_wait': get_wait_stats() if get_wait_stats is not None else None,
+        }
@@ -0,0 +1,195 @@
+import sys
+import time
+import threading
+import contextlib
+
+
+# используется вместо замера, если профилирование выключено
+NULL_PHASE = contextlib.nullcontext()
+
+
+class _Phase:
+    __slots__ = ('_profiler', '_name', '_start')
+
+    def __init__(self, profiler, name):
+        self._profiler = profiler
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profiler.record(self._name, time.perf_counter() - self._start)
+
+
+class _TimedLock:
+    """Захватывает лок, записывая время ожидания как отдельную фазу
+
+    Медленные фазы, завершившиеся под локом, передаются в `Profiler.on_slow` после его освобождения.
+    """
+
+    __slots__ = ('_profiler', '_lock', '_phase')
+
+    def __init__(self, profiler, lock, phase):
+        self._profiler = profiler
+        self._lock = lock
+        self._phase = phase
+
+    def __enter__(self):
+        with self._phase:
+            self._lock.acquire()
+            self._profiler._hold()
+        return self._lock
+
+    def __exit__(self, *exc_info):
+        try:
+            self._lock.release()
+        finally:
+            self._profiler._unhold()
+
+
+class Profiler:
+    """Счетчики и время выполнения отдельных фаз работы пула и `Chain`
+
+    Фазы:
+        acquire.lock_wait, acquire.auto_refresh, acquire.remove_outdated, acquire.cool_released,
+        acquire.pop, acquire.blacklist_sort, acquire.wait,
+        release.lock_wait, release.cooldown_save, release.blacklist_save, release.stats_save,
+        refresh.load, refresh.cleanup,
+        chain.acquire, chain.release
+
+    Использование:
+        def on_slow(phase, duration):
+            log.warning("Медленная фаза %s: %.3f сек.", phase, duration)
+
+        profiler = proxy_switcher.profiling.Profiler(slow_threshold=0.5, on_slow=on_slow)
+        proxies = proxy_switcher.chain.Proxies(proxies_url='...', profiler=profiler)
+        ...
+        profiler.get_stats()
+    """
+
+    # ожидание свободного прокси - не задержка в работе пула, по умолчанию в `on_slow` не передается
+    DEFAULT_SLOW_THRESHOLDS = {'acquire.wait': None}
+
+    def __init__(self, slow_threshold=None, on_slow=None, slow_thresholds=None):
+        """
+        @param slow_threshold (сек.): фазы дольше указанного времени передаются в `on_slow`
+        @param on_slow: функция (название фазы, длительность в секундах); для фаз, завершившихся
+            под локом пула, вызывается после его освобождения
+        @param slow_thresholds: {фаза: порог (сек.) или None - не передавать в `on_slow`}
+            вместо `slow_threshold` (дополняет `DEFAULT_SLOW_THRESHOLDS`)
+        """
+        self.slow_threshold = slow_threshold
+        self.on_slow = on_slow
+        self.slow_thresholds = dict(self.DEFAULT_SLOW_THRESHOLDS, **(slow_thresholds or {}))
+
+        # фаза -> [кол-во, суммарное время, максимальное время]
+        self._stats = {}
+        self._lock = threading.Lock()
+        # глубина захвата локов пула и отложенные до их освобождения медленные фазы (для каждого потока)
+        self._local = threading.local()
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def locked(self, lock, name):
+        return _TimedLock(self, lock, _Phase(self, name))
+
+    def _hold(self):
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+
+    def _unhold(self):
+        local = self._local
+        local.depth -= 1
+
+        if local.depth or not getattr(local, 'slow', None):
+            return
+
+        slow, local.slow = local.slow, []
+        for name, duration in slow:
+            self.on_slow(name, duration)
+
+    def _get_slow_threshold(self, name):
+        return self.slow_thresholds.get(name, self.slow_threshold)
+
+    def record(self, name, duration):
+        with self._lock:
+            stat = self._stats.get(name)
+            if stat is None:
+                stat = self._stats[name] = [0, 0.0, 0.0]
+
+            stat[0] += 1
+            stat[1] += duration
+            if duration > stat[2]:
+                stat[2] = duration
+
+        if self.on_slow is None:
+            return
+
+        threshold = self._get_slow_threshold(name)
+        if threshold is None or duration < threshold:
+            return
+
+        local = self._local
+        if getattr(local, 'depth', 0):
+            # не вызываем чужой код под локом пула
+            if getattr(local, 'slow', None) is None:
+                local.slow = []
+            local.slow.append((name, duration))
+        else:
+            self.on_slow(name, duration)
+
+    def get_stats(self):
+        """
+        @return: {фаза: {'count', 'total', 'avg', 'max'}}
+        """
+        with self._lock:
+            return {
+                name: {'count': count, 'total': total, 'avg': total / count, 'max': max_}
+                for name, (count, total, max_) in self._stats.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+_IMPORT_SCRIPT = """
+import sys, time, json
+before = set(sys.modules)
+start = time.perf_counter()
+import %s
+duration = time.perf_counter() - start
+print(json.dumps({'time': duration, 'modules': sorted(set(sys.modules) - before)}))
+"""
+
+
+def measure_import(module='proxy_switcher', repeat=5, python=None):
+    """Замеряет время импорта модуля в отдельном процессе (для контроля регрессий времени запуска)
+
+    Использование:
+        result = proxy_switcher.profiling.measure_import()
+        assert 'urllib.request' not in result['modules']
+
+    @param repeat: кол-во замеров, берется минимальное время
+    @param python: интерпретатор (по умолчанию - текущий)
+    @return: {'time': сек., 'modules': [модули, загруженные импортом]}
+    """
+    import json
+    import subprocess
+
+    result = None
+
+    for _ in range(repeat):
+        output = subprocess.run(
+            [python or sys.executable, '-c', _IMPORT_SCRIPT % module],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True,
+        ).stdout
+        measured = json.loads(output.strip().splitlines()[-1])
+
+        if result is None or measured['time'] < result['time']:
+            result = measured
+
+    return result
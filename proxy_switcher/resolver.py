@@ -0,0 +1,163 @@
+import re
+import socket
+import ipaddress
+import threading
+import concurrent.futures
+
+from . import utils
+
+
+_ADDRESS_RE = re.compile(r'^(?P<prefix>(?:[^:/]+://)?(?:[^@/]*@)?)(?P<host>\[[^\]]*\]|[^:/]+)(?P<rest>.*)$')
+
+# TLS до самого прокси требует имени хоста (SNI, проверка сертификата)
+_KEEP_HOSTNAME_SCHEMES = ('https://',)
+
+
+class _Entry:
+    __slots__ = ('addr', 'error', 'expires_at', 'refresh_at', 'refreshing')
+
+    def __init__(self, addr, error, expires_at, refresh_at):
+        self.addr = addr
+        self.error = error
+        self.expires_at = expires_at
+        self.refresh_at = refresh_at
+        self.refreshing = False
+
+
+class DNSCache:
+    """Потокобезопасный кэш разрешения имен прокси и шлюзов
+
+    Запись обновляется в фоне по истечении доли `refresh_ahead` от `ttl` (до этого момента
+    и во время обновления используется прежний адрес), ошибки разрешения кэшируются на `negative_ttl`.
+    """
+
+    def __init__(self, ttl=300, negative_ttl=30, refresh_ahead=0.8, max_workers=10, clock=None):
+        """
+        @param ttl (сек.): время жизни адреса
+        @param negative_ttl (сек.): время жизни ошибки разрешения
+        @param refresh_ahead: доля `ttl`, после которой адрес обновляется в фоне (None - не обновлять заранее)
+        @param max_workers: кол-во потоков для `prefetch`
+        @param clock: источник времени (см. `utils.SystemClock`)
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.max_workers = max_workers
+
+        self._clock = clock or utils.SystemClock()
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _getaddrinfo(host):
+        return socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)[0][4][0]
+
+    def _lookup(self, host):
+        now = self._clock.time()
+
+        try:
+            addr, error, ttl = self._getaddrinfo(host), None, self.ttl
+        except socket.gaierror as e:
+            addr, error, ttl = None, e, self.negative_ttl
+        except UnicodeError as e:
+            # имя не кодируется в IDNA (например, слишком длинная метка) - для вызывающих это то же,
+            # что неразрешимое имя
+            addr, error, ttl = None, socket.gaierror(socket.EAI_NONAME, '%s: %s' % (host, e)), self.negative_ttl
+
+        refresh_at = None
+        if error is None and self.refresh_ahead is not None:
+            refresh_at = now + ttl * self.refresh_ahead
+
+        entry = _Entry(addr, error, now + ttl, refresh_at)
+        with self._lock:
+            self._entries[host] = entry
+
+        return entry
+
+    def _refresh(self, host):
+        try:
+            self._lookup(host)
+        finally:
+            with self._lock:
+                entry = self._entries.get(host)
+                if entry is not None:
+                    entry.refreshing = False
+
+    def resolve(self, host):
+        """
+        @return: ip-адрес
+        @raise socket.gaierror: имя не разрешается (в т.ч. ошибка из кэша)
+        """
+        now = self._clock.time()
+
+        with self._lock:
+            entry = self._entries.get(host)
+
+            if entry is not None and entry.refresh_at is not None and now >= entry.refresh_at:
+                if now < entry.expires_at and not entry.refreshing:
+                    entry.refreshing = True
+                    threading.Thread(target=self._refresh, args=(host,), daemon=True).start()
+
+        if entry is None or now >= entry.expires_at:
+            entry = self._lookup(host)
+
+        if entry.error is not None:
+            raise entry.error
+
+        return entry.addr
+
+    def resolve_address(self, address):
+        """Заменяет имя хоста в адресе прокси (`[scheme://][user:password@]host[:port]`) на ip-адрес
+
+        Если имя не разрешается - адрес возвращается без изменений.
+        """
+        if address.startswith(_KEEP_HOSTNAME_SCHEMES):
+            return address
+
+        match = _ADDRESS_RE.match(address)
+        if match is None:
+            return address
+
+        host = match.group('host')
+        if _is_ip(host):
+            return address
+
+        try:
+            addr = self.resolve(host)
+        except socket.gaierror:
+            return address
+
+        if ':' in addr:
+            addr = '[%s]' % addr
+
+        return match.group('prefix') + addr + match.group('rest')
+
+    def prefetch(self, addresses):
+        """Разрешает имена хостов из адресов в фоне (например, всего списка после загрузки)
+        """
+        hosts = set()
+        for address in addresses:
+            match = _ADDRESS_RE.match(address)
+            if match is not None and not _is_ip(match.group('host')):
+                hosts.add(match.group('host'))
+
+        if hosts:
+            threading.Thread(target=self._prefetch, args=(hosts,), daemon=True).start()
+
+    def _prefetch(self, hosts):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for _ in executor.map(self._lookup, hosts):
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host.strip('[]'))
+    except ValueError:
+        return False
+
+    return True
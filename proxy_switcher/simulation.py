@@ -0,0 +1,182 @@
+import heapq
+import random
+import itertools
+import collections
+
+from . import chain
+
+
+class SimulatedClock:
+    """Виртуальное время: ожидание не блокирует поток, а сдвигает время вперед
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def wait(self, cond, timeout=None):
+        if timeout is None:
+            raise RuntimeError("Бесконечное ожидание при моделировании: укажите таймаут")
+
+        self.advance(timeout)
+        return False
+
+
+class MinIntervalBanModel:
+    """Синтетическая модель: прокси банится, если запросы через него идут чаще указанного интервала
+    """
+
+    def __init__(self, min_intervals, default_interval=None):
+        """
+        @param min_intervals: {прокси: минимальный интервал между запросами (сек.)}
+        @param default_interval: интервал для прокси, отсутствующих в `min_intervals`
+        """
+        self.min_intervals = min_intervals
+        self.default_interval = default_interval
+        self._last_request = {}
+
+    def is_banned(self, proxy, now):
+        interval = self.min_intervals.get(proxy, self.default_interval)
+        last_request = self._last_request.get(proxy)
+        self._last_request[proxy] = now
+
+        return (
+            interval is not None and
+            last_request is not None and
+            now - last_request < interval
+        )
+
+
+class TraceBanModel:
+    """Модель по записанной трассе: прокси забанен в указанные интервалы времени
+    """
+
+    def __init__(self, bans):
+        """
+        @param bans: итерируемый объект (прокси, начало, конец) - время в секундах от начала моделирования
+        """
+        self._bans = collections.defaultdict(list)
+        for proxy, start, end in bans:
+            self._bans[proxy].append((start, end))
+
+    @classmethod
+    def from_file(cls, file_name, sep=','):
+        """Загружает трассу из файла: каждая строка - "прокси,начало,конец"
+        """
+        def _read():
+            with open(file_name) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        proxy, start, end = line.rsplit(sep, 2)
+                        yield proxy, float(start), float(end)
+
+        return cls(_read())
+
+    def is_banned(self, proxy, now):
+        return any(start <= now < end for start, end in self._bans.get(proxy, ()))
+
+
+SimulationReport = collections.namedtuple(
+    'SimulationReport',
+    'duration requests bans throughput ban_rate avg_acquire_wait max_acquire_wait',
+)
+
+
+def simulate(
+    proxies, ban_model, duration, workers=1, request_time=1.0, idle_step=1.0,
+    options=None, seed=None,
+):
+    """Моделирует работу `workers` потоков с пулом в течение `duration` секунд виртуального времени
+
+    Каждый поток в цикле берет прокси из пула, выполняет "запрос" длительностью `request_time`
+    и возвращает прокси в пул (с `bad=True`, если модель сообщила о бане).
+    Потоки, не получившие прокси, ждут в порядке очереди до ближайшего освобождения прокси.
+
+    @param proxies: список адресов прокси
+    @param ban_model: объект с методом `is_banned(proxy, now)`
+    @param duration (сек.): длительность моделирования
+    @param workers: кол-во одновременно работающих потоков
+    @param request_time (сек.): длительность одного запроса
+    @param idle_step (сек.): шаг повторной попытки, если время освобождения прокси неизвестно
+    @param options: опции `chain.Proxies` (см. `Proxies.from_cfg_string`)
+    @param seed: для воспроизводимости при 'shuffle'
+    @return: `SimulationReport`, throughput - запросов в час
+    """
+    if seed is not None:
+        random.seed(seed)
+
+    clock = SimulatedClock()
+    pool = chain.Proxies(proxies, options=dict(options or {}), clock=clock).get_pool()
+
+    requests = bans = 0
+    acquires = 0
+    total_wait = max_wait = 0.0
+
+    seq = itertools.count()
+    # (время, N, номер потока или None для таймера, взятый прокси)
+    events = [(0.0, next(seq), worker, None) for worker in range(workers)]
+    # (номер потока, начало ожидания)
+    waiting = collections.deque()
+    timers = set()
+
+    while events:
+        now, _, worker, proxy = heapq.heappop(events)
+        if now >= duration:
+            continue
+
+        clock.now = now
+
+        if worker is None:
+            timers.discard(now)
+        else:
+            if proxy is not None:
+                banned = ban_model.is_banned(proxy, now)
+                pool.release(proxy, bad=banned, bad_reason='simulation' if banned else None)
+
+                requests += 1
+                bans += banned
+
+            waiting.append((worker, now))
+
+        while waiting:
+            try:
+                proxy = pool.acquire(timeout=0)
+            except chain.NoFreeProxies:
+                break
+
+            worker, wait_start = waiting.popleft()
+
+            wait = now - wait_start
+            acquires += 1
+            total_wait += wait
+            max_wait = max(max_wait, wait)
+
+            heapq.heappush(events, (now + request_time, next(seq), worker, proxy))
+
+        if waiting:
+            wake_at = pool._get_next_release_time()
+            if wake_at is None or wake_at <= now:
+                wake_at = now + idle_step
+
+            if wake_at not in timers:
+                timers.add(wake_at)
+                heapq.heappush(events, (wake_at, next(seq), None, None))
+
+    return SimulationReport(
+        duration=duration,
+        requests=requests,
+        bans=bans,
+        throughput=requests / duration * 3600 if duration else 0,
+        ban_rate=bans / requests if requests else 0,
+        avg_acquire_wait=total_wait / acquires if acquires else 0,
+        max_acquire_wait=max_wait,
+    )
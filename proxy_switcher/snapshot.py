@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import struct
+import collections
+
+
+MAGIC = b'PSWS'
+VERSION = 1
+
+# magic, версия формата, длина заголовка
+_PREFIX = struct.Struct('<4sHI')
+
+Snapshot = collections.namedtuple('Snapshot', 'source source_version saved_at proxies state metadata')
+
+
+def save(file_name, source, source_version, proxies, state, metadata=None):
+    """Сохраняет список прокси и состояние пула в файл
+
+    Формат: префикс (magic, версия, длина заголовка), заголовок в json,
+    далее секции - список прокси (через '\\n'), состояние пула (json) и атрибуты прокси (json, если есть).
+    Смещения секций в заголовке абсолютные, поэтому файл можно читать как через `read`, так и через `mmap`.
+
+    @param source: описание источника списка (ссылка или файл + опции обработки списка),
+     снимок другого источника не используется
+    @param source_version: ETag/Last-Modified ссылки или mtime файла
+    @param state: {'cooldown': ..., 'blacklist': ..., 'stats': ...}
+    @param metadata: {прокси: {атрибут: значение}}
+    """
+    sections = [
+        ('proxies', '\n'.join(proxies).encode('utf-8')),
+        ('state', json.dumps(state, ensure_ascii=False).encode('utf-8')),
+    ]
+    if metadata:
+        sections.append(('metadata', json.dumps(metadata, ensure_ascii=False).encode('utf-8')))
+
+    header = {
+        'source': source,
+        'source_version': source_version,
+        'saved_at': time.time(),
+        'sections': {},
+    }
+
+    # смещения фиксированной ширины - длина заголовка известна до их расчета
+    header_len = len(_dump_header(header, sections, 0))
+    header_bytes = _dump_header(header, sections, _PREFIX.size + header_len)
+
+    tmp_name = '%s.%s.tmp' % (file_name, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for _, data in sections:
+            f.write(data)
+
+    # атомарная замена: читатели видят либо старый, либо новый снимок целиком
+    os.replace(tmp_name, file_name)
+
+
+def _dump_header(header, sections, offset):
+    header['sections'] = {}
+    for name, data in sections:
+        header['sections'][name] = ['%012d' % offset, len(data)]
+        offset += len(data)
+
+    return json.dumps(header).encode('utf-8')
+
+
+def load(file_name):
+    """Читает снимок за одно обращение к файлу
+
+    @return: `Snapshot` или None, если файла нет либо он в другом формате/поврежден
+    """
+    try:
+        with open(file_name, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+
+    return parse(data)
+
+
+def parse(data):
+    """
+    @param data: содержимое файла снимка (bytes, memoryview или mmap)
+    """
+    if len(data) < _PREFIX.size:
+        return None
+
+    magic, version, header_len = _PREFIX.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        return None
+
+    try:
+        header = json.loads(bytes(data[_PREFIX.size:_PREFIX.size + header_len]).decode('utf-8'))
+
+        sections = {}
+        for name, (offset, length) in header['sections'].items():
+            offset = int(offset)
+            sections[name] = bytes(data[offset:offset + length]).decode('utf-8')
+
+        proxies = sections['proxies'].split('\n') if sections['proxies'] else []
+        state = json.loads(sections['state'])
+        metadata = json.loads(sections['metadata']) if 'metadata' in sections else {}
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    return Snapshot(
+        source=header['source'],
+        source_version=header['source_version'],
+        saved_at=header['saved_at'],
+        proxies=proxies,
+        state=state,
+        metadata=metadata,
+    )
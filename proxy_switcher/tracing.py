@@ -0,0 +1,149 @@
+import time
+import random
+import threading
+import itertools
+import collections
+
+
+# start - смещение (сек.) от начала трассы
+Span = collections.namedtuple('Span', 'name start duration tags')
+
+_local = threading.local()
+_trace_ids = itertools.count(1)
+
+
+def get_current_trace():
+    """Трасса, активная в текущем потоке (см. `Trace.activate`), или None
+    """
+    return getattr(_local, 'trace', None)
+
+
+def add_span(name, start, duration, **tags):
+    """Добавляет интервал в активную трассу (без активной трассы ничего не делает)
+
+    @param start: значение `time.perf_counter()` в начале интервала
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.add_span(name, start, duration, **tags)
+
+
+class Exporter:
+    """Получатель завершенных трасс.
+
+    Вызывается синхронно в потоке, выполнявшем запрос, поэтому не должен блокироваться надолго
+    (при необходимости - складывать трассы в очередь и отправлять в фоне).
+    """
+
+    def export(self, trace):
+        pass
+
+
+class LoggingExporter(Exporter):
+    def __init__(self, logger=None, level=None):
+        """
+        @param level: уровень логирования (по умолчанию - DEBUG)
+        """
+        import logging
+
+        self.logger = logger or logging.getLogger('proxy_switcher.tracing')
+        self.level = logging.DEBUG if level is None else level
+
+    def export(self, trace):
+        if not self.logger.isEnabledFor(self.level):
+            return
+
+        self.logger.log(
+            self.level, "trace %s %s: %s", trace.trace_id, trace.tags,
+            ', '.join('%s=%.3f' % (span.name, span.duration) for span in trace.spans),
+        )
+
+
+class CollectingExporter(Exporter):
+    """Хранит последние `maxlen` трасс в памяти (для отладки)
+    """
+
+    def __init__(self, maxlen=1000):
+        self.traces = collections.deque(maxlen=maxlen)
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+
+class Trace:
+    """Трасса запроса
+
+    Может быть активна в нескольких потоках одновременно (дублирующие запросы `client.Client`),
+    интервалы, добавленные после `finish` (например, проигравшим запросом), отбрасываются.
+    """
+
+    __slots__ = ('trace_id', 'started_at', 'tags', 'spans', '_start', '_exporter', '_finished')
+
+    def __init__(self, exporter, tags):
+        self.trace_id = next(_trace_ids)
+        # время начала трассы (unix time), интервалы отсчитываются от него
+        self.started_at = time.time()
+        self.tags = tags
+        self.spans = []
+
+        self._start = time.perf_counter()
+        self._exporter = exporter
+        self._finished = False
+
+    def add_span(self, name, start, duration, **tags):
+        if not self._finished:
+            self.spans.append(Span(name, start - self._start, duration, tags))
+
+    def activate(self):
+        """Делает трассу текущей для потока (для интервалов, добавляемых через `add_span`)
+        """
+        # предыдущая трасса - своя для каждого потока
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+
+        stack.append(getattr(_local, 'trace', None))
+        _local.trace = self
+
+    def deactivate(self):
+        _local.trace = _local.stack.pop()
+
+    def finish(self):
+        self.add_span('total', self._start, time.perf_counter() - self._start)
+        self._finished = True
+        self._exporter.export(self)
+
+
+class Tracer:
+    """Трассировка запросов `client.Client`
+
+    Интервалы (`Span`):
+        pool.acquire - ожидание прокси из пула (tags: proxy), в т.ч. при смене прокси между запросами
+            (`Client.switch_session`) - такой интервал попадает в трассу следующего запроса с отрицательным `start`
+        ttfb - от отправки запроса до получения заголовков ответа
+            (включая подключение к шлюзу, согласование с прокси цепочки и TLS для нового соединения)
+        download - получение тела ответа (не измеряется при stream=True)
+        total - весь запрос
+    Трасса помечается тегами method, url, chain (цепочка адресов, через которую получен ответ), proxy, error.
+
+    Использование:
+        tracer = proxy_switcher.tracing.Tracer(MyExporter(), sample_rate=0.1)
+        client = proxy_switcher.client.Client(proxy_chain=proxy_chain, tracer=tracer)
+    """
+
+    def __init__(self, exporter, sample_rate=1.0):
+        """
+        @param exporter: `Exporter`
+        @param sample_rate: доля трассируемых запросов (0-1)
+        """
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def start_trace(self, **tags):
+        """
+        @return: `Trace` или None, если запрос не попал в выборку
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+
+        return Trace(self.exporter, tags)
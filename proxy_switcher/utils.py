@@ -1,4 +1,4 @@
-import json_dict
+import time
 
 
 missing_gw = object()
@@ -35,6 +35,8 @@ def get_json_dict(cls, filename=None, auto_save=True, **kw):
     if filename is None:
         return cls.factory()
 
+    import json_dict
+
     try:
         result = cls(filename, auto_save=auto_save, **kw)
     except json_dict.FileReadError:
@@ -43,3 +45,22 @@ def get_json_dict(cls, filename=None, auto_save=True, **kw):
         result = cls(filename, auto_save=auto_save, ignore_read_error=True, **kw)
 
     return result
+
+
+class SystemClock:
+    """Источник времени для `chain.Proxies` и пула
+
+    При моделировании подменяется на `simulation.SimulatedClock`
+    """
+
+    @staticmethod
+    def time():
+        return time.time()
+
+    @staticmethod
+    def perf_counter():
+        return time.perf_counter()
+
+    @staticmethod
+    def wait(cond, timeout=None):
+        return cond.wait(timeout)